@@ -0,0 +1,55 @@
+""" Sweep CompressedBand codec settings (compressor, compression level,
+shuffle filter, and chunk shape) over representative rasters, reporting the
+compression ratio and the time spent encoding and decoding.
+
+Usage: python benchmark_band_codecs.py [geotiff ...]
+
+Without arguments, a synthetic float32 DEM and a uint8 image are used.
+"""
+import sys
+import itertools
+import numpy as np
+import blosc
+from karta.raster.band import CompressedBand
+
+def synthetic_rasters(n=2048):
+    np.random.seed(49)
+    x, y = np.meshgrid(np.linspace(-3, 3, n), np.linspace(-3, 3, n))
+    dem = (1000.0 * np.exp(-x**2-y**2) + 200.0*np.sin(3*x)*np.cos(2*y) +
+           np.random.rand(n, n)).astype(np.float32)
+    img = (np.clip(127*(np.sin(5*x)+np.cos(7*y)) + 128 +
+                   10*np.random.randn(n, n), 0, 255)).astype(np.uint8)
+    return [("synthetic DEM (float32)", dem), ("synthetic image (uint8)", img)]
+
+def geotiff_rasters(paths):
+    import karta
+    for path in paths:
+        grid = karta.read_gtiff(path, ibands=1)
+        yield path, grid[:,:]
+
+def sweep(name, data):
+    print("\n{0}, {1}x{2}".format(name, *data.shape))
+    print("{0:>8s} {1:>6s} {2:>7s} {3:>10s} {4:>8s} {5:>10s} {6:>10s}".format(
+          "codec", "clevel", "shuffle", "chunksize", "ratio", "encode (s)",
+          "decode (s)"))
+    for cname, clevel, shuffle, chunksize in itertools.product(
+            blosc.compressor_list(), (1, 5, 9), ("none", "byte", "bit"),
+            ((128, 128), (256, 256), (512, 512))):
+        band = CompressedBand(data.shape, data.dtype, chunksize=chunksize,
+                              compressor=cname, clevel=clevel,
+                              shuffle=shuffle, cachesize=0)
+        band[:,:] = data
+        band[:,:]
+        print("{0:>8s} {1:6d} {2:>7s} {3:>10s} {4:8.2f} {5:10.3f} "
+              "{6:10.3f}".format(cname, clevel, shuffle,
+                                 "{0}x{1}".format(*chunksize),
+                                 band.compression_ratio, band.encode_time,
+                                 band.decode_time))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        rasters = geotiff_rasters(sys.argv[1:])
+    else:
+        rasters = synthetic_rasters()
+    for name, data in rasters:
+        sweep(name, data)
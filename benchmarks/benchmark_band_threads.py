@@ -0,0 +1,36 @@
+""" Measure how CompressedBand full-band reads and writes scale with the
+number of compression threads.
+
+Usage: python benchmark_band_threads.py [size]
+"""
+import sys
+import time
+import multiprocessing
+import numpy as np
+from karta.raster.band import CompressedBand
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 8192
+np.random.seed(49)
+x, y = np.meshgrid(np.linspace(0, 20, n), np.linspace(0, 20, n))
+data = (np.sin(x) * np.cos(y) * 1000.0 +
+        np.random.rand(n, n)).astype(np.float32)
+
+def timed(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        best = min(best, time.time() - t0)
+    return best
+
+print("{0}x{0} float32 band".format(n))
+print("threads    write (s)    read (s)    write speedup    read speedup")
+t1w = t1r = None
+for threads in range(1, multiprocessing.cpu_count()+1):
+    band = CompressedBand((n, n), np.float32, threads=threads, cachesize=0)
+    tw = timed(lambda: band.__setitem__((slice(None), slice(None)), data))
+    tr = timed(lambda: band[:,:])
+    if t1w is None:
+        t1w, t1r = tw, tr
+    print("{0:7d}    {1:9.3f}    {2:8.3f}    {3:13.2f}    {4:12.2f}".format(
+          threads, tw, tr, t1w/tw, t1r/tr))
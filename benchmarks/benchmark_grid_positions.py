@@ -0,0 +1,56 @@
+""" Compare the closed-form inverse transform used by
+RegularGrid.get_positions against the block-diagonal linear solve it
+replaced, for increasing numbers of points on a skewed grid.
+
+Usage: python benchmark_grid_positions.py
+"""
+import timeit
+import numpy as np
+import karta
+
+def get_positions_solve(grid, x, y):
+    """ Previous implementation, solving dense 140x140 block-diagonal systems
+    for batches of 70 points. """
+    npts = len(x)
+    n = min(70, npts)
+    t = grid.transform
+    T = (np.diag(np.tile([t[2], t[3]], n)) +
+         np.diag(np.tile([t[4], 0], n)[:-1], 1) +
+         np.diag(np.tile([t[5], 0], n)[:-1], -1))
+    S = np.tile([t[0]+0.5*(t[2]+t[4]), t[1]+0.5*(t[3]+t[5])], n)
+    ind = np.empty(2*npts, dtype=np.float64)
+    i = 0
+    while i != npts:
+        ip = min(i + n, npts)
+        xy = np.zeros(2*n, dtype=np.float64)
+        xy[:2*(ip-i)] = np.vstack([x[i:ip], y[i:ip]]).T.ravel()
+        ind_ = np.linalg.solve(T, xy - S)
+        ind[2*i:2*ip] = ind_[:2*(ip-i)]
+        i = ip
+    return ind[1::2], ind[::2]
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - t0)
+    return min(times)
+
+if __name__ == "__main__":
+    grid = karta.RegularGrid((500.0, -200.0, 30.0, 25.0, 2.0, -1.5),
+                             values=np.zeros((2000, 2000), dtype=np.float32))
+    rs = np.random.RandomState(49)
+    print("{0:>9s} {1:>12s} {2:>12s} {3:>8s} {4:>10s}".format(
+          "points", "solve (s)", "closed (s)", "speedup", "max diff"))
+    for npts in (10**3, 10**4, 10**5, 10**6):
+        i = rs.uniform(0, 1999, npts)
+        j = rs.uniform(0, 1999, npts)
+        x, y = grid.get_coordinates(i, j)
+        t_solve = best_of(lambda: get_positions_solve(grid, x, y), repeat=1)
+        t_closed = best_of(lambda: grid.get_positions(x, y))
+        i0, j0 = get_positions_solve(grid, x, y)
+        i1, j1 = grid.get_positions(x, y)
+        diff = max(np.abs(i1-i0).max(), np.abs(j1-j0).max())
+        print("{0:9d} {1:12.4f} {2:12.4f} {3:8.0f} {4:10.2e}".format(
+              npts, t_solve, t_closed, t_solve/t_closed, diff))
@@ -10,16 +10,22 @@ numbers.Integral.register(numpy.integer)
 
 from . import grid
 from . import misc
+from . import expression
 
-from .grid import RegularGrid, WarpedGrid, merge, gridpoints, mask_poly
-from .band import SimpleBand, CompressedBand
+from .grid import (RegularGrid, WarpedGrid, PointBinner, merge, gridpoints,
+                   mask_poly, rasterize)
+from .band import SimpleBand, CompressedBand, MemmapBand
+from .expression import GridExpression, where
 from .read import read_aai, read_gtiff, aairead, gtiffread
 from .misc import (witch_of_agnesi, pad, normed_potential_vectors,
-                   slope, aspect, gradient, divergence, hillshade)
+                   slope, aspect, gradient, divergence, hillshade, terrain,
+                   viewshed, cumulative_viewshed)
 
-__all__ = ["grid", "misc",
-           "RegularGrid", "WarpedGrid",
+__all__ = ["grid", "misc", "expression",
+           "RegularGrid", "WarpedGrid", "PointBinner", "GridExpression",
+           "where", "rasterize",
            "aairead", "gtiffread", "read_aai", "read_gtiff",
            "slope", "aspect", "gradient", "divergence", "hillshade",
-           "normed_potential_vectors"]
+           "normed_potential_vectors", "terrain", "viewshed",
+           "cumulative_viewshed"]
 
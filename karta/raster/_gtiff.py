@@ -3,7 +3,8 @@
 import struct
 import sys
 import numpy as np
-from .band import SimpleBand, CompressedBand
+from .band import SimpleBand, CompressedBand, ChunkedIndexingMixin
+from .band import is_mask_key, is_indices_key, is_rows_key
 from .. import errors
 
 try:
@@ -17,7 +18,10 @@ except ImportError:
 
 ALL = -1
 
-class GdalFileBand(object):
+# Approximate size of the strips in which GeoTiff data are copied into bands
+READ_STRIP_BYTES = 16*1024**2
+
+class GdalFileBand(ChunkedIndexingMixin):
     """ Imitates an ndarray well-enough to back a Grid instance, but reads data
     from an disk-bound datasource """
 
@@ -26,6 +30,22 @@ class GdalFileBand(object):
         self.dataset = dataset
         return
 
+    @property
+    def _blocksize(self):
+        bx, by = self.band.GetBlockSize()
+        return (by, bx)
+
+    @property
+    def _blockoffset(self):
+        # GDAL blocks are aligned with the top of the raster, which is the
+        # last row in karta convention
+        return (-self.size[0]) % self._blocksize[0]
+
+    def _readblock(self, yoff, xoff, size):
+        ny = self.size[0]
+        return self.band.ReadAsArray(xoff, ny-yoff-size[0],
+                                     size[1], size[0])[::-1]
+
     def __del__(self):
         self.dataset = None
         self.band = None
@@ -33,6 +53,13 @@ class GdalFileBand(object):
     def __getitem__(self, idx):
         ny, nx = self.size
 
+        if is_mask_key(idx):
+            return self._getmasked(idx)
+        elif is_indices_key(idx):
+            return self._getindexed(idx)
+        elif is_rows_key(idx):
+            return self._getindexed(self._rowindices(idx))
+
         if isinstance(idx, tuple):
             iidx, jidx = idx
         else:
@@ -185,7 +212,7 @@ def gdal_type(dtype):
     else:
         raise TypeError("GDAL equivalent to type {0} unknown".format(dtype))
 
-def read(fnm, in_memory, ibands=ALL, bandclass=CompressedBand):
+def read(fnm, in_memory, ibands=ALL, bandclass=CompressedBand, bandkwargs=None):
     """ Read a GeoTiff file and return a numpy array and a dictionary of header
     information.
 
@@ -198,7 +225,11 @@ def read(fnm, in_memory, ibands=ALL, bandclass=CompressedBand):
     ibands : int or list of ints
         band number (1...)
     bandclass : karta.raster.band class
-        if *in_memory* is `False`, use this class for band storage
+        if *in_memory* is `True`, use this class for band storage (e.g.
+        SimpleBand, CompressedBand, or MemmapBand)
+    bandkwargs : dict, optional
+        keyword arguments passed to *bandclass*, e.g. to choose the compressor
+        or chunk size of a CompressedBand
 
     Returns an band object and a dictionary of metadata
     """
@@ -244,10 +275,25 @@ def read(fnm, in_memory, ibands=ALL, bandclass=CompressedBand):
 
         if in_memory:
             dtype = numpy_dtype(rasterbands[0].DataType)
-            bands = [bandclass((ny, nx), dtype) for _ in ibands]
+            if bandkwargs is None:
+                bandkwargs = {}
+            bands = [bandclass((ny, nx), dtype, **bandkwargs) for _ in ibands]
+            # chunk statistics recorded while copying exclude nodata
+            for band in bands:
+                if hasattr(band, "chunk_statistics"):
+                    band.nodata = hdr["nodata"]
+
+            # Copy strips of rows so that a full-size temporary array is never
+            # needed. Strips are a multiple of the chunk height (256 rows for
+            # bands without chunks), aligned from the bottom of the raster.
+            chunkrows = getattr(bands[0], "_chunksize", (256, 256))[0]
+            nrows = chunkrows * max(1, READ_STRIP_BYTES //
+                                       (chunkrows*nx*np.dtype(dtype).itemsize))
             for i, rb in enumerate(rasterbands):
-                _arr = rb.ReadAsArray(buf_obj=np.empty([ny, nx], dtype=dtype))
-                bands[i][:,:] = _arr.squeeze()[::-1]
+                for y0 in range(0, ny, nrows):
+                    y1 = min(ny, y0+nrows)
+                    strip = rb.ReadAsArray(0, ny-y1, nx, y1-y0)
+                    bands[i][y0:y1,:] = strip[::-1]
         else:
             bands = [GdalFileBand(rb, dataset) for rb in rasterbands]
 
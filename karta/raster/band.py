@@ -9,11 +9,132 @@ Overview
 `SimpleBand` use numpy arrays for data storage
 
 `CompressedBand` uses blosc compression to reduce in-memory footprint
+
+`MemmapBand` uses a memory-mapped scratch file for data storage
+
+`ChunkCache` is a byte-budgeted LRU cache of decompressed chunks used by
+`CompressedBand`
+
+`ChunkedIndexingMixin` implements boolean mask and integer array indexing for
+bands stored as a regular grid of blocks
 """
 
+import os
+import tempfile
+import threading
+import timeit
 import blosc
 import numpy as np
 from math import ceil
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Default byte budget for the decompressed chunk cache of each CompressedBand.
+# Can be modified to change the cache size of subsequently created bands.
+CACHE_SIZE_DEFAULT = 64*1024**2
+
+# Default blosc codec settings for CompressedBand
+COMPRESSOR_DEFAULT = "blosclz"
+CLEVEL_DEFAULT = 9
+SHUFFLE_DEFAULT = "byte"
+
+SHUFFLE_MODES = {"none": blosc.NOSHUFFLE,
+                 "byte": blosc.SHUFFLE,
+                 "bit": getattr(blosc, "BITSHUFFLE", None)}
+
+# Number of threads used by each CompressedBand to compress and decompress
+# independent chunks concurrently
+THREADS_DEFAULT = 1
+
+# Directory in which MemmapBand creates scratch files. If None, the system
+# temporary directory is used.
+SCRATCH_DIR_DEFAULT = None
+
+_THREAD_POOLS = {}
+_THREAD_POOLS_LOCK = threading.Lock()
+_SCRATCH = threading.local()
+
+def get_thread_pool(nthreads):
+    """ Return a shared thread pool with *nthreads* workers, creating it if
+    necessary. """
+    with _THREAD_POOLS_LOCK:
+        pool = _THREAD_POOLS.get(nthreads)
+        if pool is None:
+            # blosc only releases the GIL (and uses its thread-safe context
+            # functions) when asked to
+            if hasattr(blosc, "set_releasegil"):
+                blosc.set_releasegil(True)
+            pool = ThreadPool(nthreads)
+            _THREAD_POOLS[nthreads] = pool
+    return pool
+
+def scratch_array(shape, dtype):
+    """ Return an uninitialized array backed by a buffer that is reused by
+    subsequent calls from the same thread. """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buf = getattr(_SCRATCH, "buf", None)
+    if buf is None or len(buf) < nbytes:
+        buf = bytearray(nbytes)
+        _SCRATCH.buf = buf
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+# Record type of the summary statistics maintained for each CompressedBand
+# chunk. *m2* is the sum of squared deviations from the chunk mean, which can
+# be combined across chunks without loss of precision.
+STATS_DTYPE = np.dtype([("min", np.float64), ("max", np.float64),
+                        ("sum", np.float64), ("m2", np.float64),
+                        ("count", np.int64), ("nnodata", np.int64)])
+
+def isnodata(values, nodata):
+    """ Return a boolean array indicating which *values* equal *nodata*, or
+    None if *nodata* is None. NaN nodata matches NaN values. """
+    if nodata is None:
+        return None
+    elif nodata != nodata:
+        return np.isnan(values)
+    else:
+        return values == nodata
+
+def summarize(values, nodata=None):
+    """ Return a `STATS_DTYPE` record summarizing the cells of *values* that
+    are not *nodata*. """
+    stats = np.zeros((), dtype=STATS_DTYPE)
+    stats["min"] = np.nan
+    stats["max"] = np.nan
+    invalid = isnodata(values, nodata)
+    if invalid is not None:
+        nnodata = np.count_nonzero(invalid)
+        if nnodata != 0:
+            values = values[~invalid]
+        stats["nnodata"] = nnodata
+    n = values.size
+    if n != 0:
+        stats["min"] = values.min()
+        stats["max"] = values.max()
+        stats["sum"] = values.sum(dtype=np.float64)
+        stats["m2"] = values.var(dtype=np.float64) * n
+        stats["count"] = n
+    return stats
+
+def summarize_constant(value, n, nodata=None):
+    """ Return a `STATS_DTYPE` record summarizing *n* cells equal to *value*.
+    """
+    stats = np.zeros((), dtype=STATS_DTYPE)
+    if isnodata(np.asarray(value), nodata):
+        stats["min"] = np.nan
+        stats["max"] = np.nan
+        stats["nnodata"] = n
+    else:
+        stats["min"] = value
+        stats["max"] = value
+        stats["sum"] = float(value) * n
+        stats["count"] = n
+    return stats
+
+def array_address(array):
+    """ Return the address of the data buffer of a C-contiguous *array*. """
+    return array.__array_interface__["data"][0]
 
 class BandIndexer(object):
 
@@ -22,33 +143,16 @@ class BandIndexer(object):
 
     def __getitem__(self, key):
         if len(self.bands) == 1:
-            if isinstance(key, np.ndarray):
-                return self.bands[0][:,:][key]
-            else:
-                return self.bands[0][key]
+            return self.bands[0][key]
         else:
-            if isinstance(key, np.ndarray):
-                return np.dstack([b[:,:][key] for b in self.bands])
-            else:
-                return np.dstack([b[key] for b in self.bands])
+            return np.dstack([b[key] for b in self.bands])
 
     def __setitem__(self, key, value):
         if len(self.bands) == 1:
-            if isinstance(key, np.ndarray):
-                tmp = self.bands[0][:,:]
-                tmp[key] = value
-                self.bands[0][:,:] = tmp
-            else:
-                self.bands[0][key] = value
+            self.bands[0][key] = value
         else:
-            if isinstance(key, np.ndarray):
-                for b, v in zip(self.bands, value):
-                    tmp = b[:,:]
-                    tmp[key] = v
-                    b[:,:] = tmp
-            else:
-                for b, v in zip(self.bands, value):
-                    b[key] = v
+            for b, v in zip(self.bands, value):
+                b[key] = v
         return
 
     def __iter__(self):
@@ -94,16 +198,394 @@ class SimpleBand(object):
         self.array[key] = value
         return
 
-class CompressedBand(object):
-    """ CompressedBand is a chunked, blosc-compressed array. """
+class MemmapBand(object):
+    """ MemmapBand stores data in a numpy.memmap backed by a file on disk, so
+    that bands larger than available memory can be built and modified in
+    place. Caching of recently used data is left to the operating system.
+
+    Parameters
+    ----------
+    size : tuple of two integers
+        band dimensions (rows, columns)
+    dtype : numpy dtype
+    initval : number, optional
+        value used to initialize the band
+    filename : str, optional
+        file in which to store data. If not provided, a scratch file is
+        created in *SCRATCH_DIR_DEFAULT* and removed when the band is deleted.
+    """
+
+    def __init__(self, size, dtype, initval=None, filename=None):
+        self.size = size
+        self.dtype = dtype
+        if filename is None:
+            fd, filename = tempfile.mkstemp(prefix="karta-", suffix=".band",
+                                            dir=SCRATCH_DIR_DEFAULT)
+            os.close(fd)
+            self._scratch = True
+        else:
+            self._scratch = False
+        self.filename = filename
+        self.array = np.memmap(filename, dtype=dtype, mode="w+",
+                               shape=tuple(size))
+        if initval is not None and initval != 0:
+            # Fill row by row to avoid allocating a full-size temporary
+            for i in range(size[0]):
+                self.array[i,:] = initval
+        return
+
+    def __del__(self):
+        array = getattr(self, "array", None)
+        if array is not None:
+            self.array = None
+            del array
+            if self._scratch:
+                try:
+                    os.remove(self.filename)
+                except OSError:
+                    pass
+        return
+
+    def __deepcopy__(self, memo):
+        band = MemmapBand(self.size, self.dtype)
+        for i in range(self.size[0]):
+            band.array[i,:] = self.array[i,:]
+        return band
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+        return
+
+    def flush(self):
+        """ Write changes to disk. """
+        self.array.flush()
+        return
+
+def is_mask_key(key):
+    """ Return whether *key* is a boolean array used for masked indexing. """
+    return isinstance(key, np.ndarray) and (key.dtype == np.bool_)
+
+def is_indices_key(key):
+    """ Return whether *key* is a pair of integer arrays used for fancy
+    indexing. """
+    return isinstance(key, tuple) and (len(key) == 2) and \
+            all(isinstance(k, (np.ndarray, list)) for k in key)
+
+def is_rows_key(key):
+    """ Return whether *key* is an integer array selecting rows. """
+    return isinstance(key, np.ndarray) and np.issubdtype(key.dtype, np.integer)
+
+class ChunkedIndexingMixin(object):
+    """ Provides boolean mask and integer array indexing for bands stored as
+    a regular grid of blocks. Only blocks containing selected cells are read
+    or written, so that memory use scales with the block size and the number
+    of selected cells rather than with the size of the band.
+
+    Classes using the mixin define *size*, *dtype*, *_blocksize*, and
+    *_blockoffset* (the number of rows by which the first row of blocks is
+    truncated), and the methods *_readblock(yoff, xoff, size)* and (for
+    writable bands) *_writeblock(yoff, xoff, array)*, which are called with
+    the corner of a block.
+    """
+
+    _blockoffset = 0
+
+    def _iterblocks(self):
+        """ Yield the bounds (ystart, yend, xstart, xend) of each block in
+        row-major order. """
+        ny, nx = self.size
+        by, bx = self._blocksize
+        off = self._blockoffset
+        y0 = 0
+        while y0 < ny:
+            y1 = min(ny, ((y0+off)//by + 1)*by - off)
+            x0 = 0
+            while x0 < nx:
+                x1 = min(nx, x0+bx)
+                yield y0, y1, x0, x1
+                x0 = x1
+            y0 = y1
+
+    def _iterblocks_masked(self, mask):
+        """ Yield the bounds of each block containing True cells in *mask*,
+        along with the local mask and the positions of the selected cells in
+        row-major order over the whole band. """
+        if mask.shape != tuple(self.size):
+            raise IndexError("mask shape {0} does not match band size "
+                             "{1}".format(mask.shape, self.size))
+        pos = 0
+        for y0, y1, x0, x1 in self._iterblocks():
+            if x0 == 0:
+                # New row of blocks - compute the position of the first
+                # selected cell of each row
+                rowcounts = np.count_nonzero(mask[y0:y1], axis=1)
+                offsets = pos + np.cumsum(rowcounts) - rowcounts
+                pos += rowcounts.sum()
+
+            m = mask[y0:y1, x0:x1]
+            counts = np.count_nonzero(m, axis=1)
+            n = counts.sum()
+            if n != 0:
+                dest = np.repeat(offsets - np.cumsum(counts) + counts, counts) \
+                        + np.arange(n)
+                yield y0, y1, x0, x1, m, dest
+            offsets += counts
+
+    def _getmasked(self, mask):
+        """ Return a vector of the values where *mask* is True. """
+        result = np.empty(np.count_nonzero(mask), dtype=self.dtype)
+        for y0, y1, x0, x1, m, dest in self._iterblocks_masked(mask):
+            result[dest] = self._readblock(y0, x0, (y1-y0, x1-x0))[m]
+        return result
+
+    def _setmasked(self, mask, value):
+        """ Set the values where *mask* is True from a scalar or from a vector
+        with one entry per True cell. """
+        scalar = (np.ndim(value) == 0)
+        if not scalar:
+            value = np.asarray(value)
+            if value.shape != (np.count_nonzero(mask),):
+                raise IndexError("cannot assign {0} values to {1} masked "
+                                 "cells".format(value.size,
+                                                np.count_nonzero(mask)))
+
+        for y0, y1, x0, x1, m, dest in self._iterblocks_masked(mask):
+            if scalar and (len(dest) == m.size):
+                block = np.empty(m.shape, dtype=self.dtype)
+                block[:,:] = value
+            else:
+                block = np.array(self._readblock(y0, x0, (y1-y0, x1-x0)))
+                block[m] = value if scalar else value[dest]
+            self._writeblock(y0, x0, block)
+        return
+
+    def _groupindices(self, key):
+        """ Normalize a pair of index arrays and yield the bounds of each block
+        that is indexed, along with the positions of indices falling in that
+        block. """
+        ny, nx = self.size
+        by, bx = self._blocksize
+        off = self._blockoffset
+
+        I, J = np.broadcast_arrays(*[np.asarray(k) for k in key])
+        I = np.where(I<0, I+ny, I).ravel()
+        J = np.where(J<0, J+nx, J).ravel()
+        if len(I) != 0 and ((I.min() < 0) or (I.max() >= ny) or
+                            (J.min() < 0) or (J.max() >= nx)):
+            raise IndexError("index out of bounds for band with size "
+                             "{0}".format(self.size))
+
+        nblockcols = int(ceil(float(nx)/bx))
+        blockid = ((I+off)//by)*nblockcols + J//bx
+        order = np.argsort(blockid, kind="mergesort")
+        sortedid = blockid[order]
+        breaks = np.r_[0, np.flatnonzero(np.diff(sortedid))+1, len(order)]
+
+        for start, end in zip(breaks[:-1], breaks[1:]):
+            idx = order[start:end]
+            bi, bj = divmod(sortedid[start], nblockcols)
+            y0 = max(0, bi*by-off)
+            y1 = min(ny, (bi+1)*by-off)
+            x0 = bj*bx
+            x1 = min(nx, x0+bx)
+            yield y0, y1, x0, x1, idx, I[idx]-y0, J[idx]-x0
+
+    def _rowindices(self, rows):
+        """ Return the pair of index arrays selecting every column of *rows*,
+        broadcasting to the shape of *rows* followed by the number of
+        columns. """
+        return (np.asarray(rows)[...,np.newaxis], np.arange(self.size[1]))
+
+    def _getindexed(self, key):
+        """ Return values at a pair of row and column index arrays. """
+        shape = np.broadcast(*[np.asarray(k) for k in key]).shape
+        result = np.empty(int(np.prod(shape)), dtype=self.dtype)
+        for y0, y1, x0, x1, idx, bi, bj in self._groupindices(key):
+            result[idx] = self._readblock(y0, x0, (y1-y0, x1-x0))[bi, bj]
+        return result.reshape(shape)
+
+    def _setindexed(self, key, value):
+        """ Set values at a pair of row and column index arrays. """
+        shape = np.broadcast(*[np.asarray(k) for k in key]).shape
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), shape).ravel()
+        for y0, y1, x0, x1, idx, bi, bj in self._groupindices(key):
+            block = np.array(self._readblock(y0, x0, (y1-y0, x1-x0)))
+            block[bi, bj] = value[idx]
+            self._writeblock(y0, x0, block)
+        return
+
+class ChunkCache(object):
+    """ Least-recently-used cache of decompressed chunk arrays, bounded by the
+    total number of bytes held rather than by the number of entries.
+
+    Parameters
+    ----------
+    maxbytes : int
+        byte budget for cached arrays. A budget of zero disables caching.
+    """
+
+    def __init__(self, maxbytes):
+        self._entries = OrderedDict()
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ Return the array cached under *key*, or None if not present. """
+        try:
+            array = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = array
+        self.hits += 1
+        return array
+
+    def put(self, key, array):
+        """ Insert *array* under *key*, evicting least-recently-used entries
+        until the cache is within budget. """
+        self.invalidate(key)
+        if array.nbytes > self.maxbytes:
+            return
+        self._entries[key] = array
+        self.nbytes += array.nbytes
+        self._evict()
+        return
+
+    def pop(self, key):
+        """ Remove and return the array cached under *key*, or None. """
+        array = self._entries.pop(key, None)
+        if array is not None:
+            self.nbytes -= array.nbytes
+        return array
+
+    def invalidate(self, key):
+        """ Discard the entry cached under *key*, if any. """
+        self.pop(key)
+        return
+
+    def clear(self):
+        """ Discard all cached entries and reset the hit and miss counters. """
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def resize(self, maxbytes):
+        """ Change the byte budget, evicting entries as necessary. """
+        self.maxbytes = maxbytes
+        self._evict()
+        return
+
+    def _evict(self):
+        while self.nbytes > self.maxbytes:
+            _, array = self._entries.popitem(last=False)
+            self.nbytes -= array.nbytes
+        return
+
+class CompressedBand(ChunkedIndexingMixin):
+    """ CompressedBand is a chunked, blosc-compressed array.
+
+    Recently decompressed chunks are kept in a `ChunkCache`, so that repeated
+    reads from the same region (e.g. iterating over rows) do not decompress
+    the same chunks repeatedly. The cache is exposed as the *cache* attribute,
+    which reports *hits* and *misses*.
+
+    Compression is configurable through the blosc codec, compression level,
+    shuffle filter, and chunk shape. The band records the cumulative time
+    spent encoding and decoding chunks (*encode_time*, *decode_time*, in
+    seconds) and reports its *compression_ratio*.
+
+    Chunks containing a single value (e.g. bands created with *initval*, or
+    regions filled with nodata) are not compressed. Instead, the value is
+    stored directly and chunks are only expanded when read or partially
+    overwritten.
+
+    Summary statistics of each chunk (see `STATS_DTYPE`) are updated whenever
+    the chunk is written, so that reductions such as the band minimum and
+    maximum require no decompression. Cells equal to the *nodata* attribute
+    are excluded from the statistics.
+
+    Parameters
+    ----------
+    size : tuple of two integers
+        band dimensions (rows, columns)
+    dtype : numpy dtype
+    chunksize : tuple of two integers, optional
+        dimensions of compressed chunks (default (256, 256))
+    initval : number, optional
+        value used to initialize the band
+    cachesize : int, optional
+        byte budget of the decompressed chunk cache (default
+        CACHE_SIZE_DEFAULT). Zero disables caching.
+    compressor : str, optional
+        blosc codec, one of `blosc.compressor_list()`, e.g. 'blosclz', 'lz4',
+        'lz4hc', 'zlib', or 'zstd' (default COMPRESSOR_DEFAULT)
+    clevel : int, optional
+        compression level from 0 to 9 (default CLEVEL_DEFAULT)
+    shuffle : str, optional
+        shuffle filter applied before compression, one of 'byte', 'bit', or
+        'none' (default SHUFFLE_DEFAULT)
+    threads : int, optional
+        number of threads used to compress and decompress chunks when
+        reading or writing regions spanning several chunks (default
+        THREADS_DEFAULT). Can be changed later through the *threads*
+        attribute.
+    """
     CHUNKSET = 1
     CHUNKUNSET = 0
+    CHUNKCONST = 2
 
-    def __init__(self, size, dtype, chunksize=(256, 256), initval=None):
+    def __init__(self, size, dtype, chunksize=(256, 256), initval=None,
+                 cachesize=None, compressor=None, clevel=None, shuffle=None,
+                 threads=None):
         assert len(size) == 2
         self.size = size
         self.dtype = dtype
-        self._chunksize = chunksize
+        self._chunksize = tuple(chunksize)
+        self._blocksize = self._chunksize
+
+        if compressor is None:
+            compressor = COMPRESSOR_DEFAULT
+        if clevel is None:
+            clevel = CLEVEL_DEFAULT
+        if shuffle is None:
+            shuffle = SHUFFLE_DEFAULT
+
+        if compressor not in blosc.compressor_list():
+            raise ValueError("compressor '{0}' not available (choose from "
+                             "{1})".format(compressor,
+                                           blosc.compressor_list()))
+        if not 0 <= clevel <= 9:
+            raise ValueError("clevel must be between 0 and 9")
+        if SHUFFLE_MODES.get(shuffle) is None:
+            raise ValueError("shuffle must be one of 'byte', 'bit', or 'none'")
+        self.compressor = compressor
+        self.clevel = clevel
+        self.shuffle = shuffle
+
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+
+        if cachesize is None:
+            cachesize = CACHE_SIZE_DEFAULT
+        self.cache = ChunkCache(cachesize)
+
+        if threads is None:
+            threads = THREADS_DEFAULT
+        self.threads = threads
 
         self.nchunkrows = int(ceil(float(size[0])/float(chunksize[0])))
         self.nchunkcols = int(ceil(float(size[1])/float(chunksize[1])))
@@ -113,16 +595,34 @@ class CompressedBand(object):
         self._data = [None for i in range(nchunks)]
 
         # 0 => unset
-        # 1 => set
+        # 1 => set (data store contains compressed bytes)
+        # 2 => constant (data store contains a scalar)
         self.chunkstatus = np.zeros(nchunks, dtype=np.int8)
 
         if initval is not None:
-            self[:,:] = initval*np.ones(size, dtype=dtype)
+            value = np.asarray(initval).astype(dtype)[()]
+            self._data = [value for i in range(nchunks)]
+            self.chunkstatus[:] = self.CHUNKCONST
+
+        # Per-chunk summary statistics, computed with respect to _nodata.
+        # Statistics that are not valid are computed on demand.
+        self._nodata = None
+        self._stats = np.zeros(nchunks, dtype=STATS_DTYPE)
+        self._statsvalid = np.zeros(nchunks, dtype=np.bool_)
         return
 
     def __getitem__(self, key):
 
-        if isinstance(key, int):
+        if is_mask_key(key):
+            return self._getmasked(key)
+
+        elif is_indices_key(key):
+            return self._getindexed(key)
+
+        elif is_rows_key(key):
+            return self._getindexed(self._rowindices(key))
+
+        elif isinstance(key, int):
             irow = key // self.size[1]
             icol = key % self.size[1]
             return self._getblock(irow, icol, (1, 1))[0]
@@ -185,7 +685,16 @@ class CompressedBand(object):
 
     def __setitem__(self, key, value):
 
-        if isinstance(key, int):
+        if is_mask_key(key):
+            self._setmasked(key, value)
+
+        elif is_indices_key(key):
+            self._setindexed(key, value)
+
+        elif is_rows_key(key):
+            self._setindexed(self._rowindices(key), value)
+
+        elif isinstance(key, int):
             irow = key // self.size[1]
             icol = key % self.size[1]
             self._setblock(irow, icol, np.array(value, dtype=self.dtype))
@@ -264,15 +773,126 @@ class CompressedBand(object):
         return
 
 
+    @property
+    def nbytes(self):
+        """ Number of bytes of compressed data held by the band. """
+        return sum(len(d) for d, st in zip(self._data, self.chunkstatus)
+                   if st == self.CHUNKSET)
+
+    @property
+    def compression_ratio(self):
+        """ Ratio of the uncompressed size of compressed chunks to their
+        compressed size. Constant chunks are not counted. """
+        nset = np.count_nonzero(self.chunkstatus == self.CHUNKSET)
+        if nset == 0:
+            return np.nan
+        rawbytes = nset * self._chunksize[0] * self._chunksize[1] * \
+                   np.dtype(self.dtype).itemsize
+        return float(rawbytes) / self.nbytes
+
+    @property
+    def nodata(self):
+        """ Value excluded from chunk statistics (default None). Changing it
+        invalidates the statistics of all chunks. """
+        return self._nodata
+
+    @nodata.setter
+    def nodata(self, value):
+        if not (value is self._nodata or value == self._nodata or
+                (value != value and self._nodata != self._nodata)):
+            self._statsvalid[:] = False
+        self._nodata = value
+
+    def chunk_statistics(self):
+        """ Return a `STATS_DTYPE` array summarizing each chunk, in row-major
+        chunk order. Only chunks whose statistics are out of date are read.
+        """
+        for i in np.flatnonzero(~self._statsvalid):
+            yst = (i // self.nchunkcols) * self._chunksize[0]
+            xst = (i % self.nchunkcols) * self._chunksize[1]
+            ny = min(self._chunksize[0], self.size[0]-yst)
+            nx = min(self._chunksize[1], self.size[1]-xst)
+            if self.chunkstatus[i] == self.CHUNKSET:
+                array = self._retrieve(i)
+                self._stats[i] = summarize(array[:ny,:nx], self._nodata)
+            elif self.chunkstatus[i] == self.CHUNKCONST:
+                self._stats[i] = summarize_constant(self._data[i], ny*nx,
+                                                    self._nodata)
+            else:
+                zero = np.zeros((), dtype=self.dtype)[()]
+                self._stats[i] = summarize_constant(zero, ny*nx, self._nodata)
+            self._statsvalid[i] = True
+        return self._stats.copy()
+
     def _store(self, array, index):
-        self._data[index] = blosc.compress(array.tostring(),
-                                           np.dtype(self.dtype).itemsize)
+        self._data[index] = self._compress(array)
         self.chunkstatus[index] = self.CHUNKSET
+        self._statsvalid[index] = False
         return
 
+    def _encode(self, array, index):
+        """ Return a (status, data) pair representing the contents of *array*
+        as chunk *index*: either compressed bytes or a constant scalar. """
+        yst = (index // self.nchunkcols) * self._chunksize[0]
+        xst = (index % self.nchunkcols) * self._chunksize[1]
+        valid = array[:self.size[0]-yst, :self.size[1]-xst]
+        value = valid.flat[0]
+        if value != value:
+            isconst = np.isnan(valid).all()
+        else:
+            isconst = (valid == value).all()
+        if isconst:
+            return self.CHUNKCONST, value
+        return self.CHUNKSET, self._compress(array)
+
+    def _compress(self, array):
+        """ Return compressed bytes read directly from the buffer of
+        *array*. """
+        array = np.ascontiguousarray(array)
+        return blosc.compress_ptr(array_address(array), array.size,
+                                  np.dtype(self.dtype).itemsize,
+                                  clevel=self.clevel,
+                                  shuffle=SHUFFLE_MODES[self.shuffle],
+                                  cname=self.compressor)
+
     def _retrieve(self, index):
-        bytestr = blosc.decompress(self._data[index])
-        return np.fromstring(bytestr, dtype=self.dtype).reshape(self._chunksize)
+        """ Return the decompressed chunk *index*. The returned array may be
+        shared with the chunk cache and must not be modified. """
+        array = self.cache.get(index)
+        if array is None:
+            t0 = timeit.default_timer()
+            array = self._decompress(index)
+            self.decode_time += timeit.default_timer() - t0
+            self.cache.put(index, array)
+        return array
+
+    def _decompress(self, index, out=None):
+        """ Decompress chunk *index* directly into *out*, which must be a
+        C-contiguous array with the chunk dimensions and dtype. If *out* is
+        not provided, a new array is allocated. """
+        if out is None:
+            out = np.empty(self._chunksize, dtype=self.dtype)
+        elif (out.shape != self._chunksize) or (out.dtype != self.dtype) or \
+                not out.flags.c_contiguous:
+            raise ValueError("output must be a C-contiguous array with the "
+                             "chunk dimensions and band dtype")
+        blosc.decompress_ptr(self._data[index], array_address(out))
+        return out
+
+    def _readblock(self, yoff, xoff, size):
+        """ Return the values of the chunk with corner *yoff*, *xoff*, without
+        copying. The returned array must not be modified. """
+        i = (yoff // self._chunksize[0]) * self.nchunkcols + \
+            xoff // self._chunksize[1]
+        if self.chunkstatus[i] == self.CHUNKUNSET:
+            return np.zeros(size, dtype=self.dtype)
+        elif self.chunkstatus[i] == self.CHUNKCONST:
+            return np.full(size, self._data[i], dtype=self.dtype)
+        return self._retrieve(i)[:size[0], :size[1]]
+
+    def _writeblock(self, yoff, xoff, array):
+        self._setblock(yoff, xoff, array)
+        return
 
     def _getchunks(self, yoff, xoff, ny, nx):
         """ Return a generator returning tuples identifying chunks covered by a
@@ -304,20 +924,23 @@ class CompressedBand(object):
 
             i+= 1
 
+    def _map(self, func, items):
+        """ Apply *func* to each of *items*, using a thread pool when the band
+        is configured to use more than one thread. """
+        if self.threads > 1 and len(items) > 1:
+            return get_thread_pool(self.threads).map(func, items)
+        else:
+            return [func(item) for item in items]
+
     def _setblock(self, yoff, xoff, array):
         """ Store block of values in *array* starting at offset *yoff*, *xoff*.
         """
         size = array.shape
         chunksize = self._chunksize
 
+        tasks = []
         for i, yst, yen, xst, xen in self._getchunks(yoff, xoff, *size):
 
-            # Get from data store
-            if self.chunkstatus[i] != self.CHUNKUNSET:
-                chunkdata = self._retrieve(i)
-            else:
-                chunkdata = np.zeros(self._chunksize, dtype=self.dtype)
-
             # Compute region within chunk to place data in
             cy0 = max(0, yoff-yst)
             cy1 = min(chunksize[0], yoff+size[0]-yst)
@@ -330,17 +953,62 @@ class CompressedBand(object):
             dx0 = max(0, xst-xoff)
             dx1 = min(size[1], xen-xoff)
 
-            chunkdata[cy0:cy1, cx0:cx1] = array[dy0:dy1, dx0:dx1]
-
-            # Return to data store
-            self._store(chunkdata, i)
+            # Any cached copy is removed from the cache (invalidating it) and
+            # reused to avoid decompressing
+            tasks.append((i, self.cache.pop(i),
+                          (slice(cy0, cy1), slice(cx0, cx1)),
+                          (slice(dy0, dy1), slice(dx0, dx1))))
+
+        def update(task):
+            i, chunkdata, cslc, dslc = task
+            if chunkdata is None:
+                if (cslc[0].stop-cslc[0].start == chunksize[0]) and \
+                        (cslc[1].stop-cslc[1].start == chunksize[1]):
+                    chunkdata = np.empty(chunksize, dtype=self.dtype)
+                elif self.chunkstatus[i] == self.CHUNKSET:
+                    chunkdata = self._decompress(i)
+                elif self.chunkstatus[i] == self.CHUNKCONST:
+                    chunkdata = np.full(chunksize, self._data[i],
+                                        dtype=self.dtype)
+                else:
+                    chunkdata = np.zeros(chunksize, dtype=self.dtype)
+            chunkdata[cslc] = array[dslc]
+            t0 = timeit.default_timer()
+            status, data = self._encode(chunkdata, i)
+            dt = timeit.default_timer()-t0
+            ny = min(chunksize[0], self.size[0]-chunksize[0]*(i//ncols))
+            nx = min(chunksize[1], self.size[1]-chunksize[1]*(i%ncols))
+            if status == self.CHUNKCONST:
+                stats = summarize_constant(data, ny*nx, nodata)
+            else:
+                stats = summarize(chunkdata[:ny,:nx], nodata)
+            return i, status, data, stats, dt
+
+        # Band attributes are updated from the calling thread only
+        nodata = self._nodata
+        ncols = self.nchunkcols
+        for i, status, data, stats, dt in self._map(update, tasks):
+            self._data[i] = data
+            self.chunkstatus[i] = status
+            self._stats[i] = stats
+            self._statsvalid[i] = True
+            self.encode_time += dt
         return
 
     def _getblock(self, yoff, xoff, size):
         """ Retrieve values with dimensions *size*, starting at offset *yoff*,
         *xoff*.
+
+        Chunks covered completely by the request are decompressed directly
+        into the output when they map onto a C-contiguous region of it, and
+        otherwise into a reusable per-thread scratch buffer. They are not
+        added to the cache, which would require a new array for each chunk,
+        and which would evict the partially read chunks that row-wise access
+        relies on. Partially covered chunks go through the cache.
         """
+        chunksize = self._chunksize
         result = np.empty(size, self.dtype)
+        tasks = []
         for i, yst, yen, xst, xen in self._getchunks(yoff, xoff, *size):
 
             # Compute the bounds in the output
@@ -350,8 +1018,10 @@ class CompressedBand(object):
             ox1 = min(size[1], xen-xoff)
 
             if self.chunkstatus[i] == self.CHUNKUNSET:
-                result[oy0:oy1, ox0:ox1] = np.zeros((oy1-oy0, ox1-ox0),
-                                                    dtype=self.dtype)
+                result[oy0:oy1, ox0:ox1] = 0
+
+            elif self.chunkstatus[i] == self.CHUNKCONST:
+                result[oy0:oy1, ox0:ox1] = self._data[i]
 
             else:
                 # Compute the extents from the chunk to retain
@@ -360,7 +1030,43 @@ class CompressedBand(object):
                 cx0 = max(xoff, xst) - xst
                 cx1 = min(xoff+size[1], xen) - xst
 
-                result[oy0:oy1, ox0:ox1] = self._retrieve(i)[cy0:cy1, cx0:cx1]
-
+                oslc = (slice(oy0, oy1), slice(ox0, ox1))
+                cslc = (slice(cy0, cy1), slice(cx0, cx1))
+                covered = (cy1-cy0 == yen-yst) and (cx1-cx0 == xen-xst)
+                chunkdata = self.cache.get(i)
+                if chunkdata is not None:
+                    result[oslc] = chunkdata[cslc]
+                else:
+                    tasks.append((i, oslc, cslc, covered))
+
+        # Chunks that the cache will not hold bypass it like fully covered
+        # chunks do
+        cacheable = (self.cache.maxbytes >= np.dtype(self.dtype).itemsize *
+                                            chunksize[0] * chunksize[1])
+
+        def fetch(task):
+            t0 = timeit.default_timer()
+            i, oslc, cslc, covered = task
+            if cacheable and not covered:
+                chunkdata = self._decompress(i)
+                dt = timeit.default_timer() - t0
+                result[oslc] = chunkdata[cslc]
+            else:
+                region = result[oslc]
+                if region.shape == chunksize and region.flags.c_contiguous:
+                    self._decompress(i, out=region)
+                    dt = timeit.default_timer() - t0
+                else:
+                    scratch = scratch_array(chunksize, self.dtype)
+                    self._decompress(i, out=scratch)
+                    dt = timeit.default_timer() - t0
+                    result[oslc] = scratch[cslc]
+                chunkdata = None
+            return i, chunkdata, dt
+
+        # Cache and band attributes are updated from the calling thread only
+        for i, chunkdata, dt in self._map(fetch, tasks):
+            if chunkdata is not None:
+                self.cache.put(i, chunkdata)
+            self.decode_time += dt
         return result
-
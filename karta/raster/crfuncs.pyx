@@ -2,6 +2,7 @@ from math import ceil, sqrt
 import numpy as np
 cimport numpy as np
 cimport cython
+from libc.math cimport fabs, floor, sin, cos, sqrt, atan2, M_PI, INFINITY
 
 DTYPE_float64 = np.float64
 ctypedef np.float64_t DTYPE_float64_t
@@ -46,20 +47,488 @@ def fillarray_double(double[:,:] array not None,
                 array[i,j] = nodata_value
     return 0
 
-cdef float interpolate1(float x, float y, float a, float b, float c, float d):
-    """ Return a value *v(x,y)* in the regular structured stencil
+# Interpolation kernels. The radius of each kernel is the number of cells on
+# either side of a point contributing to its value.
+KERNEL_RADIUS = {"bilinear": 1, "cubic": 2, "lanczos": 3}
 
-            a --- b
-            |  v  |
-            c --- d
+# Kernel codes are equal to the kernel radius
+cdef enum Kernel:
+    BILINEAR = 1
+    CUBIC = 2
+    LANCZOS = 3
 
-    using linear interpolation. The coordinates (x, y) must be normalized by
-    the horizontal and vertical grid spacings, respectively.
+cdef inline double kernel_bilinear(double t) nogil:
+    t = fabs(t)
+    if t < 1.0:
+        return 1.0 - t
+    return 0.0
+
+cdef inline double kernel_cubic(double t) nogil:
+    # Keys cubic convolution kernel with a = -0.5
+    t = fabs(t)
+    if t < 1.0:
+        return (1.5*t - 2.5)*t*t + 1.0
+    elif t < 2.0:
+        return ((-0.5*t + 2.5)*t - 4.0)*t + 2.0
+    return 0.0
+
+cdef inline double kernel_lanczos(double t) nogil:
+    # Lanczos kernel with a = 3
+    cdef double pt
+    t = fabs(t)
+    if t < 1e-12:
+        return 1.0
+    elif t < 3.0:
+        pt = M_PI * t
+        return 3.0 * sin(pt) * sin(pt / 3.0) / (pt * pt)
+    return 0.0
+
+cdef inline double kernel_weight(int kernel, double t) nogil:
+    if kernel == BILINEAR:
+        return kernel_bilinear(t)
+    elif kernel == CUBIC:
+        return kernel_cubic(t)
+    return kernel_lanczos(t)
+
+cdef inline int clamp(int i, int n) nogil:
+    if i < 0:
+        return 0
+    elif i >= n:
+        return n-1
+    return i
+
+cdef inline bint isnodata(double v, double nodata_value, bint nodata_nan) nogil:
+    return (v != v) or ((not nodata_nan) and (v == nodata_value))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int interpolate_points(double[:,:,:] array, double[:] I, double[:] J,
+                            double[:,:] out, int kernel, int radius,
+                            double nodata_value) nogil:
+    # array is (bands, rows, columns) and out is (points, bands). Stencil
+    # indices and weights are computed once per point and shared by all bands.
+    cdef int nb = array.shape[0]
+    cdef int ny = array.shape[1]
+    cdef int nx = array.shape[2]
+    cdef int n = I.shape[0]
+    cdef int p, b, k, l, i0, j0, inear, jnear
+    cdef int ii[6]
+    cdef int jj[6]
+    cdef double wy[6]
+    cdef double wx[6]
+    cdef double w, v, total, wtotal
+    cdef bint nodata_nan = nodata_value != nodata_value
+
+    for p in range(n):
+        inear = clamp(<int> floor(I[p]+0.5), ny)
+        jnear = clamp(<int> floor(J[p]+0.5), nx)
+        i0 = <int> floor(I[p]) - radius + 1
+        j0 = <int> floor(J[p]) - radius + 1
+        for k in range(2*radius):
+            wy[k] = kernel_weight(kernel, I[p] - (i0+k))
+            wx[k] = kernel_weight(kernel, J[p] - (j0+k))
+            # cells beyond the edges replicate edge cells
+            ii[k] = clamp(i0+k, ny)
+            jj[k] = clamp(j0+k, nx)
+
+        for b in range(nb):
+            # a point takes the nodata value of its nearest cell
+            if isnodata(array[b, inear, jnear], nodata_value, nodata_nan):
+                out[p, b] = nodata_value
+                continue
+
+            # accumulate over valid cells and renormalize by their weight
+            total = 0.0
+            wtotal = 0.0
+            for k in range(2*radius):
+                if wy[k] == 0.0:
+                    continue
+                for l in range(2*radius):
+                    if wx[l] == 0.0:
+                        continue
+                    v = array[b, ii[k], jj[l]]
+                    if isnodata(v, nodata_value, nodata_nan):
+                        continue
+                    w = wy[k] * wx[l]
+                    total += w * v
+                    wtotal += w
+
+            if fabs(wtotal) < 1e-6:
+                out[p, b] = nodata_value
+            else:
+                out[p, b] = total / wtotal
+    return 0
+
+cdef int kernel_code(str method) except -1:
+    if method == "bilinear":
+        return BILINEAR
+    elif method == "cubic":
+        return CUBIC
+    elif method == "lanczos":
+        return LANCZOS
+    raise ValueError("method '{0}' not available".format(method))
+
+def interpolate(double[:,:] array not None,
+                double[:] I not None,
+                double[:] J not None,
+                double nodata_value,
+                str method="bilinear"):
+    """ Interpolate *array* at fractional row and column positions *I*, *J*
+    using a separable kernel. *method* is one of 'bilinear', 'cubic' (Keys
+    cubic convolution), or 'lanczos' (Lanczos-3).
+
+    Cells beyond the array edges take the value of the nearest edge cell.
+    Cells equal to *nodata_value* (or NaN) are excluded and the weights of the
+    remaining cells renormalized. Points whose nearest cell is nodata are
+    nodata.
+
+    Returns an array of interpolated values.
+    """
+    return interpolate_bands(np.asarray(array)[np.newaxis,:,:], I, J,
+                             nodata_value, method)[:,0]
+
+def interpolate_bands(double[:,:,:] array not None,
+                      double[:] I not None,
+                      double[:] J not None,
+                      double nodata_value,
+                      str method="bilinear"):
+    """ Interpolate a stack of bands *array* (bands x rows x columns) at
+    fractional row and column positions *I*, *J*, as in `interpolate`.
+
+    Returns an array of interpolated values with one row per point and one
+    column per band.
+    """
+    cdef int kernel = kernel_code(method)
+    cdef double[:,:] out
+
+    if len(I) != len(J):
+        raise ValueError("I and J must have the same length")
+    if array.shape[1] == 0 or array.shape[2] == 0:
+        raise ValueError("array must not be empty")
+
+    result = np.empty((len(I), array.shape[0]), dtype=DTYPE_float64)
+    out = result
+    with nogil:
+        interpolate_points(array, I, J, out, kernel, kernel, nodata_value)
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def bin_points(np.int64_t[:] cells not None,
+               double[:] Z not None,
+               np.int64_t[:] count not None,
+               double[:] total=None,
+               double[:] mean=None,
+               double[:] m2=None,
+               double[:] vmin=None,
+               double[:] vmax=None,
+               double[:] first=None,
+               double[:] last=None):
+    """ Accumulate the values *Z* of points falling in the flattened grid cells
+    *cells*. The accumulators are updated in place, so that points can be
+    binned in several batches:
+
+    - *count*: number of points
+    - *total*: sum of values
+    - *mean*, *m2*: running mean and sum of squared deviations (Welford's
+      method; *m2* requires *mean*)
+    - *vmin*, *vmax*: minimum and maximum value
+    - *first*, *last*: first and last value, in the order points are binned
+
+    Accumulators other than *count* may be None. NaN values are ignored.
+    *vmin*, *vmax*, and *first* are only meaningful where *count* is nonzero.
     """
-    cdef float left, right, res
+    cdef Py_ssize_t k, n = len(cells)
+    cdef Py_ssize_t ncells = len(count)
+    cdef np.int64_t c
+    cdef double z, delta
+    cdef bint do_total = total is not None
+    cdef bint do_mean = mean is not None
+    cdef bint do_m2 = m2 is not None
+    cdef bint do_min = vmin is not None
+    cdef bint do_max = vmax is not None
+    cdef bint do_first = first is not None
+    cdef bint do_last = last is not None
+
+    if len(Z) != n:
+        raise ValueError("cells and Z must have the same length")
+    if do_m2 and not do_mean:
+        raise ValueError("m2 requires mean")
+    if ((do_total and total.shape[0] != ncells) or
+            (do_mean and mean.shape[0] != ncells) or
+            (do_m2 and m2.shape[0] != ncells) or
+            (do_min and vmin.shape[0] != ncells) or
+            (do_max and vmax.shape[0] != ncells) or
+            (do_first and first.shape[0] != ncells) or
+            (do_last and last.shape[0] != ncells)):
+        raise ValueError("accumulators must have the same length as count")
+    for k in range(n):
+        if cells[k] < 0 or cells[k] >= ncells:
+            raise IndexError("cell index {0} out of range".format(cells[k]))
+
+    with nogil:
+        for k in range(n):
+            z = Z[k]
+            if z != z:
+                continue
+            c = cells[k]
+            count[c] += 1
+            if do_total:
+                total[c] += z
+            if do_mean:
+                delta = z - mean[c]
+                mean[c] += delta / count[c]
+                if do_m2:
+                    m2[c] += delta * (z - mean[c])
+            if count[c] == 1:
+                if do_min:
+                    vmin[c] = z
+                if do_max:
+                    vmax[c] = z
+                if do_first:
+                    first[c] = z
+            else:
+                if do_min and z < vmin[c]:
+                    vmin[c] = z
+                if do_max and z > vmax[c]:
+                    vmax[c] = z
+            if do_last:
+                last[c] = z
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def terrain(double[:,:] z not None, double dx, double dy,
+            double[:,:] slope=None,
+            double[:,:] aspect=None,
+            double[:,:] curvature=None,
+            double[:,:] dzdx=None,
+            double[:,:] dzdy=None,
+            double[:,:] hillshade=None,
+            double azimuth=330.0,
+            double elevation=60.0):
+    """ Compute terrain derivatives of the elevations *z* in a single pass.
+
+    *z* includes a one-cell halo on every side, and contains NaN where there
+    is no data. Each output has two fewer rows and columns than *z*, and is
+    skipped if None. Outputs are NaN where any of the 3x3 neighbourhood is NaN.
+    Derivatives use the Horn (Sobel) differences, with rows increasing in the
+    y direction:
+
+    - *slope*: magnitude of the gradient
+    - *aspect*: arctan2(dz/dy, -dz/dx)
+    - *curvature*: -(d2z/dx2 + d2z/dy2), positive on convex surfaces
+    - *dzdx*, *dzdy*: components of the gradient
+    - *hillshade*: cosine of the angle between the vectors
+      (-p*dy, -q*dx, dx*dy), the cross product of (dx, 0, p) and (0, dy, q)
+      where p and q are dz/dx and dz/dy, and (cos(azimuth), sin(azimuth),
+      sin(elevation)), with *azimuth* and *elevation* in degrees. Both vectors
+      are normalized, so values lie in [-1, 1].
+    """
+    cdef int ny = z.shape[0] - 2
+    cdef int nx = z.shape[1] - 2
+    cdef int i, j, a, b
+    cdef bint missing
+    cdef double p, q, zc, norm, nan = np.nan
+    cdef double sx = cos(azimuth*M_PI/180.0)
+    cdef double sy = sin(azimuth*M_PI/180.0)
+    cdef double sz = sin(elevation*M_PI/180.0)
+    cdef double slen = sqrt(sx*sx + sy*sy + sz*sz)
+    cdef bint do_slope = slope is not None
+    cdef bint do_aspect = aspect is not None
+    cdef bint do_curvature = curvature is not None
+    cdef bint do_dzdx = dzdx is not None
+    cdef bint do_dzdy = dzdy is not None
+    cdef bint do_hillshade = hillshade is not None
+
+    if ny < 1 or nx < 1:
+        raise ValueError("z must have at least three rows and columns")
+    if ((do_slope and (slope.shape[0] != ny or slope.shape[1] != nx)) or
+            (do_aspect and (aspect.shape[0] != ny or aspect.shape[1] != nx)) or
+            (do_curvature and (curvature.shape[0] != ny or
+                               curvature.shape[1] != nx)) or
+            (do_dzdx and (dzdx.shape[0] != ny or dzdx.shape[1] != nx)) or
+            (do_dzdy and (dzdy.shape[0] != ny or dzdy.shape[1] != nx)) or
+            (do_hillshade and (hillshade.shape[0] != ny or
+                               hillshade.shape[1] != nx))):
+        raise ValueError("outputs must be two cells smaller than z")
+
+    with nogil:
+        for i in range(1, ny+1):
+            for j in range(1, nx+1):
+                missing = False
+                for a in range(i-1, i+2):
+                    for b in range(j-1, j+2):
+                        if z[a,b] != z[a,b]:
+                            missing = True
+                if missing:
+                    p = nan
+                    q = nan
+                else:
+                    p = ((2*z[i,j+1] + z[i-1,j+1] + z[i+1,j+1]) -
+                         (2*z[i,j-1] + z[i-1,j-1] + z[i+1,j-1])) / (8.0*dx)
+                    q = ((2*z[i+1,j] + z[i+1,j+1] + z[i+1,j-1]) -
+                         (2*z[i-1,j] + z[i-1,j-1] + z[i-1,j+1])) / (8.0*dy)
+                if do_slope:
+                    slope[i-1,j-1] = sqrt(p*p + q*q)
+                if do_aspect:
+                    aspect[i-1,j-1] = atan2(q, -p)
+                if do_dzdx:
+                    dzdx[i-1,j-1] = p
+                if do_dzdy:
+                    dzdy[i-1,j-1] = q
+                if do_curvature:
+                    if missing:
+                        curvature[i-1,j-1] = nan
+                    else:
+                        zc = z[i,j]
+                        curvature[i-1,j-1] = -((z[i,j-1] + z[i,j+1] - 2*zc) / (dx*dx) +
+                                               (z[i-1,j] + z[i+1,j] - 2*zc) / (dy*dy))
+                if do_hillshade:
+                    # dot product of the light vector with the normalized
+                    # cross product (dx, 0, p) x (0, dy, q) = (-p*dy, -q*dx,
+                    # dx*dy), divided by the length of the light vector
+                    norm = sqrt(p*p*dy*dy + q*q*dx*dx + dx*dx*dy*dy) * slen
+                    hillshade[i-1,j-1] = (-p*dy*sx - q*dx*sy + dx*dy*sz) / norm
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void _mark(int i, int j, int stamp, int[:,:] seen, int[:,:] out) noexcept nogil:
+    if seen[i,j] != stamp:
+        seen[i,j] = stamp
+        out[i,j] += 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _sight_ray(double[:,:] z, int oi, int oj, int ti, int tj, double zo,
+                     double target_height, double dx, double dy, double radius,
+                     double curvature, int stamp, int[:,:] seen,
+                     int[:,:] out) noexcept nogil:
+    """ Walk the line of sight from (oi, oj) to (ti, tj) one row or column at
+    a time, marking the cells nearest the line that rise above the horizon. """
+    cdef int a = ti - oi
+    cdef int b = tj - oj
+    cdef int n = max(abs(a), abs(b))
+    cdef int s, ci, cj, lo
+    cdef double f, t, zc, zi, dcell, dpoint, di, dj
+    cdef double horizon = -INFINITY
+    cdef double reach = radius + sqrt(dx*dx + dy*dy)
+    cdef int ny = z.shape[0]
+    cdef int nx = z.shape[1]
+    for s in range(1, n+1):
+        if abs(a) >= abs(b):
+            di = a * s / <double> n
+            dj = b * s / <double> n
+            ci = oi + <int> di
+            f = oj + dj
+            lo = <int> floor(f)
+            t = f - lo
+            cj = lo + 1 if t > 0.5 else lo
+            if t == 0.0 or lo+1 >= nx:
+                zi = z[ci,lo]
+            else:
+                zi = z[ci,lo]*(1.0-t) + z[ci,lo+1]*t
+        else:
+            di = a * s / <double> n
+            dj = b * s / <double> n
+            cj = oj + <int> dj
+            f = oi + di
+            lo = <int> floor(f)
+            t = f - lo
+            ci = lo + 1 if t > 0.5 else lo
+            if t == 0.0 or lo+1 >= ny:
+                zi = z[lo,cj]
+            else:
+                zi = z[lo,cj]*(1.0-t) + z[lo+1,cj]*t
+
+        dpoint = sqrt(di*di*dy*dy + dj*dj*dx*dx)
+        if dpoint > reach:
+            break
+        dcell = sqrt((ci-oi)*(ci-oi)*dy*dy + (cj-oj)*(cj-oj)*dx*dx)
+        zc = z[ci,cj]
+        if zc == zc and dcell <= radius:
+            if (zc + target_height - curvature*dcell*dcell - zo) / dcell >= horizon:
+                _mark(ci, cj, stamp, seen, out)
+        if zi == zi:
+            zi = (zi - curvature*dpoint*dpoint - zo) / dpoint
+            if zi > horizon:
+                horizon = zi
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def viewshed_count(double[:,:] z not None,
+                   np.int64_t[:] rows not None,
+                   np.int64_t[:] cols not None,
+                   double observer_height,
+                   double target_height,
+                   double dx, double dy,
+                   double radius,
+                   double curvature,
+                   int[:,:] out not None):
+    """ Add one to *out* for every cell of *z* visible from each observer at
+    (*rows*[k], *cols*[k]).
+
+    Visibility is computed with the R2 sweep: a line of sight is traced from
+    the observer to every cell on the perimeter of the square of cells within
+    *radius*, keeping the steepest horizon met so far from terrain elevations
+    interpolated where the line crosses each row or column. A cell is visible
+    if it rises above the horizon on any line passing through it. NaN cells
+    neither block sight nor are visible. *curvature* is subtracted from
+    elevations times the squared distance from the observer to account for
+    the curvature of the Earth.
+    """
+    cdef int ny = z.shape[0]
+    cdef int nx = z.shape[1]
+    cdef int nobs = rows.shape[0]
+    cdef int k, oi, oj, i0, i1, j0, j1, ri, rj, ti, tj
+    cdef double zo
+    cdef int[:,:] seen
+
+    if cols.shape[0] != nobs:
+        raise ValueError("rows and cols must have equal length")
+    if out.shape[0] != ny or out.shape[1] != nx:
+        raise ValueError("out must have the same shape as z")
+    seen = np.zeros((ny, nx), dtype=np.int32)
+
+    if radius < INFINITY:
+        ri = <int> ceil(radius / dy)
+        rj = <int> ceil(radius / dx)
+    else:
+        ri = ny
+        rj = nx
 
-    left = (c-a)*y + a
-    right = (d-b)*y + b
-    res = (right - left) * x + left
-    return res
+    with nogil:
+        for k in range(nobs):
+            oi = rows[k]
+            oj = cols[k]
+            if oi < 0 or oi >= ny or oj < 0 or oj >= nx:
+                continue
+            zo = z[oi,oj]
+            if zo != zo:
+                continue
+            zo = zo + observer_height
+            _mark(oi, oj, k+1, seen, out)
 
+            i0 = max(oi-ri, 0)
+            i1 = min(oi+ri, ny-1)
+            j0 = max(oj-rj, 0)
+            j1 = min(oj+rj, nx-1)
+            for tj in range(j0, j1+1):
+                _sight_ray(z, oi, oj, i0, tj, zo, target_height, dx, dy,
+                           radius, curvature, k+1, seen, out)
+                _sight_ray(z, oi, oj, i1, tj, zo, target_height, dx, dy,
+                           radius, curvature, k+1, seen, out)
+            for ti in range(i0+1, i1):
+                _sight_ray(z, oi, oj, ti, j0, zo, target_height, dx, dy,
+                           radius, curvature, k+1, seen, out)
+                _sight_ray(z, oi, oj, ti, j1, zo, target_height, dx, dy,
+                           radius, curvature, k+1, seen, out)
+    return
@@ -0,0 +1,423 @@
+"""
+Lazily evaluated expressions of grid values
+
+Overview
+--------
+
+Arithmetic, comparisons, and numpy ufuncs applied to `RegularGrid` instances
+return a `GridExpression` rather than computing new values immediately. An
+expression is a tree of operations whose leaves are grids, arrays, and scalars.
+It is evaluated only when its values are requested, either over a window
+(``expr[i0:i1, j0:j1]``), at points (``expr.sample(x, y)``), where a boolean
+mask is True (``expr[mask]``), or for the whole grid (``expr.compute()``).
+Masks and whole grids are evaluated one chunk at a time so that intermediate
+results never occupy more than a chunk of memory.
+
+Cells that are nodata in any operand are nodata in the result.
+
+`where` selects lazily between two operands based on a condition.
+"""
+
+import numbers
+import numpy as np
+from .band import isnodata, is_mask_key, is_rows_key
+from .. import errors
+
+# Approximate number of cells evaluated at a time by GridExpression.compute
+EVAL_CHUNK_CELLS = 2**20
+
+def _binary_operator(ufunc):
+    def operator(self, other):
+        return GridOperation(ufunc, (self._as_expression(), other))
+    return operator
+
+def _reflected_operator(ufunc):
+    def operator(self, other):
+        return GridOperation(ufunc, (other, self._as_expression()))
+    return operator
+
+def _unary_operator(ufunc):
+    def operator(self):
+        return GridOperation(ufunc, (self._as_expression(),))
+    return operator
+
+class ExpressionOperatorsMixin(object):
+    """ Mixin implementing arithmetic, comparison, and ufunc operators by
+    building `GridExpression` instances.
+
+    The host class implements `_as_expression()`. Equality operators are not
+    overridden, so that `np.equal` and `np.not_equal` must be used to compare
+    grid values.
+    """
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != "__call__" or ufunc.nout != 1 or len(kwargs) != 0:
+            return NotImplemented
+        inputs = [x._as_expression() if isinstance(x, ExpressionOperatorsMixin)
+                  else x for x in inputs]
+        return GridOperation(ufunc, inputs)
+
+    __add__ = _binary_operator(np.add)
+    __radd__ = _reflected_operator(np.add)
+    __sub__ = _binary_operator(np.subtract)
+    __rsub__ = _reflected_operator(np.subtract)
+    __mul__ = _binary_operator(np.multiply)
+    __rmul__ = _reflected_operator(np.multiply)
+    __truediv__ = _binary_operator(np.true_divide)
+    __rtruediv__ = _reflected_operator(np.true_divide)
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+    __floordiv__ = _binary_operator(np.floor_divide)
+    __rfloordiv__ = _reflected_operator(np.floor_divide)
+    __mod__ = _binary_operator(np.remainder)
+    __rmod__ = _reflected_operator(np.remainder)
+    __pow__ = _binary_operator(np.power)
+    __rpow__ = _reflected_operator(np.power)
+    __and__ = _binary_operator(np.logical_and)
+    __rand__ = _reflected_operator(np.logical_and)
+    __or__ = _binary_operator(np.logical_or)
+    __ror__ = _reflected_operator(np.logical_or)
+    __lt__ = _binary_operator(np.less)
+    __le__ = _binary_operator(np.less_equal)
+    __gt__ = _binary_operator(np.greater)
+    __ge__ = _binary_operator(np.greater_equal)
+    __neg__ = _unary_operator(np.negative)
+    __abs__ = _unary_operator(np.absolute)
+    __invert__ = _unary_operator(np.logical_not)
+
+class GridExpression(ExpressionOperatorsMixin):
+    """ Base class for lazily evaluated expressions of grid values.
+
+    All grids in an expression must share the same transform and size. The
+    first grid of the expression determines the geometry, coordinate system,
+    and default nodata value of the result.
+    """
+
+    def _as_expression(self):
+        return self
+
+    def _grids(self):
+        """ Return the grids at the leaves of the expression. """
+        raise NotImplementedError()
+
+    def _evaluate(self, key):
+        """ Return values and a nodata mask (or None) for a window or set of
+        points. Values have a trailing band dimension. """
+        raise NotImplementedError()
+
+    def __bool__(self):
+        raise TypeError("the truth value of a GridExpression is ambiguous")
+
+    __nonzero__ = __bool__
+
+    @property
+    def grid(self):
+        """ Reference grid defining the geometry of the expression """
+        return self._grids()[0]
+
+    @property
+    def transform(self):
+        return self.grid.transform
+
+    @property
+    def size(self):
+        return self.grid.size
+
+    @property
+    def crs(self):
+        return self.grid.crs
+
+    @property
+    def nodata(self):
+        return self.grid.nodata
+
+    def _finalize(self, values, invalid, nodata=None):
+        """ Remove a singleton band dimension, convert boolean values to
+        uint8, and replace invalid values with nodata (default the nodata
+        value of the reference grid). Returns the values and nodata value. """
+        if values.dtype == np.bool_:
+            values = values.astype(np.uint8)
+        if nodata is None:
+            nodata = self.nodata
+        if not _representable(nodata, values.dtype):
+            nodata = _default_nodata(values.dtype)
+        if invalid is not None and invalid.any():
+            values = np.array(values, copy=True)
+            values[np.broadcast_to(invalid, values.shape)] = nodata
+        if values.shape[-1] == 1:
+            values = values[...,0]
+        return values, nodata
+
+    def __getitem__(self, key):
+        if is_mask_key(key):
+            return self._getmasked(key)
+        elif is_rows_key(key):
+            key = (key[...,np.newaxis], np.arange(self.size[1]))
+        elif not isinstance(key, tuple):
+            key = (key, slice(None))
+        # integer indices become length-one slices, removed afterward
+        squeeze = tuple(i for i, k in enumerate(key)
+                        if isinstance(k, numbers.Integral))
+        key = tuple(slice(k, k+1 if k != -1 else None)
+                    if isinstance(k, numbers.Integral) else k for k in key)
+        values, invalid = self._evaluate(key)
+        values, _ = self._finalize(values, invalid)
+        if len(squeeze) != 0:
+            values = values.squeeze(axis=squeeze)
+        return values
+
+    def _strip_size(self):
+        """ Return the size of windows spanning whole rows and containing
+        approximately EVAL_CHUNK_CELLS cells, in multiples of the block height
+        of the reference grid. """
+        nx = self.size[1]
+        by = getattr(self.grid.bands[0], "_blocksize", (256, 256))[0]
+        return (max(1, EVAL_CHUNK_CELLS // (by*nx)) * by, nx)
+
+    def _masked_windows(self, mask):
+        """ Yield the bounds (i0, i1, j0, j1) and local mask of each window
+        containing True cells in *mask*. Windows span whole rows, so that
+        selected cells are yielded in row-major order. """
+        if mask.shape != tuple(self.size):
+            raise IndexError("mask shape {0} does not match grid size "
+                             "{1}".format(mask.shape, self.size))
+        for (i0, i1, j0, j1), _ in self.grid._chunk_windows(self._strip_size(),
+                                                            (0, 0)):
+            m = mask[i0:i1, j0:j1]
+            if m.any():
+                yield i0, i1, j0, j1, m
+
+    def _getmasked(self, mask):
+        """ Return the values where *mask* is True, evaluating one window at a
+        time. """
+        parts = []
+        for i0, i1, j0, j1, m in self._masked_windows(mask):
+            values, invalid = self._evaluate((slice(i0, i1), slice(j0, j1)))
+            values, _ = self._finalize(values, invalid)
+            parts.append(values[m])
+        if len(parts) == 0:
+            # evaluate a single cell for the dtype and number of bands
+            values, _ = self._finalize(*self._evaluate((slice(0, 1),
+                                                        slice(0, 1))))
+            return values[np.zeros((1, 1), dtype=np.bool_)]
+        return np.concatenate(parts)
+
+    def sample(self, x, y):
+        """ Evaluate the expression at the cells nearest to coordinates.
+
+        Parameters
+        ----------
+        x, y : float or vector
+            vertices of points to sample
+
+        Raises
+        ------
+        GridError
+            points outside of Grid bbox
+        """
+        i, j = self.grid.get_indices(x, y)
+        values, invalid = self._evaluate((np.atleast_1d(i), np.atleast_1d(j)))
+        values, _ = self._finalize(values, invalid)
+        return values
+
+    def compute(self, out=None, size=None):
+        """ Evaluate the expression chunk by chunk and return the result as a
+        grid.
+
+        Parameters
+        ----------
+        out : RegularGrid, optional
+            grid to which results are written, which must have the same
+            geometry and number of bands as the result. If not provided, a
+            new grid is created with the band class of the reference grid.
+        size : tuple of two integers, optional
+            number of (rows, columns) evaluated at a time (default a multiple
+            of the chunk size of the reference grid containing approximately
+            EVAL_CHUNK_CELLS cells)
+
+        Returns
+        -------
+        RegularGrid
+        """
+        grid = self.grid
+        if out is not None and not grid._equivalent_structure(out):
+            raise errors.NonEquivalentGridError(grid, out)
+        if size is None:
+            blocksize = getattr(grid.bands[0], "_blocksize", (256, 256))
+            k = max(1, int(np.sqrt(EVAL_CHUNK_CELLS /
+                                   float(blocksize[0]*blocksize[1]))))
+            size = (k*blocksize[0], k*blocksize[1])
+
+        bands = None if out is None else out.bands
+        nodata = None if out is None else out.nodata
+        for (i0, i1, j0, j1), _ in grid._chunk_windows(size, (0, 0)):
+            values, invalid = self._evaluate((slice(i0, i1), slice(j0, j1)))
+            values, nodata = self._finalize(values, invalid, nodata)
+            if values.ndim == 2:
+                values = values[:,:,np.newaxis]
+            if bands is None:
+                bandclass, bandkwargs = grid._output_bandclass()
+                bands = [bandclass(grid.size, values.dtype.type, **bandkwargs)
+                         for _ in range(values.shape[2])]
+            elif len(bands) != values.shape[2]:
+                raise ValueError("expression has {0} bands, but output grid "
+                                 "has {1}".format(values.shape[2], len(bands)))
+            for ibnd, band in enumerate(bands):
+                band[i0:i1, j0:j1] = values[:,:,ibnd]
+
+        if out is not None:
+            return out
+        return type(grid)(grid.transform, bands=bands, crs=grid.crs,
+                          nodata_value=nodata, bandkwargs=grid._bndkwargs)
+
+class GridTerm(GridExpression):
+    """ Expression leaf representing the values of a grid.
+
+    Parameters
+    ----------
+    grid : RegularGrid
+    bands : int or list of int, optional
+        indices of the bands to use (default all)
+    """
+
+    def __init__(self, grid, bands=None):
+        self._grid = grid
+        if bands is None:
+            self.bands = list(range(len(grid.bands)))
+        elif isinstance(bands, numbers.Integral):
+            self.bands = [bands]
+        else:
+            self.bands = list(bands)
+
+    def _grids(self):
+        return [self._grid]
+
+    def _evaluate(self, key):
+        values = np.stack([self._read(self._grid.bands[i], key)
+                           for i in self.bands], axis=-1)
+        return values, isnodata(values, self._grid.nodata)
+
+    @staticmethod
+    def _read(band, key):
+        values = np.asarray(band[key])
+        if isinstance(key[0], slice) and values.ndim != 2:
+            # some bands return scalars for single-cell windows
+            values = values.reshape(len(range(*key[0].indices(band.size[0]))),
+                                    len(range(*key[1].indices(band.size[1]))))
+        return values
+
+class GridOperation(GridExpression):
+    """ Expression node applying a function elementwise to its operands.
+
+    Parameters
+    ----------
+    func : callable
+        function (usually a numpy ufunc) applied to operand values
+    operands : sequence
+        GridExpression instances, scalars, or arrays of the grid size
+    """
+
+    def __init__(self, func, operands):
+        self.func = func
+        self.operands = [_operand(a) for a in operands]
+        grids = self._grids()
+        if len(grids) == 0:
+            raise ValueError("expression must contain at least one grid")
+        for other in grids[1:]:
+            if not grids[0]._equivalent_structure(other):
+                raise errors.NonEquivalentGridError(grids[0], other)
+        for a in self.operands:
+            if isinstance(a, np.ndarray) and a.ndim != 0 and \
+                    tuple(a.shape[:2]) != tuple(grids[0].size):
+                raise ValueError("array operand of shape {0} does not match "
+                                 "grid size {1}".format(a.shape,
+                                                        grids[0].size))
+
+    def _grids(self):
+        grids = []
+        for a in self.operands:
+            if isinstance(a, GridExpression):
+                grids.extend(a._grids())
+        return grids
+
+    def _evaluate(self, key):
+        evaluated = [_evaluate_operand(a, key) for a in self.operands]
+        with np.errstate(all="ignore"):
+            result = self.func(*[v for v, _ in evaluated])
+        return result, _combine_masks([m for _, m in evaluated])
+
+class GridSelection(GridOperation):
+    """ Expression node choosing values from *x* where *condition* is true
+    and from *y* elsewhere. Nodata cells in the condition or in the selected
+    operand are nodata in the result. """
+
+    def __init__(self, condition, x, y):
+        super(GridSelection, self).__init__(np.where, (condition, x, y))
+
+    def _evaluate(self, key):
+        evaluated = [_evaluate_operand(a, key) for a in self.operands]
+        (condition, cmask), (x, xmask), (y, ymask) = evaluated
+        condition = np.asarray(condition, dtype=np.bool_)
+        invalid = cmask
+        if xmask is not None or ymask is not None:
+            selected = np.where(condition,
+                                False if xmask is None else xmask,
+                                False if ymask is None else ymask)
+            invalid = _combine_masks([invalid, selected])
+        return np.where(condition, x, y), invalid
+
+def where(condition, x, y):
+    """ Return a `GridExpression` selecting *x* where *condition* is true and
+    *y* elsewhere, analogous to `numpy.where`.
+
+    Parameters
+    ----------
+    condition, x, y : RegularGrid, GridExpression, array, or scalar
+        at least one argument must be a grid or grid expression
+    """
+    return GridSelection(condition, x, y)
+
+def _operand(a):
+    if isinstance(a, ExpressionOperatorsMixin):
+        return a._as_expression()
+    elif isinstance(a, np.ndarray):
+        return a
+    elif isinstance(a, (numbers.Number, np.generic)):
+        return a
+    else:
+        raise TypeError("unsupported operand type '{0}'".format(type(a)))
+
+def _evaluate_operand(a, key):
+    """ Return the values and nodata mask (or None) of an operand. """
+    if isinstance(a, GridExpression):
+        return a._evaluate(key)
+    elif isinstance(a, np.ndarray) and a.ndim != 0:
+        values = a[key]
+        if a.ndim == 2:
+            values = values[...,np.newaxis]
+        return values, None
+    return a, None
+
+def _combine_masks(masks):
+    """ Return the union of nodata masks, ignoring None. """
+    invalid = None
+    for m in masks:
+        if m is not None:
+            invalid = m if invalid is None else invalid | m
+    return invalid
+
+def _representable(nodata, dtype):
+    """ Return whether *nodata* can be stored exactly in *dtype*. """
+    if nodata is None:
+        return False
+    elif nodata != nodata:
+        return dtype.kind in "fc"
+    with np.errstate(all="ignore"):
+        return np.array(nodata).astype(dtype) == nodata
+
+def _default_nodata(dtype):
+    if dtype.kind == "u":
+        return np.iinfo(dtype).max
+    elif dtype.kind == "i":
+        return np.iinfo(dtype).min
+    return np.nan
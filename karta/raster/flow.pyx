@@ -0,0 +1,303 @@
+""" Hydrological routing on elevation grids.
+
+Flow directions are stored as int8 codes 0-7 indexing the neighbour offsets
+(DI[k], DJ[k]), counterclockwise from +j (east) with +i pointing north.
+OUTLET (-1) marks cells that drain off the grid or into nodata, and NODATA
+(-2) marks cells without elevation (NaN).
+"""
+
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.math cimport sqrt
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memmove
+
+cdef enum:
+    OUTLET = -1
+    NODATA = -2
+    UNVISITED = -3
+
+cdef int DI[8]
+cdef int DJ[8]
+DI[:] = [0, 1, 1, 1, 0, -1, -1, -1]
+DJ[:] = [1, 1, 0, -1, -1, -1, 0, 1]
+
+cdef struct Heap:
+    double *key
+    Py_ssize_t *idx
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+cdef struct Queue:
+    Py_ssize_t *idx
+    Py_ssize_t head
+    Py_ssize_t tail
+    Py_ssize_t capacity
+
+cdef int heap_push(Heap *h, double key, Py_ssize_t idx) nogil:
+    cdef Py_ssize_t k, parent
+    cdef void *p
+    if h.size == h.capacity:
+        h.capacity = 2*h.capacity
+        p = realloc(h.key, h.capacity*sizeof(double))
+        if p == NULL:
+            return -1
+        h.key = <double*> p
+        p = realloc(h.idx, h.capacity*sizeof(Py_ssize_t))
+        if p == NULL:
+            return -1
+        h.idx = <Py_ssize_t*> p
+    k = h.size
+    h.size += 1
+    while k > 0:
+        parent = (k-1) // 2
+        if h.key[parent] <= key:
+            break
+        h.key[k] = h.key[parent]
+        h.idx[k] = h.idx[parent]
+        k = parent
+    h.key[k] = key
+    h.idx[k] = idx
+    return 0
+
+cdef Py_ssize_t heap_pop(Heap *h) nogil:
+    cdef Py_ssize_t top = h.idx[0]
+    cdef Py_ssize_t k = 0, child
+    cdef double key
+    cdef Py_ssize_t idx
+    h.size -= 1
+    key = h.key[h.size]
+    idx = h.idx[h.size]
+    while True:
+        child = 2*k + 1
+        if child >= h.size:
+            break
+        if child+1 < h.size and h.key[child+1] < h.key[child]:
+            child += 1
+        if key <= h.key[child]:
+            break
+        h.key[k] = h.key[child]
+        h.idx[k] = h.idx[child]
+        k = child
+    h.key[k] = key
+    h.idx[k] = idx
+    return top
+
+cdef int queue_push(Queue *q, Py_ssize_t idx) nogil:
+    cdef void *p
+    if q.tail == q.capacity:
+        if q.head > 0:
+            memmove(q.idx, q.idx + q.head, (q.tail-q.head)*sizeof(Py_ssize_t))
+            q.tail -= q.head
+            q.head = 0
+        else:
+            q.capacity = 2*q.capacity
+            p = realloc(q.idx, q.capacity*sizeof(Py_ssize_t))
+            if p == NULL:
+                return -1
+            q.idx = <Py_ssize_t*> p
+    q.idx[q.tail] = idx
+    q.tail += 1
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def priority_flood(double[:,::1] z not None, np.int8_t[:,::1] direction not None):
+    """ Fill the depressions of *z* in place with the priority-flood algorithm
+    (Barnes et al., 2014).
+
+    Cells on the grid edge or next to NaN cells seed a priority queue ordered
+    by elevation. The lowest cell is repeatedly removed and its unvisited
+    neighbours are raised to at least its elevation; raised cells are
+    processed from a plain FIFO queue, so that only cells above their
+    neighbours pay the O(log n) cost of the priority queue. *direction*
+    receives the code of the neighbour from which each cell was reached,
+    which drains every cell, including those in filled flats, to an outlet.
+    """
+    cdef Py_ssize_t ny = z.shape[0]
+    cdef Py_ssize_t nx = z.shape[1]
+    cdef Py_ssize_t i, j, ni, nj, c, n
+    cdef int k
+    cdef bint seed
+    cdef double zc
+    cdef Heap heap
+    cdef Queue pit
+    cdef int err = 0
+
+    if direction.shape[0] != ny or direction.shape[1] != nx:
+        raise ValueError("direction must have the same shape as z")
+
+    heap.capacity = max(1024, 2*(ny+nx))
+    heap.size = 0
+    heap.key = <double*> malloc(heap.capacity*sizeof(double))
+    heap.idx = <Py_ssize_t*> malloc(heap.capacity*sizeof(Py_ssize_t))
+    pit.capacity = 1024
+    pit.head = 0
+    pit.tail = 0
+    pit.idx = <Py_ssize_t*> malloc(pit.capacity*sizeof(Py_ssize_t))
+    if heap.key == NULL or heap.idx == NULL or pit.idx == NULL:
+        free(heap.key)
+        free(heap.idx)
+        free(pit.idx)
+        raise MemoryError()
+
+    try:
+        with nogil:
+            for i in range(ny):
+                for j in range(nx):
+                    if z[i,j] != z[i,j]:
+                        direction[i,j] = NODATA
+                    else:
+                        direction[i,j] = UNVISITED
+
+            for i in range(ny):
+                for j in range(nx):
+                    if direction[i,j] != UNVISITED:
+                        continue
+                    seed = (i == 0 or j == 0 or i == ny-1 or j == nx-1)
+                    k = 0
+                    while not seed and k < 8:
+                        seed = direction[i+DI[k],j+DJ[k]] == NODATA
+                        k += 1
+                    if seed:
+                        direction[i,j] = OUTLET
+                        err = err | heap_push(&heap, z[i,j], i*nx+j)
+
+            while err == 0 and (heap.size != 0 or pit.head != pit.tail):
+                if pit.head != pit.tail:
+                    c = pit.idx[pit.head]
+                    pit.head += 1
+                    if pit.head == pit.tail:
+                        pit.head = 0
+                        pit.tail = 0
+                else:
+                    c = heap_pop(&heap)
+                i = c // nx
+                j = c % nx
+                zc = z[i,j]
+                for k in range(8):
+                    ni = i + DI[k]
+                    nj = j + DJ[k]
+                    if ni < 0 or nj < 0 or ni >= ny or nj >= nx:
+                        continue
+                    if direction[ni,nj] != UNVISITED:
+                        continue
+                    direction[ni,nj] = (k+4) % 8
+                    n = ni*nx + nj
+                    if z[ni,nj] <= zc:
+                        z[ni,nj] = zc
+                        err = err | queue_push(&pit, n)
+                    else:
+                        err = err | heap_push(&heap, z[ni,nj], n)
+    finally:
+        free(heap.key)
+        free(heap.idx)
+        free(pit.idx)
+    if err != 0:
+        raise MemoryError()
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def steepest_descent(double[:,::1] z not None, double dx, double dy,
+                     np.int8_t[:,::1] direction not None):
+    """ Point each cell of *direction* toward its steepest strictly-lower
+    neighbour in *z* (D8). Cells without a lower neighbour, such as those in
+    flats, keep their existing direction. """
+    cdef Py_ssize_t ny = z.shape[0]
+    cdef Py_ssize_t nx = z.shape[1]
+    cdef Py_ssize_t i, j, ni, nj
+    cdef int k, best
+    cdef double drop, steepest
+    cdef double dist[8]
+
+    if direction.shape[0] != ny or direction.shape[1] != nx:
+        raise ValueError("direction must have the same shape as z")
+    for k in range(8):
+        dist[k] = sqrt((DI[k]*dy)**2 + (DJ[k]*dx)**2)
+
+    with nogil:
+        for i in range(ny):
+            for j in range(nx):
+                if direction[i,j] == NODATA:
+                    continue
+                best = -1
+                steepest = 0.0
+                for k in range(8):
+                    ni = i + DI[k]
+                    nj = j + DJ[k]
+                    if ni < 0 or nj < 0 or ni >= ny or nj >= nx:
+                        continue
+                    drop = (z[i,j] - z[ni,nj]) / dist[k]
+                    if drop > steepest:
+                        steepest = drop
+                        best = k
+                if best != -1:
+                    direction[i,j] = best
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate(np.int8_t[:,::1] direction not None,
+               np.uint32_t[:,::1] out not None):
+    """ Count the cells draining through each cell of *direction*, including
+    the cell itself, into *out*.
+
+    Each cell is visited once in topological order without a queue: walks
+    start at cells with no inflow and follow the flow path downstream, passing
+    on their counts and stopping at the first cell that still has undrained
+    inflows. Directions must not contain cycles.
+    """
+    cdef Py_ssize_t ny = direction.shape[0]
+    cdef Py_ssize_t nx = direction.shape[1]
+    cdef Py_ssize_t i, j, ci, cj, ni, nj
+    cdef int d
+    cdef np.uint8_t[:,::1] inflow
+    cdef np.uint8_t DONE = 255
+
+    if out.shape[0] != ny or out.shape[1] != nx:
+        raise ValueError("out must have the same shape as direction")
+    inflow = np.zeros((ny, nx), dtype=np.uint8)
+
+    with nogil:
+        for i in range(ny):
+            for j in range(nx):
+                d = direction[i,j]
+                if d == NODATA:
+                    out[i,j] = 0
+                    inflow[i,j] = DONE
+                    continue
+                out[i,j] = 1
+                if d >= 0:
+                    ni = i + DI[d]
+                    nj = j + DJ[d]
+                    if 0 <= ni < ny and 0 <= nj < nx:
+                        inflow[ni,nj] += 1
+
+        for i in range(ny):
+            for j in range(nx):
+                if inflow[i,j] != 0:
+                    continue
+                ci = i
+                cj = j
+                while True:
+                    inflow[ci,cj] = DONE
+                    d = direction[ci,cj]
+                    if d < 0:
+                        break
+                    ni = ci + DI[d]
+                    nj = cj + DJ[d]
+                    if ni < 0 or nj < 0 or ni >= ny or nj >= nx:
+                        break
+                    if inflow[ni,nj] == DONE:
+                        break
+                    out[ni,nj] += out[ci,cj]
+                    inflow[ni,nj] -= 1
+                    if inflow[ni,nj] != 0:
+                        break
+                    ci = ni
+                    cj = nj
+    return
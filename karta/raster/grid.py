@@ -2,15 +2,23 @@
 Raster grid representations
 """
 import copy
+import itertools
 import math
+import multiprocessing
 import numbers
 import warnings
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from . import _gtiff
 from . import crfuncs
-from .band import SimpleBand, CompressedBand, BandIndexer
+from . import scanline
+from . import flow
+from .band import SimpleBand, CompressedBand, BandIndexer, is_mask_key
+from .band import STATS_DTYPE, isnodata, summarize
+from .expression import ExpressionOperatorsMixin, GridExpression, GridTerm
 from .. import errors
-from ..crs import Cartesian
+from ..crs import Cartesian, GeographicalCRS
+from ..vector.geometry import Multipoint, Polygon
 
 try:
     from scipy import interpolate
@@ -19,6 +27,45 @@ except ImportError:
     HASSCIPY = False
 
 BAND_CLASS_DEFAULT = CompressedBand
+
+# Approximate number of cells read at a time by streaming reductions over
+# bands that do not maintain chunk statistics
+REDUCTION_CELLS = 2**20
+
+# Statistics computed by PointBinner (in addition to "median" and "p<q>"
+# percentiles), and the number of points binned at a time by gridpoints
+BIN_STATS = ("count", "sum", "mean", "std", "min", "max", "first", "last")
+BIN_BATCH_POINTS = 2**20
+
+# Statistics computed by RegularGrid.zonal_stats
+ZONAL_STATS = ("count", "sum", "mean", "min", "max", "std")
+
+# Methods for combining overlapping grids in merge
+MERGE_METHODS = ("mean", "first", "last", "min", "max")
+
+# Methods supported by RegularGrid.resample, and the maximum number of cells
+# in each direction read at a time when resampling
+RESAMPLE_METHODS = ("nearest", "bilinear", "cubic", "lanczos", "average",
+                    "mode", "min", "max")
+RESAMPLE_TILE = 1024
+
+# Resampling methods for building overviews with RegularGrid.build_overviews
+OVERVIEW_METHODS = ("average", "nearest", "mode")
+
+# Approximate number of cells in each chunk processed by
+# RegularGrid.map_chunks, when a chunk size is not given
+MAP_CHUNK_CELLS = 2**20
+
+# Statistics supported by RegularGrid.focal
+FOCAL_STATS = ("mean", "min", "max", "std", "median")
+
+# Row and column offsets of the neighbours indicated by flow direction codes
+# 0-7 (counterclockwise from east), and the codes for cells that drain off
+# the grid and cells without data
+FLOW_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0),
+                (-1, 1))
+FLOW_OUTLET = -1
+FLOW_NODATA = -2
 CRS_DEFAULT = Cartesian
 
 class Grid(object):
@@ -68,7 +115,7 @@ class Grid(object):
         return copy.deepcopy(self)
 
 
-class RegularGrid(Grid):
+class RegularGrid(Grid, ExpressionOperatorsMixin):
     """ Regular (structured) grid class. A RegularGrid contains a fixed number
     of rows and columns with a constant spacing and a list of bands
     representing scalar fields.
@@ -86,9 +133,13 @@ class RegularGrid(Grid):
     be used to define a rotation. In the common case of a "north-up" grid,
 
     e = f = 0
+
+    Arithmetic operators, comparisons, and numpy ufuncs applied to a
+    RegularGrid return a lazily evaluated `GridExpression` (see
+    `karta.raster.expression`).
     """
     def __init__(self, transform, values=None, bands=None, crs=None,
-            nodata_value=None, bandclass=None):
+            nodata_value=None, bandclass=None, bandkwargs=None):
         """ Create a RegularGrid instance.
 
         Parameters
@@ -114,6 +165,9 @@ class RegularGrid(Grid):
         bandclass : class, optional
             indicates the band class used to represent grid data. default
             BAND_CLASS_DEFAULT
+        bandkwargs : dict, optional
+            keyword arguments passed to *bandclass* when creating bands, e.g.
+            to choose the compressor or chunk size of a CompressedBand
         """
 
         if hasattr(transform, "keys"):
@@ -135,19 +189,40 @@ class RegularGrid(Grid):
         else:
             self._bndcls = bandclass
 
+        if bandkwargs is None:
+            self._bndkwargs = {}
+        else:
+            self._bndkwargs = bandkwargs
+
+        if nodata_value is not None:
+            self._nodata = nodata_value
+        elif bands is not None and len(bands) != 0:
+            self._nodata = get_nodata(bands[0].dtype)
+        elif values is not None:
+            self._nodata = get_nodata(values.dtype.type)
+        else:
+            self._nodata = np.nan
+
         if bands is not None:
             self.bands = bands
+            self._sync_band_nodata()
         else:
             self.bands = []
 
+        # bands learn the nodata value before they are written, so that
+        # chunk statistics recorded while loading remain valid
         if bands is None and (values is not None):
             if values.ndim == 2:
-                band = self._bndcls(values.shape, values.dtype.type)
+                band = self._bndcls(values.shape, values.dtype.type,
+                                    **self._bndkwargs)
+                self._sync_band_nodata([band])
                 band[:,:] = values
                 self.bands.append(band)
             elif values.ndim == 3:
                 for ibnd in range(values.shape[2]):
-                    band = self._bndcls(values.shape[:2], values.dtype.type)
+                    band = self._bndcls(values.shape[:2], values.dtype.type,
+                                        **self._bndkwargs)
+                    self._sync_band_nodata([band])
                     band[:,:] = values[:,:,ibnd]
                     self.bands.append(band)
             else:
@@ -159,39 +234,77 @@ class RegularGrid(Grid):
             self.crs = CRS_DEFAULT
         else:
             self.crs = crs
-
-        if nodata_value is None:
-            if len(self.bands) == 0:
-                self._nodata = np.nan
-            else:
-                self._nodata = get_nodata(self.bands[0].dtype)
-        else:
-            self._nodata = nodata_value
+        self._overviews = []
+        self._overview_method = None
         return
 
-    def __add__(self, other):
-        if self._equivalent_structure(other):
-            return RegularGrid(copy.copy(self.transform),
-                               values=self[:,:]+other[:,:],
-                               crs=self.crs, nodata_value=self.nodata)
-        else:
-            raise errors.NonEquivalentGridError(self, other)
-
-    def __sub__(self, other):
-        if self._equivalent_structure(other):
-            return RegularGrid(copy.copy(self.transform),
-                               values=self[:,:]-other[:,:],
-                               crs=self.crs, nodata_value=self.nodata)
-        else:
-            raise errors.NonEquivalentGridError(self, other)
+    def _sync_band_nodata(self, bands=None):
+        """ Tell bands that keep chunk statistics which value is nodata. """
+        for band in (self.bands if bands is None else bands):
+            if hasattr(band, "chunk_statistics"):
+                band.nodata = self._nodata
+        return
 
     def __getitem__(self, key):
         return self._bandindexer[key]
 
     def __setitem__(self, key, value):
+        self._invalidate_overviews()
+        if isinstance(value, GridExpression):
+            if isinstance(key, tuple) and len(key) == 2 and \
+                    all(isinstance(k, slice) and k == slice(None) for k in key):
+                value.compute(out=self)
+                return
+            elif is_mask_key(key):
+                # write the selected cells of each window as it is evaluated
+                for i0, i1, j0, j1, m in value._masked_windows(key):
+                    values, invalid = value._evaluate((slice(i0, i1),
+                                                       slice(j0, j1)))
+                    values, _ = value._finalize(values, invalid, self.nodata)
+                    I, J = np.nonzero(m)
+                    if values.ndim == 3:
+                        values = [values[:,:,k][m]
+                                  for k in range(values.shape[2])]
+                    else:
+                        values = values[m]
+                    self._bandindexer[I+i0, J+j0] = values
+                return
+            else:
+                # slices and index arrays are evaluated at the selected
+                # cells only
+                value = value[key]
+                if len(self.bands) > 1:
+                    value = [value[...,k] for k in range(len(self.bands))]
         self._bandindexer[key] = value
         return
 
+    def _invalidate_overviews(self):
+        """ Discard cached overviews. Called by every method that writes to
+        the bands of this grid. """
+        self._overviews = []
+        return
+
+    def _as_expression(self):
+        return GridTerm(self)
+
+    def as_expression(self, bands=None):
+        """ Return a `GridExpression` representing grid values, optionally
+        restricted to a subset of bands.
+
+        Parameters
+        ----------
+        bands : int or list of int, optional
+            indices of bands to include (default all)
+        """
+        return GridTerm(self, bands=bands)
+
+    def _output_bandclass(self):
+        """ Return the band class and keyword arguments used to create bands
+        for new grids derived from this one. """
+        if hasattr(self._bndcls, "__setitem__"):
+            return self._bndcls, self._bndkwargs
+        return BAND_CLASS_DEFAULT, {}
+
     def _equivalent_structure(self, other):
         return (self._transform == other._transform) and \
                (self.size == other.size)
@@ -215,8 +328,10 @@ class RegularGrid(Grid):
         ----------
         val : number
         """
-        self[:,:] = np.where(self.data_mask, self[:,:], val)
+        values = np.where(self.data_mask, self[:,:], val)
         self._nodata = val
+        self._sync_band_nodata()
+        self[:,:] = values
         return
 
     def center_llref(self):
@@ -421,6 +536,128 @@ class RegularGrid(Grid):
                 return a != self.nodata
         return isdata(self[:,:])
 
+    def _iterstrips(self, band):
+        """ Yield strips of rows from *band*, each containing approximately
+        REDUCTION_CELLS cells. """
+        ny, nx = band.size
+        nrows = max(1, REDUCTION_CELLS // max(nx, 1))
+        for i in range(0, ny, nrows):
+            yield band[i:i+nrows, :]
+
+    def _statistics(self):
+        """ Return a `STATS_DTYPE` array summarizing the valid data of all
+        bands. Bands that maintain chunk statistics contribute one record per
+        chunk without reading data. Other bands are read in strips. """
+        records = []
+        self._sync_band_nodata()
+        for band in self.bands:
+            if hasattr(band, "chunk_statistics"):
+                records.append(band.chunk_statistics())
+            else:
+                records.append(np.array([summarize(strip, self.nodata)
+                                         for strip in self._iterstrips(band)],
+                                        dtype=STATS_DTYPE))
+        if len(records) == 0:
+            return np.zeros(0, dtype=STATS_DTYPE)
+        return np.concatenate(records)
+
+    def _reduce(self, stats, field, func):
+        """ Reduce *field* of the non-empty records of *stats* with *func*,
+        returning NaN if there are no valid data. """
+        values = stats[field][stats["count"] != 0]
+        if len(values) == 0:
+            return np.nan
+        return np.dtype(self.bands[0].dtype).type(func(values))
+
+    def max(self):
+        """ Return the maximum valid value in all bands. """
+        return self._reduce(self._statistics(), "max", np.max)
+
+    def min(self):
+        """ Return the minimum valid value in all bands. """
+        return self._reduce(self._statistics(), "min", np.min)
+
+    def minmax(self):
+        """ Return the minimum and maximum valid value in all bands. """
+        stats = self._statistics()
+        return (self._reduce(stats, "min", np.min),
+                self._reduce(stats, "max", np.max))
+
+    def mean(self):
+        """ Return the mean of valid values in all bands. """
+        stats = self._statistics()
+        n = stats["count"].sum()
+        if n == 0:
+            return np.nan
+        return stats["sum"].sum() / n
+
+    def std(self):
+        """ Return the (population) standard deviation of valid values in all
+        bands. """
+        stats = self._statistics()
+        stats = stats[stats["count"] != 0]
+        n = stats["count"].sum()
+        if n == 0:
+            return np.nan
+        mean = stats["sum"].sum() / n
+        # combine the per-chunk sums of squared deviations (Chan et al.)
+        chunkmeans = stats["sum"] / stats["count"]
+        m2 = (stats["m2"] + stats["count"]*(chunkmeans-mean)**2).sum()
+        return math.sqrt(m2 / n)
+
+    def histogram(self, bins=10, range=None):
+        """ Compute a histogram of valid values in all bands, reading data
+        incrementally.
+
+        Parameters
+        ----------
+        bins : int or sequence of floats, optional
+            number of equal-width bins or a monotonically increasing array of
+            bin edges (default 10)
+        range : (float, float), optional
+            lower and upper range of the bins (default the minimum and maximum
+            of valid values). Ignored if *bins* is a sequence.
+
+        Returns
+        -------
+        counts : ndarray
+        bin_edges : ndarray (length(counts)+1)
+        """
+        stats = self._statistics()
+        if range is None and np.ndim(bins) == 0:
+            range = (self._reduce(stats, "min", np.min),
+                     self._reduce(stats, "max", np.max))
+            if np.isnan(range[0]):
+                range = (0, 1)
+        _, edges = np.histogram([], bins=bins, range=range)
+        counts = np.zeros(len(edges)-1, dtype=np.int64)
+
+        for band in self.bands:
+            if hasattr(band, "chunk_statistics"):
+                for (y0, y1, x0, x1), st in zip(band._iterblocks(),
+                                                band.chunk_statistics()):
+                    if st["count"] == 0:
+                        continue
+                    elif st["min"] == st["max"]:
+                        # uniform chunks contribute without being read
+                        counts += st["count"] * \
+                                  np.histogram([st["min"]], bins=edges)[0]
+                    else:
+                        values = band._readblock(y0, x0, (y1-y0, x1-x0))
+                        counts += self._histogram_valid(values, edges)
+            else:
+                for strip in self._iterstrips(band):
+                    counts += self._histogram_valid(strip, edges)
+        return counts, edges
+
+    def _histogram_valid(self, values, edges):
+        """ Return histogram counts of the non-nodata *values*. """
+        if np.isnan(self.nodata):
+            values = values[~np.isnan(values)]
+        else:
+            values = values[values != self.nodata]
+        return np.histogram(values, bins=edges)[0]
+
     def aschunks(self, size=(-1, -1), overlap=(0, 0), copy=True):
         """ Generator for grid chunks, useful for parallel or memory-controlled
         grid processing.
@@ -428,10 +665,12 @@ class RegularGrid(Grid):
         Parameters
         ----------
         size : tuple of two integers, optional
-            size of the chunks ot return (default approximately one-quarter of
-            each dimension)
+            size (columns, rows) of the chunks to return (default
+            approximately one-quarter of each dimension). Note that this is
+            the reverse of the order used by `RegularGrid.size` and
+            `map_chunks`.
         overlap : tuple of two integers, optional
-            number of pixels of overlap (default (0, 0))
+            number of pixels of overlap (columns, rows) (default (0, 0))
         copy : bool
             whether to force returned grids to be copies
             warning: output may be a copy regardless, depending on the band class
@@ -443,7 +682,7 @@ class RegularGrid(Grid):
         """
         ny, nx = self.size
         if size == (-1, -1):
-            size = (nx//4, ny//4)
+            size = (max(nx//4, 1), max(ny//4, 1))
 
         i0 = 0
         j0 = 0
@@ -467,7 +706,354 @@ class RegularGrid(Grid):
             yield RegularGrid(T, values=v, crs=self.crs, nodata_value=self.nodata)
             j0 += size[0]-overlap[0]
 
-    def clip(self, xmin, xmax, ymin, ymax, crs=None):
+    def _chunk_windows(self, size, overlap):
+        """ Yield (core, window) pairs of (i0, i1, j0, j1) bounds tiling the
+        grid. Cores have dimensions *size* and are aligned with the blocks of
+        the first band where possible. Windows extend cores by *overlap*,
+        truncated at the grid edges. """
+        ny, nx = self.size
+        offset = getattr(self.bands[0], "_blockoffset", 0)
+        blocksize = getattr(self.bands[0], "_blocksize", None)
+        if blocksize is None or (size[0] % blocksize[0] != 0):
+            offset = 0
+        i0 = 0
+        i1 = size[0] - offset
+        while i0 < ny:
+            i1 = min(i1, ny)
+            j0 = 0
+            while j0 < nx:
+                j1 = min(j0+size[1], nx)
+                yield ((i0, i1, j0, j1),
+                       (max(i0-overlap[0], 0), min(i1+overlap[0], ny),
+                        max(j0-overlap[1], 0), min(j1+overlap[1], nx)))
+                j0 = j1
+            i0 = i1
+            i1 = i0 + size[0]
+
+    def _default_chunk_size(self):
+        """ Return a chunk size of approximately MAP_CHUNK_CELLS cells that is
+        a multiple of the block size of the first band. """
+        blocksize = getattr(self.bands[0], "_blocksize", (256, 256))
+        k = max(1, int(math.sqrt(MAP_CHUNK_CELLS /
+                                 float(blocksize[0]*blocksize[1]))))
+        return (k*blocksize[0], k*blocksize[1])
+
+    def map_chunks(self, func, size=None, overlap=(0, 0), workers=1,
+                   executor=None, nodata_value=None):
+        """ Apply a function to the grid in chunks, optionally in parallel,
+        and return the result as a new grid.
+
+        The grid is divided into chunks, each of which is read along with a
+        surrounding halo of *overlap* cells and passed to *func*. The halo is
+        cropped from the result before it is written to the output grid, so
+        that functions of a neighbourhood (filters, terrain derivatives) give
+        the same result as they would on the whole grid, except near grid
+        edges, where the halo is truncated.
+
+        Parameters
+        ----------
+        func : callable
+            function mapping an array of grid values (rows x columns, or rows x
+            columns x bands for multiband grids) to an array of the same
+            number of rows and columns. Its output determines the number of
+            bands and the data type of the result. With a process executor,
+            *func* must be picklable (e.g. a module-level function).
+        size : tuple of two integers, optional
+            number of (rows, columns) in each chunk, not including the halo.
+            By default, a multiple of the chunk size of the first band
+            containing approximately MAP_CHUNK_CELLS cells.
+        overlap : tuple of two integers, optional
+            number of halo (rows, columns) on each side of a chunk (default
+            (0, 0))
+        workers : int, optional
+            number of chunks to process in parallel (default 1)
+        executor : str or object, optional
+            either 'thread' (default) or 'process' to create a pool of
+            *workers* threads or processes, or an existing pool or executor
+            providing a ``map(func, iterable)`` method (e.g.
+            `multiprocessing.Pool` or `concurrent.futures.ProcessPoolExecutor`)
+        nodata_value : number, optional
+            nodata value of the result (default the nodata value of the grid)
+
+        Returns
+        -------
+        RegularGrid
+        """
+        if size is None:
+            size = self._default_chunk_size()
+        if size[0] < 1 or size[1] < 1:
+            raise ValueError("chunk size must be positive")
+        if overlap[0] < 0 or overlap[1] < 0:
+            raise ValueError("overlap must be non-negative")
+        if nodata_value is None:
+            nodata_value = self.nodata
+
+        pool = None
+        if workers > 1 and executor in (None, "thread"):
+            pool = ThreadPool(workers)
+            mapper = pool.imap
+        elif workers > 1 and executor == "process":
+            pool = multiprocessing.Pool(workers)
+            mapper = pool.imap
+        elif executor in (None, "thread", "process"):
+            mapper = map
+        elif hasattr(executor, "imap"):
+            mapper = executor.imap
+        else:
+            mapper = executor.map
+
+        # Output bands are written in the calling thread, and only a bounded
+        # number of chunks is read ahead of the one being written
+        bandclass, bandkwargs = self._output_bandclass()
+        outbands = []
+        windows = self._chunk_windows(size, overlap)
+        batchsize = max(1, 2*workers)
+        try:
+            while True:
+                batch = list(itertools.islice(windows, batchsize))
+                if len(batch) == 0:
+                    break
+                tasks = [(func, self[w[0]:w[1], w[2]:w[3]])
+                         for _, w in batch]
+                for (core, w), result in zip(batch, mapper(_map_window, tasks)):
+                    if result.ndim == 2:
+                        result = result[:,:,np.newaxis]
+                    if len(outbands) == 0:
+                        outbands = [bandclass(self.size, result.dtype.type,
+                                              **bandkwargs)
+                                    for _ in range(result.shape[2])]
+                    inner = result[core[0]-w[0]:core[1]-w[0],
+                                   core[2]-w[2]:core[3]-w[2]]
+                    for ibnd, band in enumerate(outbands):
+                        band[core[0]:core[1], core[2]:core[3]] = inner[:,:,ibnd]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return RegularGrid(self.transform, bands=outbands, crs=self.crs,
+                           nodata_value=nodata_value, bandkwargs=bandkwargs)
+
+    def focal(self, func="mean", size=3, footprint=None, chunksize=None):
+        """ Return a grid of a statistic computed over a moving window
+        centered on each cell.
+
+        The grid is processed in chunks read with a halo of half the window
+        size. Nodata cells and cells beyond the grid edges are ignored, and
+        cells that are nodata in the grid are nodata (NaN) in the result.
+        Rectangular windows use algorithms that take constant time per cell
+        regardless of window size: summed-area tables for "mean" and "std",
+        and separable van Herk/Gil-Werman passes for "min" and "max".
+
+        Parameters
+        ----------
+        func : str or callable, optional
+            one of "mean", "min", "max", "std", "median", or a function taking
+            an array of neighbourhood values (rows x columns x cells, with NaN
+            for missing cells) and returning an array of rows x columns
+            (default "mean")
+        size : int or tuple of two ints, optional
+            odd window dimensions in (rows, columns) (default 3)
+        footprint : 2d array of bool, optional
+            odd-dimensioned mask of the window cells to include, overriding
+            *size*
+        chunksize : tuple of two integers, optional
+            number of (rows, columns) in each chunk, not including the halo
+
+        Returns
+        -------
+        RegularGrid with float64 bands and NaN nodata
+        """
+        if footprint is not None:
+            footprint = np.asarray(footprint, dtype=bool)
+            if footprint.ndim != 2:
+                raise ValueError("footprint must be two-dimensional")
+            shape = footprint.shape
+        elif isinstance(size, numbers.Integral):
+            shape = (size, size)
+        else:
+            shape = tuple(size)
+        if len(shape) != 2 or shape[0] < 1 or shape[1] < 1 or \
+                shape[0] % 2 == 0 or shape[1] % 2 == 0:
+            raise ValueError("focal window dimensions must be positive and odd")
+        if not callable(func) and func not in FOCAL_STATS:
+            raise ValueError("focal statistic must be callable or one of {0}"
+                             .format(FOCAL_STATS))
+        if footprint is not None and footprint.all():
+            footprint = None
+
+        # statistics without a constant-time algorithm build a stack of every
+        # neighbour, so chunks are shrunk to bound its size
+        general = callable(func) or func == "median" or footprint is not None
+        if chunksize is None:
+            if general:
+                ncells = shape[0]*shape[1] if footprint is None else footprint.sum()
+                n = max(1, int(math.sqrt(MAP_CHUNK_CELLS / float(max(ncells, 1)))))
+                chunksize = (n, n)
+            else:
+                chunksize = self._default_chunk_size()
+        if footprint is None and general:
+            footprint = np.ones(shape, dtype=bool)
+
+        halo = (shape[0]//2, shape[1]//2)
+        bandclass, bandkwargs = self._output_bandclass()
+        outbands = [bandclass(self.size, np.float64, **bandkwargs)
+                    for _ in self.bands]
+        for (i0, i1, j0, j1), (wi0, wi1, wj0, wj1) in \
+                self._chunk_windows(chunksize, halo):
+            for band, outband in zip(self.bands, outbands):
+                z = np.full((i1-i0+2*halo[0], j1-j0+2*halo[1]), np.nan,
+                            dtype=np.float64)
+                values = self._read_window(band, wi0, wi1, wj0, wj1)
+                nodata = isnodata(values, self.nodata)
+                if nodata is not None:
+                    values = np.where(nodata, np.nan, values)
+                z[wi0-i0+halo[0]:wi1-i0+halo[0],
+                  wj0-j0+halo[1]:wj1-j0+halo[1]] = values
+
+                if general:
+                    result = _focal_stack(z, footprint, func)
+                elif func in ("mean", "std"):
+                    result = _focal_moments(z, shape, func)
+                else:
+                    result = _focal_extreme(z, shape, func)
+                center = z[halo[0]:z.shape[0]-halo[0],
+                           halo[1]:z.shape[1]-halo[1]]
+                result[np.isnan(center)] = np.nan
+                outband[i0:i1, j0:j1] = result
+
+        return RegularGrid(self.transform, bands=outbands, crs=self.crs,
+                           nodata_value=np.nan, bandkwargs=bandkwargs)
+
+    def _read_array(self, band=0):
+        """ Read a band into a contiguous float64 array, with NaN in place of
+        nodata. """
+        ny, nx = self.size
+        out = np.empty((ny, nx), dtype=np.float64)
+        nrows = max(1, REDUCTION_CELLS // max(nx, 1))
+        for i in range(0, ny, nrows):
+            i1 = min(i+nrows, ny)
+            values = self._read_window(self.bands[band], i, i1, 0, nx)
+            nodata = isnodata(values, self.nodata)
+            out[i:i1] = values
+            if nodata is not None:
+                out[i:i1][nodata] = np.nan
+        return out
+
+    def _from_array(self, values, nodata_value):
+        """ Return a grid with the structure of this one from an array,
+        written in strips into a band of the output band class. """
+        bandclass, bandkwargs = self._output_bandclass()
+        band = bandclass(self.size, values.dtype.type, **bandkwargs)
+        ny, nx = self.size
+        nrows = max(1, REDUCTION_CELLS // max(nx, 1))
+        for i in range(0, ny, nrows):
+            band[i:min(i+nrows, ny), :] = values[i:i+nrows]
+        return RegularGrid(self.transform, bands=[band], crs=self.crs,
+                           nodata_value=nodata_value, bandkwargs=bandkwargs)
+
+    def _flow_directions(self, band):
+        """ Return the filled elevations and D8 flow directions of a band. """
+        if self.transform[4:] != (0, 0):
+            raise NotImplementedError("flow routing not implemented on "
+                                      "skewed grids")
+        z = self._read_array(band)
+        direction = np.empty(z.shape, dtype=np.int8)
+        flow.priority_flood(z, direction)
+        dx, dy = self.resolution
+        flow.steepest_descent(z, abs(dx), abs(dy), direction)
+        return z, direction
+
+    def fill_depressions(self, band=0):
+        """ Return a grid of elevations with depressions filled to their spill
+        point, so that every cell drains to the edge of the grid or to a
+        nodata region.
+
+        Uses the priority-flood algorithm, which takes O(n log n) time for n
+        cells. The band is held in memory as float64 while filling.
+
+        Parameters
+        ----------
+        band : int, optional
+            band containing elevations (default 0)
+
+        Returns
+        -------
+        RegularGrid with NaN nodata
+        """
+        if self.transform[4:] != (0, 0):
+            raise NotImplementedError("flow routing not implemented on "
+                                      "skewed grids")
+        z = self._read_array(band)
+        flow.priority_flood(z, np.empty(z.shape, dtype=np.int8))
+        return self._from_array(z, np.nan)
+
+    def flow_direction(self, band=0):
+        """ Return D8 flow directions.
+
+        Each cell drains to its steepest downhill neighbour after depressions
+        are filled. Cells in flats, including filled depressions, drain along
+        the path by which the priority flood reached them, so that every cell
+        has a route to an outlet.
+
+        Parameters
+        ----------
+        band : int, optional
+            band containing elevations (default 0)
+
+        Returns
+        -------
+        RegularGrid of int8 codes 0-7 indexing `FLOW_OFFSETS`, with
+        `FLOW_OUTLET` for cells draining off the grid or into nodata, and
+        `FLOW_NODATA` as the nodata value
+        """
+        _, direction = self._flow_directions(band)
+        return self._from_array(direction, FLOW_NODATA)
+
+    def flow_accumulation(self, band=0, direction=None):
+        """ Return the number of cells draining through each cell, including
+        the cell itself.
+
+        Parameters
+        ----------
+        band : int, optional
+            band containing elevations (default 0)
+        direction : RegularGrid, optional
+            flow directions returned by `flow_direction`, which are computed
+            from the elevations if not given. Cells equal to the nodata value
+            of *direction* are treated as nodata.
+
+        Returns
+        -------
+        RegularGrid of uint32 counts, with nodata value 0
+
+        Raises
+        ------
+        ValueError
+            *direction* contains values other than the flow direction codes
+        """
+        if direction is None:
+            _, codes = self._flow_directions(band)
+        else:
+            if not self._equivalent_structure(direction):
+                raise errors.GridError("direction grid must have the same "
+                                       "structure as the elevation grid")
+            values = direction[:,:]
+            values = np.where(isnodata(values, direction.nodata),
+                              FLOW_NODATA, values)
+            # the compiled kernel indexes neighbour offsets by code without
+            # bounds checking
+            if values.size != 0 and not (
+                    np.all(values == np.round(values)) and
+                    values.min() >= FLOW_NODATA and values.max() <= 7):
+                raise ValueError("direction must contain flow direction codes "
+                                 "between {0} and 7".format(FLOW_NODATA))
+            codes = np.ascontiguousarray(values, dtype=np.int8)
+        counts = np.empty(codes.shape, dtype=np.uint32)
+        flow.accumulate(codes, counts)
+        return self._from_array(counts, 0)
+
+    def clip(self, xmin, xmax, ymin, ymax, crs=None, resolution=None):
         """ Return a clipped version of grid with cell centers constrained to a
         bounding box.
 
@@ -478,7 +1064,14 @@ class RegularGrid(Grid):
         ymin : float
         ymax : float
         crs : karta.crs.CRS subclass, optional
+        resolution : float, optional
+            coarsest acceptable cell size. If overviews have been built, the
+            coarsest overview with cells no larger than *resolution* is
+            clipped instead of the full grid.
         """
+        source = self._overview(resolution)
+        if source is not self:
+            return source.clip(xmin, xmax, ymin, ymax, crs=crs)
         if crs is not None:
             x, y = crs.transform(self.crs, [xmin, xmin, xmax, xmax],
                                            [ymin, ymax, ymin, ymax])
@@ -489,16 +1082,14 @@ class RegularGrid(Grid):
 
         # Convert to center coords
         t = self.transform
+        ny, nx = self.size
+        i, j = self.get_positions([xmin, xmax, xmin, xmax],
+                                  [ymin, ymin, ymax, ymax])
 
-        ll = self.get_positions(xmin, ymin)
-        lr = self.get_positions(xmax, ymin)
-        ul = self.get_positions(xmin, ymax)
-        ur = self.get_positions(xmax, ymax)
-
-        i0 = int(np.ceil(min(ll[0], lr[0], ul[0], ur[0])))
-        i1 = int(np.floor(max(ll[0], lr[0], ul[0], ur[0]))) + 1
-        j0 = int(np.ceil(min(ll[1], lr[1], ul[1], ur[1])))
-        j1 = int(np.floor(max(ll[1], lr[1], ul[1], ur[1]))) + 1
+        i0 = max(int(np.ceil(i.min())), 0)
+        i1 = min(int(np.floor(i.max())) + 1, ny)
+        j0 = max(int(np.ceil(j.min())), 0)
+        j1 = min(int(np.floor(j.max())) + 1, nx)
 
         values = self[i0:i1,j0:j1].copy()
         x0 = t[0] + j0*t[2] + i0*t[4]
@@ -554,17 +1145,19 @@ class RegularGrid(Grid):
         newbands = []
         for band in self.bands:
             newband = self._bndcls((nynew, nxnew), dtype=band.dtype,
-                                   initval=self.nodata)
+                                   initval=self.nodata, **self._bndkwargs)
             newband[i0new:i1new, j0new:j1new] = band[i0:i1, j0:j1]
             newbands.append(newband)
 
         gridnew = RegularGrid(Tnew, bands=newbands, crs=self.crs,
-                              nodata_value=self.nodata)
+                              nodata_value=self.nodata,
+                              bandkwargs=self._bndkwargs)
         return gridnew
 
     def mask_by_poly(self, polys, inplace=False):
         """ Return a grid with all elements outside the bounds of a polygon
-        masked by nodata
+        masked by nodata. Cells are inside when their centers are inside a
+        polygon and not inside one of its holes.
 
         Parameters
         ----------
@@ -573,39 +1166,124 @@ class RegularGrid(Grid):
         inplace : bool, optional
             whether or not to perform masking in place (default False)
         """
-        if getattr(polys, "_geotype", "") == "Polygon":
-            polys = [polys]
+        edges = _polygon_edges(self, polys)
+        if inplace:
+            self._invalidate_overviews()
+            out = self.bands
+        else:
+            bandclass, bandkwargs = self._output_bandclass()
+            out = [bandclass(band.size, band.dtype, **bandkwargs)
+                   for band in self.bands]
 
-        msk = None
-        for poly in polys:
+        for i0, i1, inside in _rasterize_strips(edges, self.size):
+            for band, outband in zip(self.bands, out):
+                outband[i0:i1,:] = np.where(inside, band[i0:i1,:], self.nodata)
 
-            if not poly.isclockwise():
-                vertices = poly.get_vertices(self.crs)[::-1]
-            else:
-                vertices = poly.get_vertices(self.crs)
-            x = [a[0] for a in vertices]
-            y = [a[1] for a in vertices]
+        if inplace:
+            return self
+        return RegularGrid(self.transform, bands=out, crs=self.crs,
+                           nodata_value=self.nodata)
 
-            ny, nx = self.size
+    def zonal_stats(self, polys, stats=("count", "mean", "min", "max", "std",
+                                        "sum"), band=0):
+        """ Compute statistics of the grid values within each of a set of
+        polygons (zones). The zones are rasterized together, a strip of rows
+        at a time, and each strip of the band is read once for all zones.
+        Cells belong to a zone when their centers are inside it. Zones should
+        not overlap.
 
-            _msk = mask_poly(x, y, nx, ny, self.transform)
+        Parameters
+        ----------
+        polys : Multipolygon, or list of Polygon
+            zones. The results are written to the data table of a
+            Multipolygon, with one field per statistic.
+        stats : list of str, optional
+            statistics to compute from "count", "sum", "mean", "min", "max",
+            and "std" (population standard deviation). By default all.
+        band : int, optional
+            index of the band to summarize (default 0)
 
-            if msk is None:
-                msk = _msk
+        Returns
+        -------
+        dict
+            mapping each statistic to a list with one value per zone. Zones
+            containing no valid cells have a count of zero and NaN for other
+            statistics.
+        """
+        for stat in stats:
+            if stat not in ZONAL_STATS:
+                raise ValueError("unknown statistic '{0}'".format(stat))
+        edges, parts = _polygon_edges(self, polys, return_parts=True)
+        nzones = len(_polygon_rings(polys, self.crs))
+
+        count = np.zeros(nzones, dtype=np.int64)
+        total = np.zeros(nzones)
+        mean = np.zeros(nzones)
+        m2 = np.zeros(nzones)
+        vmin = np.full(nzones, np.inf)
+        vmax = np.full(nzones, -np.inf)
+        for i0, i1, labels in _label_strips(edges, parts, self.size):
+            values = np.reshape(self.bands[band][i0:i1,:], labels.shape)
+            valid = labels >= 0
+            nodata = isnodata(values, self.nodata)
+            if nodata is not None:
+                valid &= ~nodata
+            labels = labels[valid]
+            values = values[valid].astype(np.float64)
+            if len(values) == 0:
+                continue
+
+            # per-zone summaries of the strip, combined with the running
+            # summaries as in RegularGrid.std
+            n = np.bincount(labels, minlength=nzones)
+            t = np.bincount(labels, weights=values, minlength=nzones)
+            total += t
+            with np.errstate(invalid="ignore", divide="ignore"):
+                m = t / n
+            d = values - m[labels]
+            s2 = np.bincount(labels, weights=d*d, minlength=nzones)
+            present = n != 0
+            ntotal = count + n
+            delta = np.where(present, m - mean, 0.0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.where(present, mean + delta*n/ntotal, mean)
+                m2 = np.where(present, m2 + s2 + delta**2*count*n/ntotal, m2)
+            count = ntotal
+
+            order = np.argsort(labels, kind="mergesort")
+            sorted_labels = labels[order]
+            starts = np.flatnonzero(np.r_[True, sorted_labels[1:] !=
+                                                sorted_labels[:-1]])
+            zones = sorted_labels[starts]
+            vmin[zones] = np.minimum(vmin[zones],
+                                     np.minimum.reduceat(values[order], starts))
+            vmax[zones] = np.maximum(vmax[zones],
+                                     np.maximum.reduceat(values[order], starts))
+
+        empty = count == 0
+        results = {}
+        for stat in stats:
+            if stat == "count":
+                values = count
+            elif stat == "sum":
+                values = total
+            elif stat == "mean":
+                values = mean
+            elif stat == "std":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = np.sqrt(m2/count)
+            elif stat == "min":
+                values = vmin
             else:
-                msk = (msk | _msk)
+                values = vmax
+            if stat != "count":
+                values = np.where(empty, np.nan, values)
+            results[stat] = values.tolist()
 
-        if inplace:
-            for band in self.bands:
-                data = band[:,:]
-                data[~msk] = self.nodata
-                band[:,:] = data
-            return self
-        else:
-            val = self[:,:]
-            return RegularGrid(self.transform,
-                               values=np.where(msk, val, self.nodata),
-                               crs=self.crs, nodata_value=self.nodata)
+        if getattr(polys, "_geotype", None) == "Multipolygon":
+            for stat in stats:
+                polys.data.setfield(stat, results[stat])
+        return results
 
     def resample_griddata(self, dx, dy, method='nearest'):
         """ Resample array to have spacing `dx`, `dy' using *scipy.griddata*
@@ -643,10 +1321,85 @@ class RegularGrid(Grid):
         return RegularGrid(tnew, values=values, crs=self.crs,
                            nodata_value=self.nodata)
 
+    def build_overviews(self, levels=(2, 4, 8, 16), method="average"):
+        """ Build and cache reduced-resolution versions of the grid.
+
+        Each overview is resampled from the full-resolution grid a tile at a
+        time, so that its values are the same as those of `resample` and
+        nodata and partial edge cells are weighted exactly. Overviews cover
+        the whole grid, are stored in bands of the same class as the grid, and
+        are discarded when grid values are assigned.
+
+        Once built, `sample`, `sample_along`, `profile`, `resample`, and
+        `clip` read from the coarsest overview whose cells are no larger than
+        the requested resolution. Interpolating methods use "average"
+        overviews; other methods use overviews built with the same method.
+
+        Parameters
+        ----------
+        levels : list of int, optional
+            decimation factors, greater than one (default (2, 4, 8, 16))
+        method : str, optional
+            'average' (default), 'nearest', or 'mode' (see `resample`)
+
+        Returns
+        -------
+        list of RegularGrid
+        """
+        if method not in OVERVIEW_METHODS:
+            raise ValueError("overview method must be one of {0}"
+                             .format(OVERVIEW_METHODS))
+        if self._transform[4:] != (0, 0):
+            raise NotImplementedError("overviews not implemented on skewed "
+                                      "grids")
+        levels = sorted(set(int(level) for level in levels))
+        if len(levels) == 0 or levels[0] < 2:
+            raise ValueError("overview levels must be integers greater than one")
+
+        ny, nx = self.size
+        dx, dy = self._transform[2:4]
+        overviews = []
+        for level in levels:
+            size = (-(-ny // level), -(-nx // level))
+            overviews.append((level, self._resampled(dx*level, dy*level,
+                                                     method, size)))
+        self._overviews = overviews
+        self._overview_method = method
+        return [grid for _, grid in overviews]
+
+    @property
+    def overviews(self):
+        """ List of cached overview grids, from finest to coarsest. """
+        return [grid for _, grid in self._overviews]
+
+    def _overview(self, resolution, method=None):
+        """ Return the coarsest overview with cells no larger than
+        *resolution* (a number or a pair for x and y) that can serve
+        *method*, or this grid if there is none. """
+        if resolution is None or len(self._overviews) == 0:
+            return self
+        if method in crfuncs.KERNEL_RADIUS:
+            if self._overview_method != "average":
+                return self
+        elif method is not None and method != self._overview_method:
+            return self
+        if isinstance(resolution, numbers.Number):
+            resolution = (resolution, resolution)
+        best = self
+        for _, grid in self._overviews:
+            if abs(grid._transform[2]) <= resolution[0]*(1+1e-9) and \
+                    abs(grid._transform[3]) <= resolution[1]*(1+1e-9):
+                best = grid
+        return best
+
     def resample(self, dx, dy, method='nearest'):
         """ Resample array to have spacing `dx`, `dy'. The grid origin remains
         in the same position.
 
+        The new grid is computed a tile at a time, reading only the part of
+        this grid needed for each tile, so that grids backed by compressed or
+        file bands need not fit in memory.
+
         Parameters
         ----------
         dx : float
@@ -654,92 +1407,213 @@ class RegularGrid(Grid):
         dy : float
             cell dimension 2
         method : str, optional
-            interpolation method, currently only 'nearest' supported
+            one of
+
+            - 'nearest' (default): value of the nearest cell
+            - 'bilinear', 'cubic', 'lanczos': interpolated value (see
+              `RegularGrid.sample`)
+            - 'average': mean of the cells covered by each new cell, weighted
+              by the area of overlap
+            - 'mode', 'min', 'max': most common, minimum, or maximum value of
+              the cells whose centers fall within each new cell
+
+            Nodata cells are ignored by all methods except 'nearest'.
+
+        If overviews have been built, the coarsest suitable overview is
+        resampled instead of the full grid (see `build_overviews`).
         """
+        if method not in RESAMPLE_METHODS:
+            raise NotImplementedError('method "{0}" not '
+                                      'implemented'.format(method))
         ny, nx = self.bands[0].size
         dx0, dy0 = self._transform[2:4]
-        xllcenter, yllcenter = self.center_llref()
+        size = (_resampled_size(ny, dy / dy0), _resampled_size(nx, dx / dx0))
+        source = self._overview((abs(dx), abs(dy)), method)
+        return source._resampled(dx, dy, method, size)
+
+    def _resampled(self, dx, dy, method, size):
+        """ Return this grid resampled to cells of *dx*, *dy* with the same
+        origin and dimensions *size*. """
+        dx0, dy0 = self._transform[2:4]
+        rx, ry = dx / dx0, dy / dy0
+        t = self._transform
+        tnew = (t[0], t[1], dx, dy, t[4], t[5])
+        nynew, nxnew = size
+
+        bandclass, bandkwargs = self._output_bandclass()
+        bands = []
+        for band in self.bands:
+            if method in ("nearest", "mode", "min", "max"):
+                dtype = band.dtype
+            else:
+                dtype = np.float64
+            bands.append(bandclass((nynew, nxnew), dtype, **bandkwargs))
+
+        # each tile covers at most RESAMPLE_TILE cells of this grid (plus any
+        # interpolation margin) in each direction
+        tny = max(1, int(RESAMPLE_TILE / max(ry, 1.0)))
+        tnx = max(1, int(RESAMPLE_TILE / max(rx, 1.0)))
+        for p0 in range(0, nynew, tny):
+            p1 = min(p0+tny, nynew)
+            for q0 in range(0, nxnew, tnx):
+                q1 = min(q0+tnx, nxnew)
+                tile = self._resample_tile(method, ry, rx, p0, p1, q0, q1)
+                for band, values in zip(bands, tile):
+                    band[p0:p1, q0:q1] = values
+
+        return RegularGrid(tnew, bands=bands, crs=self.crs,
+                           nodata_value=self.nodata, bandkwargs=bandkwargs)
+
+    def _resample_tile(self, method, ry, rx, p0, p1, q0, q1):
+        """ Return a list with the values of each band of the rows *p0:p1* and
+        columns *q0:q1* of this grid resampled by factors *ry*, *rx*. """
+        ny, nx = self.size
+        # centers of new cells, in fractional indices of this grid
+        I = ry/2 + np.arange(p0, p1)*ry - 0.5
+        J = rx/2 + np.arange(q0, q1)*rx - 0.5
 
-        if method == 'nearest':
-            rx, ry = dx / dx0, dy / dy0
-            I = np.around(np.arange(ry/2, ny, ry)-0.5).astype(int)
-            J = np.around(np.arange(rx/2, nx, rx)-0.5).astype(int)
-            if I[-1] == ny:
-                I = I[:-1]
-            if J[-1] == nx:
-                J = J[:-1]
+        if method in crfuncs.KERNEL_RADIUS:
             JJ, II = np.meshgrid(J, I)
-            values = self[:,:][II, JJ]
-        else:
-            raise NotImplementedError('method "{0}" not '
-                                      'implemented'.format(method))
+            z = self._interpolate(II.ravel(), JJ.ravel(), method)
+            return [z[:,k].reshape(II.shape) for k in range(len(self.bands))]
 
+        if method == "nearest":
+            I = np.clip(np.around(I).astype(int), 0, ny-1)
+            J = np.clip(np.around(J).astype(int), 0, nx-1)
+            y0, y1, x0, x1 = I[0], I[-1]+1, J[0], J[-1]+1
+            return [self._read_window(band, y0, y1, x0, x1)[np.ix_(I-y0, J-x0)]
+                    for band in self.bands]
+
+        if method == "average":
+            y0, y1 = int(math.floor(p0*ry)), min(int(math.ceil(p1*ry)), ny)
+            x0, x1 = int(math.floor(q0*rx)), min(int(math.ceil(q1*rx)), nx)
+            iy, wy = _overlap_weights(p0, p1, ry, y0, y1)
+            ix, wx = _overlap_weights(q0, q1, rx, x0, x1)
+            result = []
+            for band in self.bands:
+                values = self._read_window(band, y0, y1, x0, x1)
+                valid = ~isnodata(values, self.nodata)
+                values = np.where(valid, values, 0).astype(np.float64)
+                total = _weighted_rows(_weighted_rows(values, iy, wy).T,
+                                       ix, wx).T
+                weight = _weighted_rows(_weighted_rows(valid, iy, wy).T,
+                                        ix, wx).T
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    result.append(np.where(weight > 0, total/weight,
+                                           self.nodata))
+            return result
+
+        # mode, min, max: group the cells whose centers fall in each new cell
+        takey, startsy = _resample_groups(p0, p1, ry, ny)
+        takex, startsx = _resample_groups(q0, q1, rx, nx)
+        y0, y1 = takey.min(), takey.max()+1
+        x0, x1 = takex.min(), takex.max()+1
+        result = []
+        for band in self.bands:
+            values = self._read_window(band, y0, y1, x0, x1)
+            values = values[np.ix_(takey-y0, takex-x0)]
+            invalid = isnodata(values, self.nodata)
+            if method == "mode":
+                z = _group_mode(values, invalid, startsy, startsx,
+                                self.nodata)
+            else:
+                if method == "min":
+                    fill, reduce_ = np.inf, np.minimum
+                else:
+                    fill, reduce_ = -np.inf, np.maximum
+                values = np.where(invalid, fill, values.astype(np.float64))
+                z = reduce_.reduceat(reduce_.reduceat(values, startsy, axis=0),
+                                     startsx, axis=1)
+                z[z == fill] = self.nodata
+            result.append(z)
+        return result
+
+    @staticmethod
+    def _read_window(band, y0, y1, x0, x1):
+        """ Read a two-dimensional window from a band, including windows of a
+        single cell. """
+        return np.asarray(band[y0:y1, x0:x1]).reshape(y1-y0, x1-x0)
+
+    def _inverse_transform(self):
+        """ Return the coefficients (x0, y0, a, b, c, d) mapping coordinates
+        to fractional indices as
+
+            j = a * (x - x0) + b * (y - y0)
+            i = c * (x - x0) + d * (y - y0)
+
+        where (x0, y0) is the center of cell (0, 0). Coefficients are cached
+        until the transform changes.
+        """
         t = self._transform
-        tnew = (t[0], t[1], dx, dy, t[4], t[5])
-        return RegularGrid(tnew, values=values, crs=self.crs,
-                           nodata_value=self.nodata)
+        cached = getattr(self, "_inverse", None)
+        if cached is None or cached[0] != t:
+            det = t[2]*t[3] - t[4]*t[5]
+            if det == 0:
+                raise errors.GridError("grid transform is not invertible")
+            coeffs = (t[0] + 0.5*(t[2]+t[4]), t[1] + 0.5*(t[3]+t[5]),
+                      t[3]/det, -t[4]/det, -t[5]/det, t[2]/det)
+            cached = (t, coeffs)
+            self._inverse = cached
+        return cached[1]
 
     def get_positions(self, x, y):
-        """ Return the float column and row indices for the point nearest
+        """ Return the float row and column indices for the point nearest
         geographical coordinates.
 
         Parameters
         ----------
         x, y : float or vector
             vertices of points to compute indices for
+
+        Returns
+        -------
+        i, j : ndarray
+            fractional row and column indices, where integer values are cell
+            centers
+        """
+        x0, y0, a, b, c, d = self._inverse_transform()
+        dx = np.atleast_1d(np.asarray(x, dtype=np.float64)) - x0
+        dy = np.atleast_1d(np.asarray(y, dtype=np.float64)) - y0
+        j = a*dx + b*dy
+        i = c*dx + d*dy
+        return i, j
+
+    def get_coordinates(self, i, j):
+        """ Return the geographical coordinates of (possibly fractional) row
+        and column indices. This is the inverse of `get_positions`.
+
+        Parameters
+        ----------
+        i, j : float or vector
+            row and column indices, where integer values are cell centers
+
+        Returns
+        -------
+        x, y : ndarray
         """
-        # Calculate this by forming block matrices
-        #       | dx sy          |
-        #       | sx dy          |
-        #   T = |      ....      |
-        #       |          dx sy |
-        #       |          sx dy |
-        #
-        #       | x0 + (dx+dy)/2 |
-        #       | y0 + (dx+dy)/2 |
-        #   S = |    .......     |
-        #       | x0 + (dx+dy)/2 |
-        #       | y0 + (dx+dy)/2 |
-        #
-        # where the grid transform is t = (x0, y0, dx, dy, sy, sx)
-        #
-        # Then the nearest indices J come from solving the system
-        # T J = X - S
-        try:
-            npts = len(x)
-            if npts == 1:
-                x = x[0]
-                y = y[0]
-        except TypeError:
-            npts = 1
-
-        n = min(70, npts)    # number to process at once
         t = self._transform
-        T = (np.diag(np.tile([t[2], t[3]], n)) +
-             np.diag(np.tile([t[4], 0], n)[:-1], 1) +
-             np.diag(np.tile([t[5], 0], n)[:-1], -1))
-        S = np.tile([t[0]+0.5*(t[2]+t[4]), t[1]+0.5*(t[3]+t[5])], n)
+        i = np.asarray(i, dtype=np.float64) + 0.5
+        j = np.asarray(j, dtype=np.float64) + 0.5
+        x = t[0] + j*t[2] + i*t[4]
+        y = t[1] + i*t[3] + j*t[5]
+        return x, y
 
-        if npts == 1:
-            ind = np.linalg.solve(T, np.array([x, y]) - S)
-        else:
-            ind = np.empty(2*npts, dtype=np.float64)
-            i = 0
-            while i != npts:
-                ip = min(i + n, npts)
-                xy = np.zeros(2*n, dtype=np.float64)
-                xy[:2*(ip-i)] = np.vstack([x[i:ip], y[i:ip]]).T.ravel()
-                ind_ = np.linalg.solve(T, xy - S)
-                ind[2*i:2*ip] = ind_[:2*(ip-i)]
-                i = ip
+    def in_bounds(self, i, j):
+        """ Return a boolean array indicating which (possibly fractional) row
+        and column indices round to a cell within the grid.
 
+        Parameters
+        ----------
+        i, j : float or vector
+            row and column indices, e.g. from `get_positions`
+        """
         ny, nx = self.size
-        j = ind[::2]
-        i = ind[1::2]
-        return i, j
+        i = np.round(i)
+        j = np.round(j)
+        return (i >= 0) & (i <= ny-1) & (j >= 0) & (j <= nx-1)
 
     def get_indices(self, x, y):
-        """ Return the integer column and row indices for the point nearest
+        """ Return the integer row and column indices for the point nearest
         geographical coordinates. Compared to get_positions, this method raises
         and exception when points are out of range.
 
@@ -753,21 +1627,16 @@ class RegularGrid(Grid):
         GridError
             points outside of Grid bbox
         """
-        ny, nx = self.size
         i, j = self.get_positions(x, y)
+        if not self.in_bounds(i, j).all():
+            raise errors.GridError("Coordinates outside grid region ({0})".format(self.bbox))
 
-        if len(i) != 1:
-            i, j = np.round(i).astype(int), np.round(j).astype(int)
-            if min(i) < 0 or max(i) > ny-1 or min(j) < 0 or max(j) > nx-1:
-                raise errors.GridError("Coordinates outside grid region ({0})".format(self.bbox))
-        else:
-            i, j = int(round(i[0])), int(round(j[0]))
-            if not (0 <= i <= ny-1) or not(0 <= j <= nx-1):
-                raise errors.GridError("Coordinates outside grid region ({0})".format(self.bbox))
-
-        return i,j
+        i, j = np.round(i).astype(int), np.round(j).astype(int)
+        if len(i) == 1:
+            return int(i[0]), int(j[0])
+        return i, j
 
-    def sample_nearest(self, x, y):
+    def sample_nearest(self, x, y, bands=None):
         """ Return the value nearest to coordinates. Nearest grid center
         sampling scheme.
 
@@ -775,6 +1644,9 @@ class RegularGrid(Grid):
         ----------
         x, y : float or vector
             vertices of points to compute indices for
+        bands : int or list of int, optional
+            band or bands to sample (default all). When several bands are
+            sampled, the result has one column per band.
 
         Raises
         ------
@@ -782,43 +1654,91 @@ class RegularGrid(Grid):
             points outside of Grid bbox
         """
         i, j = self.get_indices(x, y)
-        ny, nx = self.bands[0].size
-        return self[:,:][i, j]
+        bands, squeeze = self._select_bands(bands)
+        values = np.stack([band[(i, j)] for band in bands], axis=-1)
+        if squeeze:
+            return values[...,0][()]
+        return values
 
-    def sample_bilinear(self, x, y):
+    def sample_bilinear(self, x, y, bands=None):
         """ Return the value nearest to coordinates. Bilinear sampling scheme.
 
         Parameters
         ----------
         x, y : float or vector
             vertices of points to compute indices for
+        bands : int or list of int, optional
+            band or bands to sample (default all). When several bands are
+            sampled, the result has one column per band.
+
+        Raises
+        ------
+        GridError
+            points outside of Grid bbox
         """
+        return self._sample_kernel(x, y, "bilinear", bands)
+
+    def _select_bands(self, bands):
+        """ Return a list of bands selected by an index, list of indices, or
+        None (all bands), and whether the band dimension of results should be
+        removed. """
+        if bands is None:
+            return self.bands, len(self.bands) == 1
+        elif isinstance(bands, numbers.Integral):
+            return [self.bands[bands]], True
+        return [self.bands[k] for k in bands], False
+
+    def _sample_kernel(self, x, y, method, bands=None):
+        """ Return values interpolated at coordinates using a compiled kernel
+        (see `crfuncs.interpolate_bands`). """
         i, j = self.get_positions(x, y)
-        i0 = np.floor(i).astype(int)
-        i1 = np.ceil(i).astype(int)
-        j0 = np.floor(j).astype(int)
-        j1 = np.ceil(j).astype(int)
-
-        # Handle case where interpolation point is exactly on a grid point
-        mska = i0==i1
-        mskb = i0==0
-        i0[mska&~mskb] -= 1
-        i1[mska&mskb] += 1
-
-        mska = j0==j1
-        mskb = j0==0
-        j0[mska&~mskb] -= 1
-        j1[mska&mskb] += 1
-
-        ny, nx = self.size
-        if np.any(i1>=ny) or np.any(j1>=nx) or np.any(i0<0) or np.any(j0<0):
+        if not self.in_bounds(i, j).all():
             raise errors.GridError("Coordinates outside grid extent({0})"
                     .format(self.get_extent()))
+        bands, squeeze = self._select_bands(bands)
+        z = self._interpolate(i, j, method, bands)
+        if squeeze:
+            return z[:,0]
+        return z
 
-        dx, dy = self._transform[2:4]
-        values = self[:,:]
-        z = (values[i0,j0]*(i1-i)*(j1-j) + values[i1,j0]*(i-i0)*(j1-j) + \
-             values[i0,j1]*(i1-i)*(j-j0) + values[i1,j1]*(i-i0)*(j-j0))
+    def _interpolate(self, i, j, method, bands=None):
+        """ Interpolate bands (default all) at fractional positions *i*, *j*,
+        returning an array with one column per band.
+
+        Points are grouped by the chunk (or file block) of the first band
+        containing them, and for each group only the region spanned by the
+        points and the kernel radius is read from each band. Kernel weights
+        are computed once per point and applied to every band.
+        """
+        if bands is None:
+            bands = self.bands
+        ny, nx = self.size
+        radius = crfuncs.KERNEL_RADIUS[method]
+        by, bx = getattr(bands[0], "_blocksize", (256, 256))
+        off = getattr(bands[0], "_blockoffset", 0)
+
+        fi = np.floor(i).astype(int)
+        fj = np.floor(j).astype(int)
+        blockid = ((np.clip(fi, 0, ny-1)+off)//by) * ((nx+bx-1)//bx) + \
+                  np.clip(fj, 0, nx-1)//bx
+        order = np.argsort(blockid, kind="mergesort")
+        breaks = np.r_[0, np.flatnonzero(np.diff(blockid[order]))+1, len(order)]
+
+        i = np.asarray(i, dtype=np.float64)
+        j = np.asarray(j, dtype=np.float64)
+        nodata = float(self.nodata)
+        z = np.empty((len(i), len(bands)), dtype=np.float64)
+        for start, end in zip(breaks[:-1], breaks[1:]):
+            idx = order[start:end]
+            y0 = max(fi[idx].min()-radius+1, 0)
+            y1 = min(fi[idx].max()+radius+1, ny)
+            x0 = max(fj[idx].min()-radius+1, 0)
+            x1 = min(fj[idx].max()+radius+1, nx)
+            window = np.empty((len(bands), y1-y0, x1-x0), dtype=np.float64)
+            for k, band in enumerate(bands):
+                window[k] = band[y0:y1, x0:x1]
+            z[idx] = crfuncs.interpolate_bands(window, i[idx]-y0, j[idx]-x0,
+                                               nodata, method)
         return z
 
     def sample(self, *args, **kwargs):
@@ -836,10 +1756,27 @@ class RegularGrid(Grid):
             used when coordinate lists are provided, otherwise the coordinate
             system is taken from the crs attribute of the geometry
         method : string, optional
-            may be one of 'nearest', 'bilinear' (default).
+            may be one of 'nearest', 'bilinear' (default), 'cubic' (Keys cubic
+            convolution), or 'lanczos' (Lanczos-3). Interpolating methods
+            exclude nodata cells, and return nodata for points whose nearest
+            cell is nodata.
+        bands : int or list of int, optional
+            band or bands to sample (default all). Multiple bands are sampled
+            in a single pass, returning an array with one row per point and
+            one column per band.
+        resolution : float, optional
+            coarsest acceptable cell size. If overviews have been built, the
+            coarsest overview with cells no larger than *resolution* is
+            sampled instead of the full grid.
         """
         crs = kwargs.get("crs", None)
         method = kwargs.get("method", "bilinear")
+        bands = kwargs.get("bands", None)
+        resolution = kwargs.pop("resolution", None)
+
+        source = self._overview(resolution, method)
+        if source is not self:
+            return source.sample(*args, **kwargs)
 
         argerror = TypeError("`grid` takes a Point, a Multipoint, or x, y coordinate lists")
         if hasattr(args[0], "_geotype"):
@@ -864,9 +1801,9 @@ class RegularGrid(Grid):
                 raise argerror
 
         if method == "nearest":
-            return self.sample_nearest(x, y)
-        elif method == "bilinear":
-            return self.sample_bilinear(x, y)
+            return self.sample_nearest(x, y, bands=bands)
+        elif method in crfuncs.KERNEL_RADIUS:
+            return self._sample_kernel(x, y, method, bands=bands)
         else:
             raise ValueError("method '{0}' not available".format(method))
 
@@ -881,20 +1818,77 @@ class RegularGrid(Grid):
             sample spacing, taken to be the minimum grid resolution by default
 
         Additional keyword arguments passed to `RegularGrid.sample` (e.g. to
-        specify sampling method)
+        specify sampling method, such as ``method="cubic"``)
 
         Returns
         -------
-        list of (x, y) tuples
+        karta.Multipoint
             sample points
         ndarray
             grid value at sample points
+
+        See also
+        --------
+        RegularGrid.sample_along
+        """
+        _, x, y, z = self.sample_along(line, resolution=resolution, **kw)
+        return Multipoint(np.column_stack([x, y]), crs=line.crs), z
+
+    def sample_along(self, line, resolution=None, **kw):
+        """ Sample at equally spaced positions along a Line, or along each
+        part of a Multiline. Positions are spaced along geodesics when the
+        line has a geographical coordinate system. All parts of a Multiline
+        are sampled together, so that each block of the grid is read once.
+
+        Parameters
+        ----------
+        line : karta.Line or karta.Multiline
+            defines the sampling path(s)
+        resolution : float, optional
+            sample spacing in the distance units of the line coordinate system
+            (meters for geographical systems), taken to be the minimum grid
+            resolution by default. If overviews have been built, values are
+            sampled from the coarsest overview with cells no larger than
+            *resolution*.
+
+        Additional keyword arguments passed to `RegularGrid.sample` (e.g. to
+        specify sampling method, such as ``method="cubic"``)
+
+        Returns
+        -------
+        distance, x, y, z : ndarray
+            distance along line, sample coordinates in the line coordinate
+            system, and grid values. When *line* is a Multiline, each is a list
+            with one array per part.
         """
         if resolution is None:
             resolution = min(self.transform[2:4])
-        points = line.to_points(resolution)
-        z = self.sample(*points.coordinates, **kw)
-        return points, z
+        if resolution <= 0:
+            raise ValueError("resolution must be positive")
+
+        if line._geotype == "Multiline":
+            parts = line.vertices
+        elif line._geotype == "Line":
+            parts = [line.vertices]
+        else:
+            raise TypeError("`sample_along` takes a Line or a Multiline")
+
+        counts = [len(part) for part in parts]
+        vx = np.concatenate([part.vectors()[0] for part in parts])
+        vy = np.concatenate([part.vectors()[1] for part in parts])
+        d, x, y, nsamples = _densify(vx, vy, counts, line.crs, resolution)
+
+        if line.crs == self.crs:
+            if not isinstance(self.crs, GeographicalCRS):
+                kw["resolution"] = resolution
+            z = self.sample(x, y, **kw)
+        else:
+            z = self.sample(x, y, crs=line.crs, **kw)
+
+        if line._geotype == "Line":
+            return d, x, y, z
+        splits = np.cumsum(nsamples)[:-1]
+        return tuple(np.split(a, splits) for a in (d, x, y, z))
 
     def as_warpedgrid(self):
         """ Return a copy of grid as a `WarpedGrid`. This is a more general
@@ -1041,78 +2035,393 @@ class WarpedGrid(Grid):
         """ Resample internal grid to the points defined by *X*, *Y*. """
         raise NotImplementedError
 
-def merge(grids, weights=None):
-    """ Perform a basic grid merge. Currently limited to grids whose sampling
-    is an integer translation from each other.
+def merge(grids, weights=None, method="mean", resampling="nearest",
+          transform=None, size=None, nodata_value=None, bandclass=None,
+          bandkwargs=None):
+    """ Merge grids into a single grid. The output is computed a tile at a
+    time from the grids overlapping each tile, so that mosaics larger than
+    memory can be written to compressed or disk-backed bands.
 
     Parameters
     ----------
-    grids : iterable of Grid objects
-        grids to combine
+    grids : iterable of RegularGrid
+        grids to combine, which must have the same number of bands
     weights : iterable of floats, optional
         weighting factors for computing grid averages
+    method : str, optional
+        how the values of overlapping grids are combined:
+
+        - 'mean' (default): weighted mean
+        - 'first', 'last': value of the first or last grid with data
+        - 'min', 'max': minimum or maximum value
+    resampling : str, optional
+        method used to sample grids that are not aligned with the output,
+        one of 'nearest' (default), 'bilinear', 'cubic', or 'lanczos'
+    transform : 6-tuple of floats, optional
+        output geotransform. By default, the output has the resolution and
+        skew of the first grid, is aligned with it, and covers all grids.
+    size : 2-tuple of int, optional
+        output number of rows and columns (required with *transform*)
+    nodata_value : number, optional
+        output nodata value (default the nodata value of the first grid)
+    bandclass : Band class, optional
+        class of the output bands (default CompressedBand), e.g. MemmapBand
+        to write the output to disk
+    bandkwargs : dict, optional
+        arguments passed to *bandclass*
     """
-
-    # Check grid class
+    grids = list(grids)
     if not all(isinstance(grid, RegularGrid) for grid in grids):
         raise NotImplementedError("All grids must by type RegularGrid")
-
-    T = grids[0].transform
-    # Check grid stretch and skew
-    for i, grid in enumerate(grids[1:]):
-        if grid.transform[2:6] != T[2:6]:
-            raise NotImplementedError("grid %d transform stretch and skew "
-                    "does not match grid 1" % (i+2,))
-
-    # Check grid offset
-    excmsg = "grid %d not an integer translation from grid 1"
-    for i, grid in enumerate(grids[1:]):
-        if ((grid.transform[0]-T[0]) / float(T[2])) % 1 > 1e-15:
-            raise NotImplementedError(excmsg % (i+2,))
-        if ((grid.transform[1]-T[1]) / float(T[3])) % 1 > 1e-15:
-            raise NotImplementedError(excmsg % (i+2,))
-
-    # Compute weighting coefficients by normalizing *weights*
+    if method not in MERGE_METHODS:
+        raise ValueError("method must be one of {0}".format(MERGE_METHODS))
+    if resampling != "nearest" and resampling not in crfuncs.KERNEL_RADIUS:
+        raise ValueError("resampling method '{0}' not "
+                         "available".format(resampling))
+    nbands = len(grids[0].bands)
+    if any(len(grid.bands) != nbands for grid in grids):
+        raise ValueError("grids must have the same number of bands")
     if weights is None:
         weights = np.ones(len(grids))
     else:
-        weights = np.asarray(weights, dtype=np.float32)
-
-    normalizedweights = weights * len(weights) / weights.sum()
-
-    # Compute final grid extent
-    xmin, xmax, ymin, ymax = grids[0].get_extent(reference='edge')
-    for grid in grids[1:]:
-        _xmin, _xmax, _ymin, _ymax = grid.get_extent(reference='edge')
-        xmin = min(xmin, _xmin)
-        xmax = max(xmax, _xmax)
-        ymin = min(ymin, _ymin)
-        ymax = max(ymax, _ymax)
-
-    nx = int(round((xmax-xmin) / T[2]))
-    ny = int(round((ymax-ymin) / T[3]))
-
-    # Allocate data array and copy each grid's data
-    typ = grids[0].bands[0].dtype
-    values = np.zeros([ny, nx], dtype=typ)
-    counts = np.zeros([ny, nx], dtype=np.float32)
-    for grid, w in zip(grids, normalizedweights):
-        _xmin, _xmax, _ymin, _ymax = grid.get_extent(reference='edge')
-        offx = int((_xmin-xmin) / T[2])
-        offy = int((_ymin-ymin) / T[3])
-        _ny, _nx = grid.size
-
-        mask = grid.data_mask
-        counts[offy:offy+_ny,offx:offx+_nx][mask] += w
-        values[offy:offy+_ny,offx:offx+_nx][mask] += typ(grid[mask]*w)
-        del mask
-
-    validcountmask = (counts!=0.0)
-    values[validcountmask] = values[validcountmask] / counts[validcountmask]
-    values[~validcountmask] = grids[0].nodata
-    Tmerge = [xmin, ymin] + list(T[2:])
-    return RegularGrid(Tmerge, values=values, crs=grids[0].crs,
-                       nodata_value=grids[0].nodata)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(grids):
+            raise ValueError("one weight is required per grid")
+
+    crs = grids[0].crs
+    if nodata_value is None:
+        nodata_value = grids[0].nodata
+    if bandclass is None:
+        bandclass = BAND_CLASS_DEFAULT
+    if bandkwargs is None:
+        bandkwargs = {}
+
+    # Output extent from the footprints of the grids, in the index space of
+    # the first grid
+    if transform is None:
+        corners = np.array([_footprint(grids[0], grid) for grid in grids])
+        imin = int(np.floor(corners[:,0].min() + 1e-9))
+        imax = int(np.ceil(corners[:,1].max() - 1e-9))
+        jmin = int(np.floor(corners[:,2].min() + 1e-9))
+        jmax = int(np.ceil(corners[:,3].max() - 1e-9))
+        t = grids[0].transform
+        transform = (t[0] + jmin*t[2] + imin*t[4],
+                     t[1] + imin*t[3] + jmin*t[5]) + tuple(t[2:])
+        size = (imax-imin, jmax-jmin)
+    elif size is None:
+        raise ValueError("size is required when transform is given")
+
+    dtypes = []
+    for k in range(nbands):
+        dtype = grids[0].bands[k].dtype
+        if method == "mean" and not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        dtypes.append(dtype)
+    bands = [bandclass(tuple(size), dtype, **bandkwargs) for dtype in dtypes]
+    out = RegularGrid(transform, bands=bands, crs=crs,
+                      nodata_value=nodata_value, bandkwargs=bandkwargs)
+
+    footprints = np.array([_footprint(out, grid) for grid in grids])
+    for (i0, i1, j0, j1), _ in out._chunk_windows((RESAMPLE_TILE, RESAMPLE_TILE),
+                                                  (0, 0)):
+        hits = np.flatnonzero((footprints[:,0] < i1) & (footprints[:,1] > i0) &
+                              (footprints[:,2] < j1) & (footprints[:,3] > j0))
+        shape = (nbands, i1-i0, j1-j0)
+        if method == "mean":
+            result = np.zeros(shape)
+            total = np.zeros(shape)
+        else:
+            result = np.full(shape, np.nan)
+        for k in hits:
+            values, valid = _merge_read(grids[k], out, i0, i1, j0, j1,
+                                        resampling)
+            if method == "mean":
+                result[valid] += weights[k] * values[valid]
+                total[valid] += weights[k]
+            elif method == "first":
+                fill = valid & np.isnan(result)
+                result[fill] = values[fill]
+            elif method == "last":
+                result[valid] = values[valid]
+            elif method == "min":
+                result[valid] = np.fmin(result[valid], values[valid])
+            else:
+                result[valid] = np.fmax(result[valid], values[valid])
+        if method == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = np.where(total != 0, result/total, np.nan)
+        result[np.isnan(result)] = nodata_value
+        for band, values in zip(bands, result):
+            band[i0:i1, j0:j1] = values
+    return out
+
+def _footprint(target, grid):
+    """ Return the bounds (imin, imax, jmin, jmax) of the cell edges of *grid*
+    in the index space of *target*. """
+    ny, nx = grid.size
+    i = np.array([-0.5, -0.5, ny-0.5, ny-0.5])
+    j = np.array([-0.5, nx-0.5, -0.5, nx-0.5])
+    x, y = grid.get_coordinates(i, j)
+    if grid.crs != target.crs:
+        x, y = grid.crs.transform(target.crs, x, y)
+    ti, tj = target.get_positions(x, y)
+    return ti.min()+0.5, ti.max()+0.5, tj.min()+0.5, tj.max()+0.5
+
+def _merge_read(grid, out, i0, i1, j0, j1, resampling):
+    """ Return the values of *grid* at the centers of cells *i0:i1*, *j0:j1*
+    of the grid *out*, as an array of shape (bands, rows, columns), and a
+    boolean array indicating which values are valid. """
+    nbands = len(grid.bands)
+    ny, nx = grid.size
+    shape = (i1-i0, j1-j0)
+    values = np.full((nbands,) + shape, np.nan)
+
+    # offset of out in the index space of grid
+    x, y = out.get_coordinates(np.array([0.0, 1.0, 0.0]),
+                               np.array([0.0, 0.0, 1.0]))
+    if grid.crs != out.crs:
+        x, y = out.crs.transform(grid.crs, x, y)
+    gi, gj = grid.get_positions(x, y)
+    steps = np.array([gi[1]-gi[0], gj[1]-gj[0], gi[2]-gi[0], gj[2]-gj[0]])
+    offset = np.array([gi[0], gj[0]])
+    aligned = (np.allclose(steps, [1, 0, 0, 1], rtol=0, atol=1e-9) and
+               np.allclose(offset, np.round(offset), rtol=0, atol=1e-6))
+
+    if aligned:
+        di, dj = np.round(offset).astype(int)
+        r0, r1 = max(i0+di, 0), min(i1+di, ny)
+        c0, c1 = max(j0+dj, 0), min(j1+dj, nx)
+        if r0 < r1 and c0 < c1:
+            for k, band in enumerate(grid.bands):
+                values[k, r0-di-i0:r1-di-i0, c0-dj-j0:c1-dj-j0] = \
+                        np.reshape(band[r0:r1, c0:c1], (r1-r0, c1-c0))
+    else:
+        II, JJ = np.mgrid[i0:i1, j0:j1]
+        x, y = out.get_coordinates(II.ravel(), JJ.ravel())
+        if grid.crs != out.crs:
+            x, y = out.crs.transform(grid.crs, x, y)
+        i, j = grid.get_positions(x, y)
+        inside = np.flatnonzero(grid.in_bounds(i, j))
+        flat = values.reshape(nbands, -1)
+        if len(inside) != 0:
+            if resampling == "nearest":
+                ii = np.round(i[inside]).astype(int)
+                jj = np.round(j[inside]).astype(int)
+                for k, band in enumerate(grid.bands):
+                    flat[k, inside] = band[(ii, jj)]
+            else:
+                z = grid._interpolate(i[inside], j[inside], resampling)
+                flat[:, inside] = z.T
+
+    valid = ~np.isnan(values)
+    nodata = isnodata(values, grid.nodata)
+    if nodata is not None:
+        valid &= ~nodata
+    return values, valid
+
+def _resampled_size(n, r):
+    """ Return the number of cells of size *r* (relative to the current cell
+    size) whose centers round to one of *n* cells. """
+    centers = r/2 + np.arange(int(math.ceil(n/r))+1)*r - 0.5
+    return int(np.count_nonzero((centers < n) & (np.around(centers) < n)))
+
+def _overlap_weights(p0, p1, r, s0, s1):
+    """ For new cells *p0:p1* of size *r*, return the indices (relative to
+    *s0*) of the unit cells *s0:s1* that each new cell may overlap, and the
+    lengths of overlap. Both arrays have one row per new cell. """
+    lo = np.arange(p0, p1)*r
+    hi = lo + r
+    first = np.clip(np.floor(lo).astype(int), s0, s1-1)
+    s = first[:,np.newaxis] + np.arange(int(math.ceil(r))+1)
+    weights = np.minimum(hi[:,np.newaxis], s+1) - np.maximum(lo[:,np.newaxis], s)
+    weights = np.clip(weights, 0, None)
+    weights[s >= s1] = 0
+    return np.minimum(s, s1-1) - s0, weights
+
+def _weighted_rows(values, index, weights):
+    """ Return rows that are sums of rows of *values* at *index* multiplied by
+    *weights*. """
+    out = np.zeros((len(index),) + values.shape[1:], dtype=np.float64)
+    for k in range(index.shape[1]):
+        out += weights[:,k,np.newaxis] * values[index[:,k]]
+    return out
+
+def _resample_groups(p0, p1, r, n):
+    """ For new cells *p0:p1* of size *r*, return the indices of the unit cells
+    whose centers fall within each new cell, concatenated, and the start of
+    each group. New cells containing no cell centers use the nearest cell. """
+    p = np.arange(p0, p1)
+    a = np.clip(np.ceil(p*r - 0.5), 0, n).astype(int)
+    b = np.clip(np.ceil((p+1)*r - 0.5), 0, n).astype(int)
+    empty = b <= a
+    a[empty] = np.clip(np.around(r/2 + p[empty]*r - 0.5), 0, n-1).astype(int)
+    b[empty] = a[empty] + 1
+    lengths = b - a
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    take = np.repeat(a - starts, lengths) + np.arange(lengths.sum())
+    return take, starts
+
+def _group_mode(values, invalid, startsy, startsx, nodata):
+    """ Return the most common valid value in each group of rows and columns
+    of *values* beginning at *startsy* and *startsx*, preferring the smallest
+    value in case of ties. """
+    ny, nx = values.shape
+    gy = np.repeat(np.arange(len(startsy)), np.diff(np.r_[startsy, ny]))
+    gx = np.repeat(np.arange(len(startsx)), np.diff(np.r_[startsx, nx]))
+    labels = (gy[:,np.newaxis]*len(startsx) + gx[np.newaxis,:])
+    labels = labels[~invalid]
+    vals = values[~invalid]
+
+    result = np.full(len(startsy)*len(startsx), nodata, dtype=values.dtype)
+    if len(vals) != 0:
+        order = np.lexsort((vals, labels))
+        labels = labels[order]
+        vals = vals[order]
+        runstart = np.r_[True, (labels[1:] != labels[:-1]) |
+                               (vals[1:] != vals[:-1])]
+        runidx = np.flatnonzero(runstart)
+        counts = np.diff(np.r_[runidx, len(vals)])
+        runlabels = labels[runidx]
+        # order runs by label and decreasing count, keeping the first run of
+        # each label (the lexsort puts smaller values first among ties)
+        best = np.lexsort((-counts, runlabels))
+        first = np.r_[True, runlabels[best][1:] != runlabels[best][:-1]]
+        chosen = runidx[best[first]]
+        result[labels[chosen]] = vals[chosen]
+    return result.reshape(len(startsy), len(startsx))
+
+def _densify(x, y, counts, crs, resolution):
+    """ Return positions spaced by *resolution* along each of a set of paths.
+
+    Parameters
+    ----------
+    x, y : ndarray
+        concatenated vertices of all paths
+    counts : list of int
+        number of vertices in each path
+    crs : karta.crs.CRS
+        coordinate system of the vertices. Spacing is measured along geodesics
+        for geographical coordinate systems.
+    resolution : float
+        sample spacing
+
+    Returns
+    -------
+    distance, x, y : ndarray
+        concatenated distances along path and sample coordinates
+    nsamples : ndarray
+        number of samples in each path
+    """
+    counts = np.asarray(counts)
+    if np.any(counts < 2):
+        raise ValueError("paths must have at least two vertices")
+    first = np.r_[0, np.cumsum(counts)[:-1]]
+    last = first + counts - 1
+
+    geographical = isinstance(crs, GeographicalCRS)
+    if geographical:
+        az, _, seglength = crs.inverse(x[:-1], y[:-1], x[1:], y[1:])
+        az = np.asarray(az)
+    else:
+        seglength = np.hypot(np.diff(x), np.diff(y))
+    # segments joining the end of one path to the start of the next take no
+    # length, so that the cumulative distance restarts within each path
+    seglength = np.asarray(seglength, dtype=np.float64)
+    seglength[last[:-1]] = 0.0
+    cumlength = np.r_[0.0, np.cumsum(seglength)]
+
+    pathlength = cumlength[last] - cumlength[first]
+    nsamples = np.floor(pathlength/resolution*(1+1e-12)).astype(int) + 1
+    path = np.repeat(np.arange(len(counts)), nsamples)
+    dist = (np.arange(nsamples.sum()) -
+            np.repeat(np.r_[0, np.cumsum(nsamples)[:-1]], nsamples))*resolution
+    D = cumlength[first][path] + dist
+
+    seg = np.searchsorted(cumlength, D, side="right") - 1
+    seg = np.clip(seg, first[path], last[path]-1)
+    remaining = D - cumlength[seg]
+    if geographical:
+        xs, ys, _ = crs.forward(x[seg], y[seg], az[seg], remaining)
+        xs, ys = np.asarray(xs), np.asarray(ys)
+    else:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(seglength[seg] > 0, remaining/seglength[seg], 0.0)
+        xs = x[seg] + frac*(x[seg+1]-x[seg])
+        ys = y[seg] + frac*(y[seg+1]-y[seg])
+    return dist, xs, ys, nsamples
+
+def _window_sums(a, shape):
+    """ Return the sums of *a* over every complete window of *shape*, using a
+    summed-area table. """
+    h, w = shape
+    table = np.zeros((a.shape[0]+1, a.shape[1]+1), dtype=np.float64)
+    np.cumsum(a, axis=0, out=table[1:,1:])
+    np.cumsum(table[1:,1:], axis=1, out=table[1:,1:])
+    return table[h:,w:] - table[:-h,w:] - table[h:,:-w] + table[:-h,:-w]
+
+def _focal_moments(z, shape, func):
+    """ Return the windowed mean or standard deviation of the non-NaN values of
+    *z*. Values are shifted by their mean to limit cancellation in the
+    summed-area tables. """
+    valid = ~np.isnan(z)
+    shift = z[valid].mean() if valid.any() else 0.0
+    v = np.where(valid, z-shift, 0.0)
+    count = _window_sums(valid.astype(np.float64), shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = _window_sums(v, shape) / count
+        if func == "mean":
+            return mean + shift
+        var = _window_sums(v*v, shape) / count - mean*mean
+    return np.sqrt(np.maximum(var, 0.0))
+
+def _running_extreme(a, n, axis, ufunc):
+    """ Return *ufunc* (np.minimum or np.maximum) reduced over every window of
+    *n* cells along *axis*, with the van Herk/Gil-Werman algorithm. """
+    a = np.moveaxis(a, axis, 0)
+    m = a.shape[0]
+    nblocks = -(-m // n)
+    fill = np.inf if ufunc is np.minimum else -np.inf
+    padded = np.full((nblocks*n,) + a.shape[1:], fill)
+    padded[:m] = a
+    blocks = padded.reshape((nblocks, n) + a.shape[1:])
+    prefix = ufunc.accumulate(blocks, axis=1).reshape(padded.shape)
+    suffix = ufunc.accumulate(blocks[:,::-1], axis=1)[:,::-1].reshape(padded.shape)
+    return np.moveaxis(ufunc(suffix[:m-n+1], prefix[n-1:m]), 0, axis)
+
+def _focal_extreme(z, shape, func):
+    """ Return the windowed minimum or maximum of the non-NaN values of *z*. """
+    ufunc = np.minimum if func == "min" else np.maximum
+    fill = np.inf if func == "min" else -np.inf
+    result = _running_extreme(np.where(np.isnan(z), fill, z), shape[0], 0, ufunc)
+    result = _running_extreme(result, shape[1], 1, ufunc)
+    result[np.isinf(result)] = np.nan
+    return result
+
+def _focal_stack(z, footprint, func):
+    """ Apply *func* to the stack of neighbours of each cell of *z* selected by
+    *footprint*. """
+    h, w = footprint.shape
+    ny, nx = z.shape[0]-h+1, z.shape[1]-w+1
+    stack = np.stack([z[di:di+ny, dj:dj+nx]
+                      for di, dj in np.argwhere(footprint)], axis=-1)
+    if callable(func):
+        return np.asarray(func(stack), dtype=np.float64)
+    reducer = {"mean": np.nanmean, "std": np.nanstd, "min": np.nanmin,
+               "max": np.nanmax, "median": np.nanmedian}[func]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return reducer(stack, axis=-1)
+
+def _map_window(task):
+    """ Apply a function to a window of grid values (used by
+    `RegularGrid.map_chunks`). """
+    func, values = task
+    result = np.asarray(func(values))
+    if result.shape[:2] != values.shape[:2]:
+        raise ValueError("function returned an array of shape {0} for a "
+                         "window of shape {1}".format(result.shape,
+                                                      values.shape))
+    return result
 
 def get_nodata(T):
     """ Return a default value for NODATA given a type
@@ -1131,8 +2440,170 @@ def get_nodata(T):
     else:
         raise ValueError("No default NODATA value for type {0}".format(T))
 
-def gridpoints(x, y, z, transform, crs):
-    """ Return a grid computed by averaging point data over cells.
+class PointBinner(object):
+    """ Accumulates statistics of point values over the cells of a regular
+    grid. Points may be added in any number of batches, so that large point
+    clouds can be gridded while holding only one batch and the accumulated
+    statistics in memory.
+
+    Parameters
+    ----------
+    transform : 6-tuple of floats
+        geotransform: ``[xllcorner, yllcorner, xres, yres, xskew, yskew]``
+    size : 2-tuple of int
+        number of rows and columns
+    stats : str or list of str, optional
+        statistics to compute (default "mean"):
+
+        - "count": number of points
+        - "sum", "mean", "min", "max"
+        - "std": population standard deviation
+        - "first", "last": value of the first and last point added
+        - "median", or "p" followed by a percentile, e.g. "p95" (these keep
+          the cell and value of every point until `grids` is called)
+    crs : karta.crs.CRS subclass, optional
+        coordinate reference system object
+    nodata_value : float, optional
+        value for cells containing no points (default NaN). Count grids are
+        zero in such cells.
+
+    Examples
+    --------
+    ::
+
+        binner = PointBinner(T, (ny, nx), stats=["mean", "max", "count"])
+        for x, y, z in batches:
+            binner.add(x, y, z)
+        grids = binner.grids()
+    """
+    def __init__(self, transform, size, stats="mean", crs=Cartesian,
+                 nodata_value=np.nan):
+        if isinstance(stats, str):
+            stats = [stats]
+        self.stats = list(stats)
+        self._percentiles = {}
+        for stat in self.stats:
+            if stat == "median":
+                self._percentiles[stat] = 50.0
+            elif stat.startswith("p") and stat not in BIN_STATS:
+                try:
+                    q = float(stat[1:])
+                except ValueError:
+                    raise ValueError("unknown statistic '{0}'".format(stat))
+                if not 0 <= q <= 100:
+                    raise ValueError("percentile must be in [0, 100]")
+                self._percentiles[stat] = q
+            elif stat not in BIN_STATS:
+                raise ValueError("unknown statistic '{0}'".format(stat))
+
+        self.crs = crs
+        self.nodata = nodata_value
+        ny, nx = size
+        # grid used to locate points; its band is never written, so holds no
+        # data
+        self._grid = RegularGrid(transform,
+                                 bands=[CompressedBand((ny, nx), np.int8)],
+                                 crs=crs)
+        self._count = np.zeros(ny*nx, dtype=np.int64)
+
+        def accumulator(*names):
+            if any(stat in self.stats for stat in names):
+                return np.zeros(ny*nx, dtype=np.float64)
+            return None
+
+        self._total = accumulator("sum")
+        self._mean = accumulator("mean", "std")
+        self._m2 = accumulator("std")
+        self._min = accumulator("min")
+        self._max = accumulator("max")
+        self._first = accumulator("first")
+        self._last = accumulator("last")
+        self._cells = []
+        self._values = []
+        return
+
+    def add(self, x, y, z):
+        """ Add points with coordinates *x*, *y* and values *z*. NaN values
+        are ignored.
+
+        Raises
+        ------
+        GridError
+            points outside of grid
+        """
+        z = np.asarray(z, dtype=np.float64).ravel()
+        if len(z) == 0:
+            return
+        I, J = self._grid.get_indices(x, y)
+        cells = (np.asarray(I, dtype=np.int64)*self._grid.size[1] +
+                 np.asarray(J, dtype=np.int64)).ravel()
+        crfuncs.bin_points(cells, z, self._count,
+                           total=self._total, mean=self._mean, m2=self._m2,
+                           vmin=self._min, vmax=self._max,
+                           first=self._first, last=self._last)
+        if self._percentiles:
+            valid = ~np.isnan(z)
+            self._cells.append(cells[valid])
+            self._values.append(z[valid])
+        return
+
+    def grids(self):
+        """ Return a dictionary of grids with the requested statistics. """
+        count = self._count
+        size = self._grid.size
+        empty = count == 0
+        percentiles = self._cell_percentiles(count)
+
+        grids = {}
+        for stat in self.stats:
+            if stat == "count":
+                grids[stat] = RegularGrid(self._grid.transform,
+                                          values=count.reshape(size).copy(),
+                                          crs=self.crs, nodata_value=-1)
+                continue
+            elif stat == "sum":
+                values = self._total.copy()
+            elif stat == "mean":
+                values = self._mean.copy()
+            elif stat == "std":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = np.sqrt(self._m2 / count)
+            elif stat in ("min", "max", "first", "last"):
+                values = getattr(self, "_" + stat).copy()
+            else:
+                values = percentiles[stat]
+            values[empty] = self.nodata
+            grids[stat] = RegularGrid(self._grid.transform,
+                                      values=values.reshape(size),
+                                      crs=self.crs, nodata_value=self.nodata)
+        return grids
+
+    def _cell_percentiles(self, count):
+        """ Return a dictionary of percentiles of the values in each cell,
+        interpolated linearly between values as in `numpy.percentile`. """
+        if not self._percentiles:
+            return {}
+        cells = np.concatenate(self._cells)
+        values = np.concatenate(self._values)
+        order = np.lexsort((values, cells))
+        values = values[order]
+        start = np.r_[0, np.cumsum(count)[:-1]]
+        nonempty = count != 0
+
+        result = {}
+        for stat, q in self._percentiles.items():
+            out = np.full(len(count), np.nan)
+            pos = q/100.0 * (count[nonempty]-1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo+1, count[nonempty]-1)
+            frac = pos - lo
+            s = start[nonempty]
+            out[nonempty] = values[s+lo]*(1-frac) + values[s+hi]*frac
+            result[stat] = out
+        return result
+
+def gridpoints(x, y, z, transform, crs, stats="mean", size=None):
+    """ Return a grid computed by binning point data over cells.
 
     Parameters
     ----------
@@ -1146,39 +2617,202 @@ def gridpoints(x, y, z, transform, crs):
         geotransform: ``[xllcorner, yllcorner, xres, yres, xskew, yskew]``
     crs : karta.crs.CRS subclass
         coordinate reference system object
+    stats : str or list of str, optional
+        statistic, or list of statistics, to compute (default "mean"). See
+        `PointBinner` for options.
+    size : 2-tuple of int, optional
+        number of rows and columns. By default, the grid extends from the
+        transform origin to include all points.
+
+    Returns
+    -------
+    RegularGrid, or a dictionary of RegularGrid instances if *stats* is a list
+
+    See also
+    --------
+    PointBinner : accumulate statistics from points in several batches
     """
-    ny = int((np.max(y) - transform[1]) // transform[3]) + 1
-    nx = int((np.max(x) - transform[0]) // transform[2]) + 1
-    grid = RegularGrid(transform,
-                       values=np.zeros([ny, nx]),
-                       crs=crs,
-                       nodata_value=np.nan,
-                       bandclass=SimpleBand)
-    counts = np.zeros([ny, nx], dtype=np.int16)
-
-    (I, J) = grid.get_indices(x, y)
-
-    try:
-        err = crfuncs.fillarray_double(grid[:,:],
-                                       I.astype(np.int32),
-                                       J.astype(np.int32), z, grid.nodata)
-        if err != 0:
-            raise RuntimeError("failure in fillarray_double")
-    except ValueError:
-        # Fast version works when *z* is of type double (np.float64).
-        # Python fallback for other types
-        for (i,j,z_) in zip(I, J, z):
-            grid[i,j] += z_
-            counts[i,j] += 1
-
-        m = counts!=0
-        grid[m] /= counts[m]
-        grid[~m] = grid.nodata
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z)
+    if size is None:
+        ny = int((np.max(y) - transform[1]) // transform[3]) + 1
+        nx = int((np.max(x) - transform[0]) // transform[2]) + 1
+        size = (ny, nx)
+    binner = PointBinner(transform, size, stats=stats, crs=crs)
+    for k in range(0, len(z), BIN_BATCH_POINTS):
+        batch = slice(k, k+BIN_BATCH_POINTS)
+        binner.add(x[batch], y[batch], z[batch])
+    grids = binner.grids()
+    if isinstance(stats, str):
+        return grids[stats]
+    return grids
+
+def rasterize(polys, transform, size, crs=Cartesian, coverage=False,
+              bandclass=None, bandkwargs=None):
+    """ Return a grid marking the cells covered by polygons. Holes, and
+    polygons that are parts of Multipolygons, are handled in a single pass,
+    and the result is written to the output band a strip of rows at a time.
 
+    Parameters
+    ----------
+    polys : Polygon, Multipolygon, or list of either
+        polygons to rasterize
+    transform : 6-tuple of floats
+        geotransform: ``[xllcorner, yllcorner, xres, yres, xskew, yskew]``
+    size : 2-tuple of int
+        number of rows and columns
+    crs : karta.crs.CRS subclass, optional
+        coordinate reference system of the grid
+    coverage : bool, optional
+        if False (default), return a uint8 grid that is 1 for cells with
+        centers inside a polygon and 0 elsewhere. If True, return the
+        fraction of the area of each cell covered by polygons.
+    bandclass : Band class, optional
+        class of the output band (default CompressedBand)
+    bandkwargs : dict, optional
+        arguments passed to *bandclass*
+
+    Returns
+    -------
+    RegularGrid
+    """
+    if bandclass is None:
+        bandclass = BAND_CLASS_DEFAULT
+    if bandkwargs is None:
+        bandkwargs = {}
+    dtype = np.float64 if coverage else np.uint8
+    band = bandclass(tuple(size), dtype, **bandkwargs)
+    grid = RegularGrid(transform, bands=[band], crs=crs, nodata_value=None,
+                       bandkwargs=bandkwargs)
+    edges = _polygon_edges(grid, polys)
+    for i0, i1, values in _rasterize_strips(edges, grid.size, coverage):
+        band[i0:i1,:] = values
     return grid
 
+def _polygon_rings(polys, crs):
+    """ Return a list of the rings of each polygon in *polys* (a Polygon,
+    Multipolygon, or list of either), as vertex arrays in *crs*. The first
+    ring of each polygon is its exterior. """
+    if getattr(polys, "_geotype", None) in ("Polygon", "Multipolygon"):
+        polys = [polys]
+    result = []
+    for poly in polys:
+        if poly._geotype == "Multipolygon":
+            if poly.crs == crs:
+                result.extend(poly.get_vertices())
+            else:
+                result.extend(poly.get_vertices(crs))
+        elif poly._geotype == "Polygon":
+            rings = [poly.get_vertices(crs)]
+            rings.extend(sub.get_vertices(crs) for sub in poly.subs)
+            result.append(rings)
+        else:
+            raise TypeError("expected a Polygon or Multipolygon, not "
+                            "{0}".format(poly._geotype))
+    return result
+
+def _polygon_edges(grid, polys, return_parts=False):
+    """ Return an array of the edges (y0, x0, y1, x1) of *polys* in the
+    cell-edge coordinates of *grid*, in which cell (i, j) spans [i, i+1) x
+    [j, j+1). Exterior rings are oriented counter-clockwise in these
+    coordinates and holes clockwise. If *return_parts* is True, also return
+    the index of the polygon (or Multipolygon part) of each edge. """
+    edges = [np.zeros((0, 4))]
+    parts = [np.zeros(0, dtype=np.int32)]
+    for part, rings in enumerate(_polygon_rings(polys, grid.crs)):
+        for k, ring in enumerate(rings):
+            ring = np.asarray(ring, dtype=np.float64)
+            if len(ring) < 3:
+                continue
+            i, j = grid.get_positions(ring[:,0], ring[:,1])
+            y = i + 0.5
+            x = j + 0.5
+            area = np.sum(x*np.roll(y, -1) - np.roll(x, -1)*y)
+            if (area < 0) == (k == 0):
+                y = y[::-1]
+                x = x[::-1]
+            edges.append(np.column_stack([y, x, np.roll(y, -1), np.roll(x, -1)]))
+            parts.append(np.full(len(y), part, dtype=np.int32))
+    if return_parts:
+        return np.concatenate(edges), np.concatenate(parts)
+    return np.concatenate(edges)
+
+def _rasterize_strips(edges, size, coverage=False):
+    """ Yield (i0, i1, values) for strips of rows *i0:i1* of a grid of *size*,
+    where *values* is a boolean array of cells inside the polygon with
+    *edges* or, if *coverage* is True, the fraction of each cell covered. """
+    ny, nx = size
+    nrows = max(1, REDUCTION_CELLS // max(nx, 1))
+    ylo = np.minimum(edges[:,0], edges[:,2])
+    yhi = np.maximum(edges[:,0], edges[:,2])
+    order = np.argsort(ylo, kind="mergesort")
+    edges, ylo, yhi = edges[order], ylo[order], yhi[order]
+    for i0 in range(0, ny, nrows):
+        i1 = min(i0+nrows, ny)
+        # active edges overlap the rows of the strip
+        n = np.searchsorted(ylo, i1)
+        active = np.ascontiguousarray(edges[:n][yhi[:n] > i0])
+        if coverage:
+            out = np.zeros((i1-i0, nx), dtype=np.float64)
+            scanline.coverage_strip(active, i0, out)
+            yield i0, i1, np.clip(np.abs(out), 0.0, 1.0)
+        else:
+            out = np.zeros((i1-i0, nx), dtype=np.int32)
+            scanline.winding_strip(active, i0, out)
+            yield i0, i1, out != 0
+
+def _label_strips(edges, parts, size):
+    """ Yield (i0, i1, labels) for strips of rows *i0:i1* of a grid of
+    *size*, where *labels* contains the part index of the polygon containing
+    each cell center, or -1. Polygons are assumed not to overlap. Strips
+    containing no polygons are skipped. """
+    ny, nx = size
+    nrows = max(1, REDUCTION_CELLS // max(nx, 1))
+    # orient edges upward, remembering direction
+    sign = np.where(edges[:,2] > edges[:,0], 1, -1)
+    ylo = np.minimum(edges[:,0], edges[:,2])
+    yhi = np.maximum(edges[:,0], edges[:,2])
+    xlo = np.where(sign > 0, edges[:,1], edges[:,3])
+    xhi = np.where(sign > 0, edges[:,3], edges[:,1])
+    keep = ylo != yhi
+    order = np.argsort(ylo[keep], kind="mergesort")
+    sign, ylo, yhi, xlo, xhi, parts = (a[keep][order] for a in
+                                       (sign, ylo, yhi, xlo, xhi, parts))
+    for i0 in range(0, ny, nrows):
+        i1 = min(i0+nrows, ny)
+        n = np.searchsorted(ylo, i1)
+        active = np.flatnonzero(yhi[:n] > i0)
+        if len(active) == 0:
+            continue
+
+        # rows with centers in [ylo, yhi) crossed by each active edge
+        r0 = np.maximum(np.ceil(ylo[active] - 0.5), i0).astype(int)
+        r1 = np.minimum(np.ceil(yhi[active] - 0.5), i1).astype(int)
+        counts = np.maximum(r1 - r0, 0)
+        e = np.repeat(active, counts)
+        rows = (np.repeat(r0 - np.r_[0, np.cumsum(counts)[:-1]], counts) +
+                np.arange(counts.sum()))
+        yc = rows + 0.5
+        x = xlo[e] + (yc - ylo[e]) * (xhi[e] - xlo[e]) / (yhi[e] - ylo[e])
+        cols = np.clip(np.floor(np.clip(x, -1, nx) + 0.5), 0, nx).astype(int)
+
+        # sweep crossings in each row from left to right, exits before
+        # entries, so that the running winding number is 0 outside polygons.
+        # Exteriors are counter-clockwise, so exits cross rows upward.
+        order = np.lexsort((-sign[e], cols, rows))
+        rows, cols, e = rows[order], cols[order], e[order]
+        winding = np.cumsum(sign[e])
+        label = np.where(winding != 0, parts[e], -1)
+        previous = np.r_[-1, label[:-1]]
+        previous[np.r_[True, rows[1:] != rows[:-1]]] = -1
+
+        delta = np.zeros((i1-i0, nx+1), dtype=np.int64)
+        np.add.at(delta, (rows-i0, cols), label - previous)
+        yield i0, i1, np.cumsum(delta[:,:-1], axis=1) - 1
+
 def mask_poly(xpoly, ypoly, nx, ny, transform):
-    """ Create a grid mask based on a clockwise-oriented polygon.
+    """ Create a grid mask based on a polygon.
 
     Parameters
     ----------
@@ -1191,55 +2825,10 @@ def mask_poly(xpoly, ypoly, nx, ny, transform):
         affine transformation describing grid layout and origin
         ``T == [x0, y0, dx, dy, sx, sy]``
     """
-    mask = np.zeros((ny, nx), dtype=np.int8)
-
-    # find southernmost index (will start and end on this point)
-    v = ypoly[0]
-    i_bot = 0
-    for i in range(1, len(ypoly)):
-        if ypoly[i] < v:
-            v = ypoly[i]
-            i_bot = i
-
-    x0 = xpoly[i_bot]
-    y0 = ypoly[i_bot]
-
-    ta, tb, tc, td, te, tf = transform
-    i0 = int(round((y0 - min(y0, tb) - tf/tc*(x0 - min(x0, ta))) / (td - tf*te/tc)))
-    j0 = int(round((x0 - min(x0, ta) - te/td*(y0 - min(y0, tb))) / (tc - te*tf/td)))
-
-    for el in range(1, len(xpoly)+1):
-        idx = (el + i_bot) % len(xpoly)
-        x1 = xpoly[idx]
-        y1 = ypoly[idx]
-
-        # (Unbounded) grid indices of the segment end points
-        i1 = int(round((y1-tb - tf/tc*(x1-ta)) / (td - tf*te/tc)))
-        j1 = int(round((x1-ta - te/td*(y1-tb)) / (tc - te*tf/td)))
-
-        # If segment is horizontal or off-grid, ignore
-        if ((0 <= i0 < ny) and (0 <= i1 < ny)) or (y1 != y0):
-
-            if y1 > y0:     # mark grid cells to the right
-
-                for i in range(i0, i1):
-                    if (0 <= i < ny):
-                        j = int(round((i-i0) * (x1-x0)/(y1-y0) + j0))
-                        if j < nx:
-                            mask[i, max(0, j):] += 1
-
-            else:           # unmark grid cells to the right
-
-                for i in range(i1, i0):
-                    if (0 <= i < ny):
-                        j = int(round((i-i1) * (x1-x0)/(y1-y0) + j1))
-                        if j < nx:
-                            mask[i, max(0, j):] -= 1
-
-        x0 = x1
-        y0 = y1
-        i0 = i1
-        j0 = j1
-
-    return mask.astype(np.bool)
+    grid = RegularGrid(transform, bands=[CompressedBand((ny, nx), np.int8)])
+    poly = Polygon(list(zip(xpoly, ypoly)), crs=grid.crs)
+    mask = np.zeros((ny, nx), dtype=bool)
+    for i0, i1, inside in _rasterize_strips(_polygon_edges(grid, poly), (ny, nx)):
+        mask[i0:i1,:] = inside
+    return mask
 
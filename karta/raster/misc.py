@@ -3,7 +3,9 @@
 """
 
 import numpy as np
-from .grid import RegularGrid
+from . import crfuncs
+from .band import isnodata
+from .grid import RegularGrid, REDUCTION_CELLS
 
 def witch_of_agnesi(nx=100, ny=100, a=4.0):
     """ Return a raster field defined by the equation
@@ -83,68 +85,118 @@ def pad(A, width=1, edges="all", value=0.0):
 
     return B
 
-def _slope(D, res=(1.0, 1.0)):
-    """ Return the scalar slope at each pixel using the neighbourhood method.
-    http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=How%20Slope%20works
-    """
-    dx = res[0]
-    dy = res[1]
-    Ddx = ((2 * D[1:-1,2:] + D[:-2,2:] + D[2:,2:]) -
-           (2 * D[1:-1,:-2] + D[:-2,:-2] + D[2:,:-2])) / (8.0 * dx)
-    Ddy = ((2 * D[2:,1:-1] + D[2:,2:] + D[2:,:-2]) -
-           (2 * D[:-2,1:-1] + D[:-2,:-2] + D[:-2,2:])) / (8.0 * dy)
+EARTH_RADIUS = 6371008.8
+VIEWSHED_TILE = 1024
+TERRAIN_OUTPUTS = ("slope", "aspect", "curvature", "gradient", "hillshade")
+
+def terrain(grid, outputs=("slope",), azimuth=330.0, elevation=60.0, band=0,
+            size=None):
+    """ Compute terrain derivatives of a digital elevation model in a single
+    pass.
 
-    return pad(np.sqrt(Ddx*Ddx + Ddy*Ddy), value=np.nan)
+    The grid is processed in chunks, each read once with a one-cell halo and
+    passed to a compiled kernel that evaluates every requested output from the
+    same 3x3 neighbourhood. Cells on the edge of the grid, and cells with a
+    nodata neighbour, are NaN in the outputs.
+
+    Parameters
+    ----------
+    grid : RegularGrid
+        elevation model, with no skew
+    outputs : list of str, optional
+        any of "slope", "aspect", "curvature", "gradient", "hillshade"
+        (default ("slope",))
+    azimuth : float, optional
+        direction of light source for hillshading, in degrees (default 330.0)
+    elevation : float, optional
+        height of light source for hillshading, in degrees (default 60.0)
+    band : int, optional
+        band containing elevations (default 0)
+    size : tuple of int, optional
+        chunk dimensions (default chosen from the band block size)
+
+    Returns
+    -------
+    dict mapping each output to a RegularGrid, except for "gradient", which
+    maps to a tuple of (dz/dx, dz/dy) grids
+
+    Notes
+    -----
+    Derivatives use the Horn (Sobel) differences. Aspect is arctan2(dz/dy,
+    -dz/dx) in radians. Curvature is the negative Laplacian, so that convex
+    surfaces are positive. Hillshade is the cosine of the angle between the
+    surface normal and the light source, without contrast stretching.
+    """
+    if grid.transform[4:] != (0, 0):
+        raise NotImplementedError("terrain calculations not implemented on "
+                                  "skewed grids")
+    if isinstance(outputs, str):
+        outputs = (outputs,)
+    for name in outputs:
+        if name not in TERRAIN_OUTPUTS:
+            raise ValueError("terrain output must be one of {0}"
+                             .format(TERRAIN_OUTPUTS))
+    if len(outputs) == 0:
+        raise ValueError("at least one terrain output is required")
+    if size is None:
+        size = grid._default_chunk_size()
+
+    names = []
+    for name in outputs:
+        if name == "gradient":
+            names.extend(["dzdx", "dzdy"])
+        elif name not in names:
+            names.append(name)
+
+    bandclass, bandkwargs = grid._output_bandclass()
+    bands = dict((name, bandclass(grid.size, np.float64, **bandkwargs))
+                 for name in names)
+    dx, dy = grid.resolution
+    src = grid.bands[band]
+    ny, nx = grid.size
+
+    for (i0, i1, j0, j1), (wi0, wi1, wj0, wj1) in grid._chunk_windows(size, (1, 1)):
+        z = np.full((i1-i0+2, j1-j0+2), np.nan, dtype=np.float64)
+        values = grid._read_window(src, wi0, wi1, wj0, wj1)
+        nodata = isnodata(values, grid.nodata)
+        if nodata is not None:
+            values = np.where(nodata, np.nan, values)
+        z[wi0-i0+1:wi1-i0+1, wj0-j0+1:wj1-j0+1] = values
+
+        chunk = dict((name, np.empty((i1-i0, j1-j0), dtype=np.float64))
+                     for name in names)
+        crfuncs.terrain(z, dx, dy, azimuth=azimuth, elevation=elevation,
+                        **chunk)
+        for name in names:
+            bands[name][i0:i1, j0:j1] = chunk[name]
+
+    def _grid(name):
+        return RegularGrid(grid.transform, bands=[bands[name]], crs=grid.crs,
+                           nodata_value=np.nan)
+
+    result = {}
+    for name in outputs:
+        if name == "gradient":
+            result[name] = (_grid("dzdx"), _grid("dzdy"))
+        else:
+            result[name] = _grid(name)
+    return result
 
 def slope(grid):
     """ Return the scalar slope at each pixel using the neighbourhood method.
     http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=How%20Slope%20works
     """
-    if grid.transform[4:] != (0, 0):
-        raise NotImplementedError("slope calculations no implemented on skewed grids")
-    D = np.where(grid.data_mask, grid[:,:].astype(np.float32), np.nan)
-    return RegularGrid(grid.transform, _slope(D, grid.resolution),
-                       crs=grid.crs, nodata_value=np.nan)
+    return terrain(grid, ("slope",))["slope"]
 
-def _aspect(D, res=(1.0, 1.0)):
+def aspect(grid):
     """ Return the slope aspect for each pixel.
     http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=How%20Aspect%20works
     """
-    dx = res[0]
-    dy = res[1]
-    Ddx = ((2 * D[1:-1,2:] + D[:-2,2:] + D[2:,2:]) -
-           (2 * D[1:-1,:-2] + D[:-2,:-2] + D[2:,:-2])) / (8.0 * dx)
-    Ddy = ((2 * D[2:,1:-1] + D[2:,2:] + D[2:,:-2]) -
-           (2 * D[:-2,1:-1] + D[:-2,:-2] + D[:-2,2:])) / (8.0 * dy)
-
-    return pad(np.arctan2(Ddy, -Ddx), value=np.nan)
-
-def aspect(grid):
-    if grid.transform[4:] != (0, 0):
-        raise NotImplementedError("aspect calculations no implemented on skewed grids")
-    D = np.where(grid.data_mask, grid[:,:].astype(np.float32), np.nan)
-    return RegularGrid(grid.transform, _aspect(D, grid.resolution),
-                       crs=grid.crs, nodata_value=np.nan)
-
-def _grad(D, res=(1.0, 1.0)):
-    """ Computes the gradient of potential D. Return a tuple (dx, dy).
-    """
-    dx = res[0]
-    dy = res[1]
-    Ddx = ((2 * D[1:-1,2:] + D[:-2,2:] + D[2:,2:]) -
-           (2 * D[1:-1,:-2] + D[:-2,:-2] + D[2:,:-2])) / (8.0 * dx)
-    Ddy = ((2 * D[2:,1:-1] + D[2:,2:] + D[2:,:-2]) -
-           (2 * D[:-2,1:-1] + D[:-2,:-2] + D[:-2,2:])) / (8.0 * dy)
-    return (pad(Ddx, width=1, edges='all', value=np.nan),
-            pad(Ddy, width=1, edges='all', value=np.nan))
+    return terrain(grid, ("aspect",))["aspect"]
 
 def gradient(grid):
-    if grid.transform[4:] != (0, 0):
-        raise NotImplementedError("gradient calculations no implemented on skewed grids")
-    D = np.where(grid.data_mask, grid[:,:].astype(np.float32), np.nan)
-    dDdx, dDdy = _grad(D, grid.resolution)
-    return (RegularGrid(grid.transform, dDdx, crs=grid.crs, nodata_value=np.nan),
-            RegularGrid(grid.transform, dDdy, crs=grid.crs, nodata_value=np.nan))
+    """ Computes the gradient of *grid*. Return a tuple (dx, dy). """
+    return terrain(grid, ("gradient",))["gradient"]
 
 def _div(U, V, res=(1.0, 1.0)):
     """ Calculate the divergence of a vector field. """
@@ -161,27 +213,60 @@ def divergence(grid):
     return RegularGrid(grid.transform, _div(D, grid.resolution),
                        crs=grid.crs, nodata_value=np.nan)
 
-def _normed_potential_vectors(D, res=(1.0, 1.0)):
-    """ Computes a U,V vector field of potential D. Scalar components of
+def normed_potential_vectors(grid):
+    """ Computes a U,V vector field of potential *grid*. Scalar components of
     U,V are normalized to max(|U, V|).
     """
-    dx, dy = res
-    Ddx = ((2 * D[1:-1,2:] + D[:-2,2:] + D[2:,2:]) -
-           (2 * D[1:-1,:-2] + D[:-2,:-2] + D[2:,:-2])) / (8.0*dx)
-    Ddy = ((2 * D[2:,1:-1] + D[2:,2:] + D[2:,:-2]) -
-           (2 * D[:-2,1:-1] + D[:-2,:-2] + D[:-2,2:])) / (8.0*dy)
-    M = np.sqrt(Ddx**2 + Ddy**2)
-    U = Ddx / M[np.isnan(M)==False].max()
-    V = Ddy / M[np.isnan(M)==False].max()
-    return pad(U, value=np.nan), pad(V, value=np.nan)
-
-def normed_potential_vectors(grid):
-    if grid.transform[4:] != (0, 0):
-        raise NotImplementedError("vector field calculations no implemented on skewed grids")
-    D = np.where(grid.data_mask, grid[:,:].astype(np.float32), np.nan)
-    u, v = _normed_potential_vectors(D, res=grid.resolution)
-    return (RegularGrid(grid.transform, u, crs=grid.crs, nodata_value=np.nan),
-            RegularGrid(grid.transform, v, crs=grid.crs, nodata_value=np.nan))
+    result = terrain(grid, ("gradient", "slope"))
+    scale = result["slope"].max()
+    u, v = result["gradient"]
+    nrows = max(1, REDUCTION_CELLS // grid.size[1])
+    for g in (u, v):
+        b = g.bands[0]
+        for i in range(0, g.size[0], nrows):
+            i1 = min(i+nrows, g.size[0])
+            b[i:i1, :] = b[i:i1, :] / scale
+    return u, v
+
+def _percentiles(grid, q, bins=4096):
+    """ Return the percentiles *q* of the valid values of a single-band grid
+    without holding them in memory. A first pass histograms the values, and a
+    second pass gathers the values in the bins containing the required order
+    statistics, so that the result matches `numpy.percentile`. """
+    vmin, vmax = grid.min(), grid.max()
+    if not vmin < vmax:
+        return np.full(len(q), vmin, dtype=np.float64)
+    band = grid.bands[0]
+
+    def strips():
+        for strip in grid._iterstrips(band):
+            values = np.asarray(strip, dtype=np.float64).ravel()
+            values = values[~(np.isnan(values) |
+                              isnodata(values, grid.nodata))]
+            idx = np.minimum(((values-vmin) / (vmax-vmin) * bins).astype(np.int64),
+                             bins-1)
+            yield values, idx
+
+    counts = np.zeros(bins, dtype=np.int64)
+    for _, idx in strips():
+        counts += np.bincount(idx, minlength=bins)
+    cum = np.cumsum(counts)
+    ranks = np.asarray(q, dtype=np.float64) / 100.0 * (cum[-1]-1)
+    lo = np.floor(ranks).astype(np.int64)
+    hi = np.ceil(ranks).astype(np.int64)
+    bin_lo = np.searchsorted(cum, lo, side="right")
+    bin_hi = np.searchsorted(cum, hi, side="right")
+
+    wanted = np.zeros(bins, dtype=bool)
+    wanted[bin_lo] = True
+    wanted[bin_hi] = True
+    gathered = np.sort(np.concatenate([values[wanted[idx]]
+                                       for values, idx in strips()]))
+    before = cum - counts
+    position = np.cumsum(np.where(wanted, counts, 0)) - np.where(wanted, counts, 0)
+    vlo = gathered[lo - before[bin_lo] + position[bin_lo]]
+    vhi = gathered[hi - before[bin_hi] + position[bin_hi]]
+    return vlo + (ranks-lo) * (vhi-vlo)
 
 def hillshade(grid, azimuth=330.0, elevation=60.0):
     """ Return a hill-shaded version of *grid*.
@@ -194,29 +279,155 @@ def hillshade(grid, azimuth=330.0, elevation=60.0):
     elevation : float, optional
         height of light source (default 60.0)
 
-    Note: Currently assumes orthogonal coordinates.
+    Note: Currently assumes orthogonal coordinates. Values are clipped to the
+    2nd and 98th percentiles. Use `terrain` for unclipped values.
+    """
+    shade = terrain(grid, ("hillshade",), azimuth=azimuth,
+                    elevation=elevation)["hillshade"]
+    q = _percentiles(shade, [2, 98])
+    b = shade.bands[0]
+    nrows = max(1, REDUCTION_CELLS // shade.size[1])
+    for i in range(0, shade.size[0], nrows):
+        i1 = min(i+nrows, shade.size[0])
+        values = b[i:i1, :]
+        b[i:i1, :] = np.where(isnodata(values, shade.nodata), values,
+                              np.clip(values, q[0], q[1]))
+    return shade
+
+def _viewshed_counts(grid, x, y, observer_height, target_height, radius,
+                     curvature, refraction, band):
+    """ Return an int32 band counting the observers at *x*, *y* that see each
+    cell. Observers are processed in groups falling within tiles of
+    VIEWSHED_TILE cells, and for each group only the part of the grid within
+    *radius* of the tile is read. """
+    if grid.transform[4:] != (0, 0):
+        raise NotImplementedError("viewshed calculations not implemented on "
+                                  "skewed grids")
+    if radius is not None and radius <= 0:
+        raise ValueError("radius must be positive")
+    rows, cols = grid.get_indices(np.atleast_1d(x), np.atleast_1d(y))
+    rows = np.atleast_1d(rows).astype(np.int64)
+    cols = np.atleast_1d(cols).astype(np.int64)
+
+    dx, dy = (abs(r) for r in grid.resolution)
+    ny, nx = grid.size
+    if radius is None:
+        radius = np.inf
+        ri, rj = ny, nx
+        tile = max(ny, nx)
+    else:
+        ri = int(np.ceil(radius / dy))
+        rj = int(np.ceil(radius / dx))
+        tile = VIEWSHED_TILE
+    coeff = (1.0 - refraction) / (2.0 * EARTH_RADIUS) if curvature else 0.0
+
+    bandclass, bandkwargs = grid._output_bandclass()
+    out = bandclass(grid.size, np.int32, initval=0, **bandkwargs)
+    src = grid.bands[band]
+
+    groups = {}
+    for k, key in enumerate(zip(rows // tile, cols // tile)):
+        groups.setdefault(key, []).append(k)
+    for key in sorted(groups):
+        members = np.array(groups[key])
+        gr, gc = rows[members], cols[members]
+        i0 = max(gr.min()-ri, 0)
+        i1 = min(gr.max()+ri+1, ny)
+        j0 = max(gc.min()-rj, 0)
+        j1 = min(gc.max()+rj+1, nx)
+
+        z = grid._read_window(src, i0, i1, j0, j1).astype(np.float64)
+        nodata = isnodata(z, grid.nodata)
+        if nodata is not None:
+            z[nodata] = np.nan
+        counts = np.zeros(z.shape, dtype=np.int32)
+        crfuncs.viewshed_count(z, gr-i0, gc-j0, observer_height,
+                               target_height, dx, dy, radius, coeff, counts)
+        out[i0:i1, j0:j1] = grid._read_window(out, i0, i1, j0, j1) + counts
+    return out
+
+def viewshed(grid, x, y, observer_height=0.0, target_height=0.0, radius=None,
+             curvature=False, refraction=0.13, band=0):
+    """ Return the viewshed of an observer at (*x*, *y*) on a digital elevation
+    model.
+
+    Parameters
+    ----------
+    grid : RegularGrid
+        elevation model, with no skew and horizontal units equal to elevation
+        units
+    x, y : float
+        observer location
+    observer_height : float, optional
+        height of the observer above the terrain (default 0)
+    target_height : float, optional
+        height above the terrain of the targets being observed (default 0)
+    radius : float, optional
+        maximum distance of visible cells. Only the part of the grid within
+        *radius* of the observer is read. (default unlimited)
+    curvature : bool, optional
+        whether to correct elevations for the curvature of the Earth, which
+        requires units of meters (default False)
+    refraction : float, optional
+        atmospheric refraction coefficient used with *curvature* (default 0.13)
+    band : int, optional
+        band containing elevations (default 0)
+
+    Returns
+    -------
+    RegularGrid with values of 1 for visible cells and 0 elsewhere
+
+    Notes
+    -----
+    Lines of sight are traced with the R2 algorithm, which visits each cell
+    within *radius* a bounded number of times.
     """
-    dxgrid, dygrid = gradient(grid)
-    dx = dxgrid[:,:]
-    dy = dygrid[:,:]
-    res = grid.resolution
-    u = np.array((res[0] * np.ones_like(dx), np.zeros_like(dx), dx))
-    v = np.array((np.zeros_like(dy), res[1] * np.ones_like(dy), dy))
-    w = np.cross(u, v, axisa=0, axisb=0)
-    wunit = w / np.atleast_3d(np.sqrt(np.sum(w**2, axis=-1)))
-
-    s = np.array((np.cos(azimuth*np.pi/180.0),
-                  np.sin(azimuth*np.pi/180.0),
-                  np.sin(elevation*np.pi/180.0)))
-    smat = s*np.ones([wunit.shape[0], wunit.shape[1], 3])
-    dprod = (wunit*smat).sum(axis=-1)
-
-    q = np.percentile(dprod[~np.isnan(dprod)], [2, 98])
-    np.clip(dprod, q[0], q[1], out=dprod)
-
-    return RegularGrid(grid.transform, values=dprod, crs=grid.crs)
-
-def viewshed(D, i, j, r=-1):
-    """ Return the viewshed on *D* at (i,j).
+    counts = _viewshed_counts(grid, x, y, observer_height, target_height,
+                              radius, curvature, refraction, band)
+    bandclass, bandkwargs = grid._output_bandclass()
+    out = bandclass(grid.size, np.uint8, **bandkwargs)
+    nrows = max(1, REDUCTION_CELLS // grid.size[1])
+    for i in range(0, grid.size[0], nrows):
+        i1 = min(i+nrows, grid.size[0])
+        out[i:i1, :] = grid._read_window(counts, i, i1, 0, grid.size[1]) != 0
+    return RegularGrid(grid.transform, bands=[out], crs=grid.crs)
+
+def cumulative_viewshed(grid, x, y, observer_height=0.0, target_height=0.0,
+                        radius=None, curvature=False, refraction=0.13, band=0):
+    """ Return the number of observers at (*x*, *y*) that can see each cell
+    of a digital elevation model.
+
+    Parameters
+    ----------
+    grid : RegularGrid
+        elevation model, with no skew and horizontal units equal to elevation
+        units
+    x, y : vectors of floats
+        observer locations
+    observer_height : float, optional
+        height of the observers above the terrain (default 0)
+    target_height : float, optional
+        height above the terrain of the targets being observed (default 0)
+    radius : float, optional
+        maximum distance of visible cells. Observers are processed in groups,
+        each reading only the part of the grid within *radius*. (default
+        unlimited)
+    curvature : bool, optional
+        whether to correct elevations for the curvature of the Earth, which
+        requires units of meters (default False)
+    refraction : float, optional
+        atmospheric refraction coefficient used with *curvature* (default 0.13)
+    band : int, optional
+        band containing elevations (default 0)
+
+    Returns
+    -------
+    RegularGrid of int32 observer counts
+
+    See Also
+    --------
+    viewshed
     """
-    raise NotImplementedError()
+    counts = _viewshed_counts(grid, x, y, observer_height, target_height,
+                              radius, curvature, refraction, band)
+    return RegularGrid(grid.transform, bands=[counts], crs=grid.crs)
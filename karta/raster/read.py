@@ -38,8 +38,12 @@ def read_gtiff(fnm, in_memory=True, ibands=_gtiff.ALL, **kw):
         band(s) to open (default all)
     bandclass : Band class, optional
         class of band used by returned grid (default karta.band.CompressedBand)
-        if in_memory is True, this parameter is ignored and the returned grid
+        if in_memory is False, this parameter is ignored and the returned grid
         will have bands of type karta.raster._gtiff.GdalFileBand
+    bandkwargs : dict, optional
+        keyword arguments passed to *bandclass*, e.g.
+        ``dict(compressor="lz4", clevel=5, shuffle="bit", chunksize=(512, 512))``
+        for a CompressedBand
     """
     bands, hdr = _gtiff.read(fnm, in_memory, ibands, **kw)
 
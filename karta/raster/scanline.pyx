@@ -0,0 +1,205 @@
+""" Scanline rasterization of polygon edges.
+
+Edges are given as rows of (y0, x0, y1, x1) in cell-edge coordinates, in which
+cell (i, j) spans [i, i+1) x [j, j+1). Each function fills a strip of rows
+beginning at *row0*, so that large grids can be rasterized a strip at a time.
+Rings should be oriented so that exteriors wind in one direction and holes in
+the other.
+"""
+
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.math cimport floor, ceil, fmin, fmax
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def winding_strip(double[:,:] edges not None, int row0, int[:,:] out not None):
+    """ Compute the winding number of *edges* around each cell center in the
+    strip *out*. Cells with nonzero winding number are inside the polygon. """
+    cdef int ny = out.shape[0]
+    cdef int nx = out.shape[1]
+    cdef Py_ssize_t k
+    cdef int i, i0, i1, j, sign
+    cdef double ya, xa, yb, xb, yc, x
+    cdef int[:,:] delta = np.zeros((ny, nx+1), dtype=np.int32)
+
+    if edges.shape[1] != 4:
+        raise ValueError("edges must have four columns")
+
+    with nogil:
+        for k in range(edges.shape[0]):
+            ya = edges[k,0] - row0
+            xa = edges[k,1]
+            yb = edges[k,2] - row0
+            xb = edges[k,3]
+            if ya == yb:
+                continue
+            sign = 1
+            if ya > yb:
+                ya, yb = yb, ya
+                xa, xb = xb, xa
+                sign = -1
+            # rows whose centers lie in [ya, yb)
+            i0 = <int> ceil(ya - 0.5)
+            i1 = <int> ceil(yb - 0.5)
+            if i0 < 0:
+                i0 = 0
+            if i1 > ny:
+                i1 = ny
+            for i in range(i0, i1):
+                yc = i + 0.5
+                x = xa + (yc - ya) * (xb - xa) / (yb - ya)
+                # first cell whose center is right of the crossing
+                j = <int> floor(fmin(fmax(x, -1.0), nx) + 0.5)
+                if j < 0:
+                    j = 0
+                if j < nx:
+                    delta[i,j] += sign
+
+        for i in range(ny):
+            sign = 0
+            for j in range(nx):
+                sign += delta[i,j]
+                out[i,j] += sign
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void accumulate_row(double[:] acc, double x, double xnext,
+                                double d) noexcept nogil:
+    """ Add the signed area between an edge crossing a row from *x* to *xnext*
+    and the right edge of the row, with height *d*, to the accumulation
+    buffer *acc*. """
+    cdef double x0, x1, x0floor, x1ceil, xmf, s, x0f, x1f, a0, a1, a2, am
+    cdef int x0i, x1i, xi
+
+    if x < xnext:
+        x0, x1 = x, xnext
+    else:
+        x0, x1 = xnext, x
+    x0floor = floor(x0)
+    x0i = <int> x0floor
+    x1ceil = ceil(x1)
+    x1i = <int> x1ceil
+    if x1i <= x0i + 1:
+        xmf = 0.5 * (x + xnext) - x0floor
+        acc[x0i] += d - d * xmf
+        acc[x0i+1] += d * xmf
+    else:
+        s = 1.0 / (x1 - x0)
+        x0f = x0 - x0floor
+        a0 = 0.5 * s * (1.0 - x0f) * (1.0 - x0f)
+        x1f = x1 - x1ceil + 1.0
+        am = 0.5 * s * x1f * x1f
+        acc[x0i] += d * a0
+        if x1i == x0i + 2:
+            acc[x0i+1] += d * (1.0 - a0 - am)
+        else:
+            a1 = s * (1.5 - x0f)
+            acc[x0i+1] += d * (a1 - a0)
+            for xi in range(x0i+2, x1i-1):
+                acc[xi] += d * s
+            a2 = a1 + (x1i - x0i - 3) * s
+            acc[x1i-1] += d * (1.0 - a2 - am)
+        acc[x1i] += d * am
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void accumulate_edge(double[:,:] acc, double ya, double xa, double yb,
+                          double xb) noexcept nogil:
+    """ Accumulate the signed area to the right of a single edge lying within
+    columns [0, nx] into *acc*. """
+    cdef int ny = acc.shape[0]
+    cdef double sign = 1.0
+    cdef double dxdy, x, xnext, dy
+    cdef int i, i0, i1
+
+    if ya == yb:
+        return
+    if ya > yb:
+        ya, yb = yb, ya
+        xa, xb = xb, xa
+        sign = -1.0
+    dxdy = (xb - xa) / (yb - ya)
+    i0 = <int> floor(ya)
+    i1 = <int> ceil(yb)
+    if i0 < 0:
+        i0 = 0
+    if i1 > ny:
+        i1 = ny
+    x = xa + dxdy * (fmax(ya, i0) - ya)
+    for i in range(i0, i1):
+        dy = fmin(i + 1.0, yb) - fmax(<double> i, ya)
+        xnext = x + dxdy * dy
+        accumulate_row(acc[i], x, xnext, sign * dy)
+        x = xnext
+    return
+
+@cython.cdivision(True)
+cdef void accumulate_clipped(double[:,:] acc, double ya, double xa, double yb,
+                             double xb, int nx) noexcept nogil:
+    """ Accumulate an edge, splitting it where it leaves columns [0, nx]. The
+    parts outside are moved onto the grid boundary, where they contribute full
+    or no coverage to the cells beside them. """
+    cdef double t[4]
+    cdef double tmp, y0, x0, y1, x1
+    cdef int n = 1, k
+
+    t[0] = 0.0
+    if (xa < 0) != (xb < 0):
+        t[n] = -xa / (xb - xa)
+        n += 1
+    if (xa > nx) != (xb > nx):
+        t[n] = (nx - xa) / (xb - xa)
+        n += 1
+    if n == 3 and t[2] < t[1]:
+        tmp = t[1]
+        t[1] = t[2]
+        t[2] = tmp
+    t[n] = 1.0
+
+    for k in range(n):
+        y0 = ya + t[k] * (yb - ya)
+        x0 = fmin(fmax(xa + t[k] * (xb - xa), 0), nx)
+        y1 = ya + t[k+1] * (yb - ya)
+        x1 = fmin(fmax(xa + t[k+1] * (xb - xa), 0), nx)
+        accumulate_edge(acc, y0, x0, y1, x1)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def coverage_strip(double[:,:] edges not None, int row0,
+                   double[:,:] out not None):
+    """ Add the signed fraction of each cell in the strip *out* covered by the
+    polygon bounded by *edges*. Coverage is exact for non-overlapping rings.
+    """
+    cdef int ny = out.shape[0]
+    cdef int nx = out.shape[1]
+    cdef Py_ssize_t k
+    cdef int i, j
+    cdef double ya, xa, yb, xb, total
+    cdef double[:,:] acc = np.zeros((ny, nx+2), dtype=np.float64)
+
+    if edges.shape[1] != 4:
+        raise ValueError("edges must have four columns")
+
+    with nogil:
+        for k in range(edges.shape[0]):
+            ya = edges[k,0] - row0
+            xa = edges[k,1]
+            yb = edges[k,2] - row0
+            xb = edges[k,3]
+            accumulate_clipped(acc, ya, xa, yb, xb, nx)
+
+        for i in range(ny):
+            total = 0.0
+            for j in range(nx):
+                total += acc[i,j]
+                out[i,j] += total
+    return
@@ -53,6 +53,8 @@ class build_ext(_build_ext):
 
 # File extension is added to sources at overloaded build_ext.run()
 extensions = [Extension("karta.raster.crfuncs", ["karta/raster/crfuncs.pyx"]),
+              Extension("karta.raster.scanline", ["karta/raster/scanline.pyx"]),
+              Extension("karta.raster.flow", ["karta/raster/flow.pyx"]),
               Extension("karta.vector.coordstring", ["karta/vector/coordstring.pyx"]),
               Extension("karta.vector.vectorgeo", ["karta/vector/vectorgeo.pyx"]),
               Extension("karta.vector.dateline", ["karta/vector/dateline.pyx"]),
@@ -65,8 +67,8 @@ extensions = [Extension("karta.raster.crfuncs", ["karta/raster/crfuncs.pyx"]),
 setup(
     name = "karta",
     version = VERSION,
-    setup_requires = ["numpy>=1.6"],
-    install_requires = ["numpy>=1.6", "pyproj>=1.9", "gdal>=1.10", "blosc>=1.2.8"],
+    setup_requires = ["numpy>=1.13"],
+    install_requires = ["numpy>=1.13", "pyproj>=1.9", "gdal>=1.10", "blosc>=1.2.8"],
     author = "Nat Wilson",
     author_email = "njwilson23@gmail.com",
     packages = ["karta", "karta.vector", "karta.raster"],
@@ -1,8 +1,10 @@
 import unittest
 import numpy as np
 
-from karta.raster import SimpleBand, CompressedBand
-from karta.raster.band import BandIndexer
+import os
+import copy
+from karta.raster import SimpleBand, CompressedBand, MemmapBand
+from karta.raster.band import BandIndexer, ChunkCache
 
 class GenericBandTests(object):
     """ Tests that all Band classes must pass """
@@ -42,6 +44,68 @@ class GenericBandTests(object):
 
         self.assertEqual(np.sum(band[::2,128:960:3]-d), 0.0)
 
+    def test_get_masked(self):
+        np.random.seed(49)
+        d = np.random.rand(700, 600)
+        mask = d > 0.7
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        self.assertTrue(np.all(band[mask] == d[mask]))
+
+    def test_set_masked(self):
+        np.random.seed(49)
+        d = np.random.rand(700, 600)
+        mask = d > 0.7
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        band[mask] = -1.0
+        band[~mask] = 2*d[~mask]
+        d[mask] = -1.0
+        d[~mask] *= 2
+        self.assertTrue(np.all(band[:,:] == d))
+
+    def test_get_indices(self):
+        np.random.seed(49)
+        d = np.random.rand(700, 600)
+        I = np.random.randint(0, 700, 500)
+        J = np.random.randint(0, 600, 500)
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        self.assertTrue(np.all(band[I, J] == d[I, J]))
+        self.assertTrue(np.all(band[I.reshape(20, 25), J.reshape(20, 25)] ==
+                               d[I, J].reshape(20, 25)))
+
+    def test_set_indices(self):
+        np.random.seed(49)
+        d = np.random.rand(700, 600)
+        I = np.random.randint(0, 700, 500)
+        J = np.random.randint(0, 600, 500)
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        band[I, J] = np.arange(500.0)
+        d[I, J] = np.arange(500.0)
+        self.assertTrue(np.all(band[:,:] == d))
+
+    def test_get_rows(self):
+        d = np.arange(700*600, dtype=np.float64).reshape(700, 600)
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        rows = np.array([1, 300, 699, 300])
+        self.assertTrue(np.array_equal(band[rows], d[rows]))
+        self.assertTrue(np.array_equal(band[rows.reshape(2, 2)],
+                                       d[rows.reshape(2, 2)]))
+
+    def test_set_rows(self):
+        d = np.arange(700*600, dtype=np.float64).reshape(700, 600)
+        band = self.type((700, 600), np.float64, **self.initkwargs)
+        band[:,:] = d
+        rows = np.array([1, 300, 699])
+        band[rows] = -1.0
+        d[rows] = -1.0
+        band[rows[:2]] = np.ones((2, 600))
+        d[rows[:2]] = np.ones((2, 600))
+        self.assertTrue(np.array_equal(band[:,:], d))
+
 
 
 class SimpleBandTests(unittest.TestCase, GenericBandTests):
@@ -57,6 +121,240 @@ class CompressedBandTests(unittest.TestCase, GenericBandTests):
         self.type = CompressedBand
         self.initkwargs = dict(chunksize=(256, 256))
 
+    def test_cache_repeated_reads(self):
+        band = CompressedBand((512, 512), np.float64, chunksize=(256, 256))
+        band[:,:] = np.arange(512*512, dtype=np.float64).reshape(512, 512)
+        band.cache.clear()
+        for i in range(256):
+            band[i,:]
+        self.assertEqual(band.cache.misses, 2)
+        self.assertEqual(band.cache.hits, 510)
+        return
+
+    def test_cache_invalidated_on_write(self):
+        band = CompressedBand((512, 512), np.float64, chunksize=(256, 256))
+        band[:,:] = np.zeros((512, 512))
+        self.assertEqual(band[10, 10], 0.0)
+        band[5:15, 5:15] = np.ones((10, 10))
+        self.assertEqual(band[10, 10], 1.0)
+        self.assertEqual(np.sum(band[:,:]), 100.0)
+        return
+
+    def test_cache_disabled(self):
+        band = CompressedBand((512, 512), np.float64, chunksize=(256, 256),
+                              cachesize=0)
+        band[:,:] = np.ones((512, 512))
+        band[:,:]
+        band[:,:]
+        self.assertEqual(len(band.cache), 0)
+        self.assertEqual(band.cache.hits, 0)
+        return
+
+    def test_masked_touches_selected_chunks(self):
+        band = CompressedBand((1024, 1024), np.float64, chunksize=(256, 256))
+        mask = np.zeros((1024, 1024), dtype=np.bool)
+        mask[300:400, 600:700] = True
+        band[mask] = 1.0
+        self.assertEqual(np.sum(band.chunkstatus), 1)
+        self.assertEqual(band.chunkstatus[6], band.CHUNKSET)
+        self.assertEqual(np.sum(band[mask]), 10000.0)
+        return
+
+    def test_initval_constant_chunks(self):
+        band = CompressedBand((1000, 1000), np.float64, chunksize=(256, 256),
+                              initval=np.nan)
+        self.assertTrue(np.all(band.chunkstatus == band.CHUNKCONST))
+        self.assertEqual(band.nbytes, 0)
+        self.assertTrue(np.all(np.isnan(band[:,:])))
+
+        band[300:310, 300:310] = np.ones((10, 10))
+        self.assertEqual(np.sum(band.chunkstatus == band.CHUNKSET), 1)
+        self.assertEqual(np.nansum(band[:,:]), 100.0)
+        self.assertTrue(np.isnan(band[299, 300]))
+        return
+
+    def test_constant_write_not_compressed(self):
+        band = CompressedBand((1000, 1000), np.int16, chunksize=(256, 256))
+        band[:,:] = np.arange(1000*1000).reshape(1000, 1000).astype(np.int16)
+        band[:512, :] = -9999*np.ones((512, 1000), dtype=np.int16)
+        self.assertTrue(np.all(band.chunkstatus[:8] == band.CHUNKCONST))
+        self.assertTrue(np.all(band.chunkstatus[8:] == band.CHUNKSET))
+        self.assertTrue(np.all(band[:512, :] == -9999))
+        self.assertTrue(np.all(band[512:, :] ==
+            np.arange(1000*1000).reshape(1000, 1000).astype(np.int16)[512:]))
+        return
+
+    def test_codec_options(self):
+        x, y = np.meshgrid(np.arange(700), np.arange(600))
+        d = (np.sin(x/50.0) * np.cos(y/70.0)).astype(np.float32)
+        for cname in ("blosclz", "lz4", "zlib"):
+            for shuffle in ("none", "byte", "bit"):
+                band = CompressedBand((600, 700), np.float32,
+                                      chunksize=(100, 128), compressor=cname,
+                                      clevel=5, shuffle=shuffle)
+                band[:,:] = d
+                self.assertTrue(np.all(band[:,:] == d))
+        return
+
+    def test_codec_invalid(self):
+        with self.assertRaises(ValueError):
+            CompressedBand((64, 64), np.float32, compressor="notacodec")
+        with self.assertRaises(ValueError):
+            CompressedBand((64, 64), np.float32, shuffle="sideways")
+        with self.assertRaises(ValueError):
+            CompressedBand((64, 64), np.float32, clevel=10)
+        return
+
+    def test_compression_stats(self):
+        band = CompressedBand((512, 512), np.float64, chunksize=(256, 256),
+                              cachesize=0)
+        band[:,:] = np.tile(np.arange(512, dtype=np.float64), (512, 1))
+        band[:,:]
+        self.assertTrue(band.compression_ratio > 1.0)
+        self.assertTrue(band.encode_time > 0.0)
+        self.assertTrue(band.decode_time > 0.0)
+        return
+
+    def test_uncached_reads(self):
+        # with caching disabled, chunks are decompressed directly into the
+        # output when possible, and otherwise through a scratch buffer
+        d = np.arange(600*256, dtype=np.float32).reshape(600, 256)
+        band = CompressedBand((600, 256), np.float32, chunksize=(256, 256),
+                              cachesize=0)
+        band[:,:] = d
+        self.assertTrue(np.all(band[:,:] == d))
+        self.assertTrue(np.all(band[100:550, 10:200] == d[100:550, 10:200]))
+        self.assertEqual(len(band.cache), 0)
+        return
+
+    def test_covered_chunks_bypass_cache(self):
+        # chunks covered by the request are decompressed into the output or a
+        # scratch buffer, while partially read chunks are cached
+        d = np.arange(600*512, dtype=np.float32).reshape(600, 512)
+        band = CompressedBand((600, 512), np.float32, chunksize=(256, 256))
+        band[:,:] = d
+        band.cache.clear()
+        self.assertTrue(np.all(band[:,:] == d))
+        self.assertTrue(np.all(band[:256,:256] == d[:256,:256]))
+        self.assertEqual(len(band.cache), 0)
+        self.assertTrue(np.all(band[100:550, 10:300] == d[100:550, 10:300]))
+        self.assertEqual(len(band.cache), 6)
+        return
+
+    def test_decompress_into_invalid_output(self):
+        band = CompressedBand((512, 512), np.float32, chunksize=(256, 256))
+        band[:,:] = np.ones((512, 512), dtype=np.float32)
+        band[:1,:1] = np.zeros((1, 1), dtype=np.float32)
+        with self.assertRaises(ValueError):
+            band._decompress(0, out=np.empty((256, 256), dtype=np.float64))
+        with self.assertRaises(ValueError):
+            band._decompress(0, out=np.empty((256, 512), dtype=np.float32)[:,::2])
+        return
+
+    def test_chunk_statistics(self):
+        d = np.arange(300*200, dtype=np.float64).reshape(300, 200)
+        band = CompressedBand((300, 200), np.float64, chunksize=(128, 128))
+        band[:,:] = d
+        band[:128, :128] = np.full((128, 128), 7.0)
+        stats = band.chunk_statistics()
+        self.assertEqual(len(stats), 6)
+        self.assertEqual(stats["count"].sum(), 300*200)
+        self.assertEqual(stats["min"][0], 7.0)
+        self.assertEqual(stats["max"][0], 7.0)
+        self.assertEqual(stats["m2"][0], 0.0)
+        self.assertEqual(stats["max"][5], d[256:, 128:].max())
+        self.assertEqual(stats["sum"][5], d[256:, 128:].sum())
+        self.assertTrue(np.isclose(stats["m2"][5], d[256:, 128:].var()*44*72))
+        return
+
+    def test_chunk_statistics_nodata(self):
+        band = CompressedBand((300, 200), np.int16, chunksize=(128, 128),
+                              initval=-1)
+        band[10:20, 10:20] = np.arange(100, dtype=np.int16).reshape(10, 10)
+        band.nodata = -1
+        stats = band.chunk_statistics()
+        self.assertEqual(stats["count"].sum(), 100)
+        self.assertEqual(stats["nnodata"].sum(), 300*200-100)
+        self.assertEqual(stats["max"][0], 99)
+        self.assertTrue(np.isnan(stats["max"][1]))
+
+        # statistics are recomputed when the nodata value changes
+        band.nodata = 0
+        stats = band.chunk_statistics()
+        self.assertEqual(stats["count"].sum(), 300*200-1)
+        self.assertEqual(stats["min"][0], -1)
+        return
+
+class ChunkCacheTests(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ChunkCache(3*800)
+        for i in range(3):
+            cache.put(i, np.zeros(100))
+        cache.get(0)
+        cache.put(3, np.zeros(100))
+        self.assertTrue(0 in cache)
+        self.assertFalse(1 in cache)
+        self.assertEqual(cache.nbytes, 2400)
+        return
+
+    def test_resize(self):
+        cache = ChunkCache(3*800)
+        for i in range(3):
+            cache.put(i, np.zeros(100))
+        cache.resize(800)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(2 in cache)
+        return
+
+    def test_oversized_entry_ignored(self):
+        cache = ChunkCache(100)
+        cache.put(0, np.zeros(100))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+        return
+
+class CompressedBandThreadedTests(unittest.TestCase, GenericBandTests):
+
+    def setUp(self):
+        self.type = CompressedBand
+        self.initkwargs = dict(chunksize=(256, 256), threads=4)
+
+    def test_overwrite_chunks(self):
+        band = self.type((1000, 1000), np.float64, **self.initkwargs)
+        band[:,:] = np.ones((1000, 1000))
+        band.cache.clear()
+        band[100:900, 100:900] = np.zeros((800, 800))
+        self.assertEqual(np.sum(band[:,:]), 1000**2 - 800**2)
+        return
+
+class MemmapBandTests(unittest.TestCase, GenericBandTests):
+
+    def setUp(self):
+        self.type = MemmapBand
+        self.initkwargs = dict()
+
+    def test_initval(self):
+        band = MemmapBand((300, 200), np.float32, initval=-9999)
+        self.assertTrue(np.all(band[:,:] == -9999))
+        return
+
+    def test_scratch_file_removed(self):
+        band = MemmapBand((64, 64), np.float64)
+        fnm = band.filename
+        self.assertTrue(os.path.isfile(fnm))
+        del band
+        self.assertFalse(os.path.isfile(fnm))
+        return
+
+    def test_deepcopy(self):
+        band = MemmapBand((64, 64), np.float64, initval=3.0)
+        band2 = copy.deepcopy(band)
+        band2[:,:] = 4.0
+        self.assertNotEqual(band.filename, band2.filename)
+        self.assertTrue(np.all(band[:,:] == 3.0))
+        return
+
 class BandIndexerTests(unittest.TestCase):
 
     def test_get_masked(self):
@@ -26,5 +26,70 @@ class TestCrfuncs(unittest.TestCase):
         self.assertEqual(arr[22, 32], -999.0)
         self.assertEqual(np.sum(np.abs(Zorig[arr!=-999] - arr[arr!=-999])), 0.0)
 
+    def test_bin_points(self):
+        cells = np.array([0, 2, 2, 0, 2], dtype=np.int64)
+        Z = np.array([1.0, 4.0, np.nan, 3.0, -2.0])
+        count = np.zeros(3, dtype=np.int64)
+        mean = np.zeros(3)
+        vmin = np.zeros(3)
+        last = np.zeros(3)
+        crfuncs.bin_points(cells, Z, count, mean=mean, vmin=vmin, last=last)
+        self.assertEqual(list(count), [2, 0, 2])
+        self.assertEqual(mean[0], 2.0)
+        self.assertEqual(mean[2], 1.0)
+        self.assertEqual(vmin[2], -2.0)
+        self.assertEqual(last[0], 3.0)
+        self.assertRaises(IndexError, crfuncs.bin_points,
+                          np.array([3], dtype=np.int64), np.array([1.0]), count)
+        return
+
+    def test_interpolate_linear(self):
+        yy, xx = np.mgrid[0:30, 0:40].astype(np.float64)
+        arr = 2*xx + 3*yy + 1
+        I = np.array([3.0, 4.25, 10.5, 25.9])
+        J = np.array([3.0, 7.75, 20.0, 35.1])
+        for method in ("bilinear", "cubic"):
+            z = crfuncs.interpolate(arr, I, J, np.nan, method)
+            self.assertTrue(np.allclose(z, 2*J + 3*I + 1))
+        z = crfuncs.interpolate(arr, I, J, np.nan, "lanczos")
+        self.assertTrue(np.allclose(z, 2*J + 3*I + 1, rtol=1e-2))
+        return
+
+    def test_interpolate_nodata(self):
+        arr = np.ones((10, 10), dtype=np.float64)
+        arr[5, 5] = -999.0
+        I = np.array([5.1, 5.6, 3.0])
+        J = np.array([5.1, 5.6, 3.0])
+        for method in ("bilinear", "cubic", "lanczos"):
+            z = crfuncs.interpolate(arr, I, J, -999.0, method)
+            self.assertEqual(z[0], -999.0)
+            self.assertAlmostEqual(z[1], 1.0)
+            self.assertAlmostEqual(z[2], 1.0)
+        return
+
+    def test_interpolate_edges(self):
+        arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+        z = crfuncs.interpolate(arr, np.array([-0.4, 2.4]),
+                                np.array([0.0, 3.0]), np.nan, "bilinear")
+        self.assertEqual(list(z), [0.0, 11.0])
+        with self.assertRaises(ValueError):
+            crfuncs.interpolate(arr, np.array([0.0]), np.array([0.0]),
+                                np.nan, "quintic")
+        return
+
+    def test_interpolate_bands(self):
+        yy, xx = np.mgrid[0:30, 0:40].astype(np.float64)
+        arr = np.array([xx, yy, xx+yy])
+        arr[1, 10, 10] = -1.0
+        I = np.array([5.5, 10.2])
+        J = np.array([7.25, 10.1])
+        z = crfuncs.interpolate_bands(arr, I, J, -1.0, "bilinear")
+        self.assertEqual(z.shape, (2, 3))
+        self.assertTrue(np.allclose(z[:,0], J))
+        self.assertTrue(np.allclose(z[:,2], I+J))
+        self.assertEqual(z[0,1], 5.5)
+        self.assertEqual(z[1,1], -1.0)
+        return
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,138 @@
+""" Unit tests for lazy grid expressions """
+
+import unittest
+import numpy as np
+
+import karta
+from karta.raster import where
+from karta.errors import NonEquivalentGridError
+
+class GridExpressionTests(unittest.TestCase):
+
+    def setUp(self):
+        values = np.random.RandomState(42).rand(300, 200, 4)
+        values[10:20, 30:40, 0] = -1
+        self.values = values
+        self.grid = karta.RegularGrid((0.0, 0.0, 10.0, 10.0, 0.0, 0.0),
+                                      values=values, nodata_value=-1.0)
+        return
+
+    def test_operators_are_lazy(self):
+        expr = self.grid * 2 + 1
+        self.assertTrue(isinstance(expr, karta.raster.GridExpression))
+        self.assertEqual(expr.transform, self.grid.transform)
+        self.assertEqual(expr.size, self.grid.size)
+        return
+
+    def test_compute_band_ratio(self):
+        a = self.grid.as_expression(0)
+        b = self.grid.as_expression(3)
+        result = ((a - b) / (a + b)).compute(size=(64, 64))
+        v = self.values
+        expected = (v[:,:,0] - v[:,:,3]) / (v[:,:,0] + v[:,:,3])
+        expected[10:20, 30:40] = -1
+        self.assertEqual(len(result.bands), 1)
+        self.assertEqual(result.nodata, -1.0)
+        self.assertTrue(np.allclose(result[:,:], expected))
+        return
+
+    def test_multiband_ufunc(self):
+        result = np.sqrt(self.grid)
+        self.assertEqual(result[:,:].shape, (300, 200, 4))
+        self.assertTrue(np.allclose(result[50:60, 50:60],
+                                    np.sqrt(self.values[50:60, 50:60])))
+        self.assertEqual(result[15, 35][0], -1.0)
+        return
+
+    def test_comparison_nodata(self):
+        result = (self.grid.as_expression(0) > 0.5).compute()
+        self.assertEqual(result.bands[0].dtype, np.uint8)
+        self.assertEqual(result.nodata, 255)
+        values = result[:,:]
+        self.assertTrue(np.all(values[10:20, 30:40] == 255))
+        self.assertTrue(np.all(values[100:] == (self.values[100:,:,0] > 0.5)))
+        return
+
+    def test_where(self):
+        a = self.grid.as_expression(0)
+        result = where(a > 0.5, self.grid.as_expression(1), 0.0)[:,:]
+        expected = np.where(self.values[:,:,0] > 0.5, self.values[:,:,1], 0.0)
+        expected[10:20, 30:40] = -1
+        self.assertTrue(np.allclose(result, expected))
+        return
+
+    def test_sample(self):
+        expr = self.grid.as_expression(2) * 10
+        z = expr.sample(np.array([5.0, 105.0]), np.array([5.0, 2005.0]))
+        self.assertTrue(np.allclose(z, 10*self.values[[0, 200], [0, 10], 2]))
+        return
+
+    def test_setitem_expression(self):
+        out = karta.RegularGrid(self.grid.transform,
+                                values=np.zeros((300, 200)), nodata_value=-9.0)
+        out[:,:] = self.grid.as_expression(0) - 1
+        self.assertTrue(np.all(out[10:20, 30:40] == -9.0))
+        self.assertTrue(np.allclose(out[100:,:], self.values[100:,:,0] - 1))
+        return
+
+    def test_setitem_expression_mask(self):
+        values = np.arange(600, dtype=np.float64).reshape(30, 20)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values)
+        other = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                  values=np.ones((30, 20)))
+        mask = values > 300
+        grid[mask] = grid + other
+        self.assertTrue(np.array_equal(grid[:,:],
+                                       np.where(mask, values+1, values)))
+        return
+
+    def test_setitem_expression_mask_chunked(self):
+        values = np.arange(1024*300, dtype=np.float64).reshape(1024, 300)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values)
+        other = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                  values=np.ones((1024, 300)))
+        reads = []
+        for band in (grid.bands[0], other.bands[0]):
+            def getblock(yoff, xoff, size, _getblock=band._getblock):
+                reads.append(size)
+                return _getblock(yoff, xoff, size)
+            band._getblock = getblock
+
+        evalcells = karta.raster.expression.EVAL_CHUNK_CELLS
+        karta.raster.expression.EVAL_CHUNK_CELLS = 256*300
+        try:
+            mask = (values % 7) == 0
+            grid[mask] = grid + other
+        finally:
+            karta.raster.expression.EVAL_CHUNK_CELLS = evalcells
+        self.assertTrue(len(reads) > 0)
+        self.assertTrue(all(size[0] < 1024 for size in reads))
+        self.assertTrue(np.array_equal(grid.bands[0][:,:],
+                                       np.where(mask, values+1, values)))
+        return
+
+    def test_getitem_expression_mask(self):
+        values = np.arange(600, dtype=np.float64).reshape(30, 20)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values)
+        other = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                  values=np.ones((30, 20)))
+        mask = (values % 3) == 0
+        self.assertTrue(np.array_equal((grid - other)[mask],
+                                       values[mask] - 1))
+        empty = np.zeros((30, 20), dtype=np.bool_)
+        self.assertEqual((grid - other)[empty].shape, (0,))
+
+        mask = self.values[:,:,0] > 0.5
+        self.assertTrue(np.array_equal(np.sqrt(self.grid)[mask],
+                                       np.sqrt(self.values[mask])))
+        return
+
+    def test_nonequivalent_grids(self):
+        other = karta.RegularGrid((5.0, 0.0, 10.0, 10.0, 0.0, 0.0),
+                                  values=np.zeros((300, 200)))
+        with self.assertRaises(NonEquivalentGridError):
+            self.grid.as_expression(0) + other
+        return
+
+if __name__ == "__main__":
+    unittest.main()
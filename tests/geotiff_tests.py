@@ -58,6 +58,21 @@ class GdalTests(unittest.TestCase):
         self.assertTrue(np.all(g[:,:] == gnew[:,:]))
         return
 
+    def test_io_memmap(self):
+        v = peaks(500)[:100,:]
+        utm7 = karta.crs.ProjectedCRS("+proj=utm +zone=7 +north +datum=WGS84",
+                                      "UTM 7N (WGS 84)")
+        g = karta.RegularGrid([15.0, 15.0, 30.0, 30.0, 0.0, 0.0], v, crs=utm7)
+
+        fpath = os.path.join(TMPDATA, "test.tif")
+        g.to_gtiff(fpath, compress=None)
+        gnew = karta.read_gtiff(fpath, bandclass=karta.raster.MemmapBand)
+
+        self.assertTrue(isinstance(gnew.bands[0], karta.raster.MemmapBand))
+        self.assertEqual(g.transform, gnew.transform)
+        self.assertTrue(np.all(g[:,:] == gnew[:,:]))
+        return
+
     def test_write_compress(self):
         v = peaks(500)[:100,:]
         utm7 = karta.crs.ProjectedCRS("+proj=utm +zone=7 +north +datum=WGS84",
@@ -99,6 +114,14 @@ class GdalVirtualArrayTests(unittest.TestCase):
         for row in self.grid.values:
             pass
 
+    def test_sample_virtual(self):
+        v = peaks(500)[:100,:]
+        x = np.array([30.0, 4530.0, 15000.0])
+        y = np.array([30.0, 1500.0, 3000.0])
+        z = self.grid.sample_nearest(x, y)
+        self.assertTrue(np.allclose(z, v[[0, 49, 99], [0, 150, 499]]))
+        return
+
 
 def peaks(n=49):
     """ 2d peaks function of MATLAB logo fame. """
@@ -88,6 +88,61 @@ class RegularGridTests(unittest.TestCase):
         self.assertAlmostEqual(grid_combined[4,5], 2.33333333333)
         return
 
+    def test_merge_methods(self):
+        grid1 = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=np.ones([4, 4]))
+        grid2 = karta.RegularGrid([2, 2, 1, 1, 0, 0], values=2*np.ones([4, 4]))
+        v = 3*np.ones([2, 6])
+        v[0,0] = np.nan
+        grid3 = karta.RegularGrid([0, 3, 1, 1, 0, 0], values=v)
+        grids = [grid1, grid2, grid3]
+        for method, expected in (("first", [1, 1, 1, 2]), ("last", [1, 3, 3, 3]),
+                                 ("min", [1, 1, 1, 2]), ("max", [1, 3, 3, 3]),
+                                 ("mean", [1, 2, 2, 2.5])):
+            merged = karta.raster.merge(grids, method=method)
+            self.assertEqual(merged.size, (6, 6))
+            self.assertTrue(np.allclose([merged[3,0], merged[3,1], merged[3,3],
+                                         merged[4,4]], expected))
+            self.assertTrue(np.isnan(merged[0,5]))
+        return
+
+    def test_merge_unaligned(self):
+        # grids of a linear function at different resolutions and offsets
+        def linear(T, shape):
+            g = karta.RegularGrid(T, values=np.zeros(shape))
+            X, Y = g.center_coords()
+            return karta.RegularGrid(T, values=2*X + 3*Y)
+        grid1 = linear([0, 0, 1, 1, 0, 0], (20, 20))
+        grid2 = linear([10.25, 10.25, 0.5, 0.5, 0, 0], (30, 30))
+        merged = karta.raster.merge([grid1, grid2], method="last",
+                                    resampling="bilinear")
+        self.assertEqual(merged.transform, (0.0, 0.0, 1.0, 1.0, 0.0, 0.0))
+        self.assertEqual(merged.size, (26, 26))
+        X, Y = merged.center_coords()
+        values = merged[:,:]
+        valid = ~np.isnan(values)
+        # grid1 covers rows and columns 0-19, grid2 10-24
+        self.assertEqual(np.sum(valid), 400 + 225 - 100)
+        self.assertTrue(np.allclose(values[valid], (2*X + 3*Y)[valid]))
+        return
+
+    def test_merge_tiled(self):
+        np.random.seed(49)
+        grids = [karta.RegularGrid([30*k, 20*(k%3), 1, 1, 0, 0],
+                                   values=np.random.rand(40, 40))
+                 for k in range(6)]
+        expected = karta.raster.merge(grids, weights=np.arange(1, 7))
+        tile = karta.raster.grid.RESAMPLE_TILE
+        try:
+            karta.raster.grid.RESAMPLE_TILE = 16
+            merged = karta.raster.merge(grids, weights=np.arange(1, 7),
+                                        bandclass=karta.raster.CompressedBand,
+                                        bandkwargs=dict(chunksize=(16, 16)))
+        finally:
+            karta.raster.grid.RESAMPLE_TILE = tile
+        self.assertEqual(merged.size, (80, 190))
+        self.assertTrue(np.allclose(merged[:,:], expected[:,:], equal_nan=True))
+        return
+
     def test_resample(self):
         # use linear function so that nearest neighbour and linear interp are
         # exact
@@ -105,6 +160,74 @@ class RegularGridTests(unittest.TestCase):
         self.assertTrue(np.max(np.abs(residue)) < 1e-12)
         return
 
+    def test_resample_bilinear(self):
+        values = np.tile(np.arange(60.0), (40, 1))
+        grid = karta.RegularGrid((0.0, 0.0, 2.0, 2.0, 0.0, 0.0), values=values)
+        for method in ("bilinear", "cubic"):
+            gnew = grid.resample(1.0, 1.0, method=method)
+            self.assertEqual(gnew.size, (80, 120))
+            self.assertEqual(gnew.transform, (0.0, 0.0, 1.0, 1.0, 0.0, 0.0))
+            self.assertTrue(np.allclose(gnew[:,4:-4],
+                                        np.arange(1.75, 57.5, 0.5)[np.newaxis,:]))
+        return
+
+    def test_resample_aggregate(self):
+        values = peaks(90)[:60]
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values)
+        blocks = values.reshape(20, 3, 30, 3).swapaxes(1, 2).reshape(20, 30, 9)
+        for method, func in (("average", np.mean), ("min", np.min),
+                             ("max", np.max)):
+            gnew = grid.resample(3.0, 3.0, method=method)
+            self.assertEqual(gnew.size, (20, 30))
+            self.assertTrue(np.allclose(gnew[:,:], func(blocks, axis=2)))
+        return
+
+    def test_resample_average_fractional(self):
+        # the second 1.5x cell covers half of cell 1 and all of cell 2
+        values = np.arange(36.0).reshape(6, 6)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values)
+        gnew = grid.resample(1.5, 1.5, method="average")
+        self.assertEqual(gnew.size, (4, 4))
+        w = np.array([0.5, 1.0])
+        expected = (w[:,np.newaxis]*w*values[1:3,1:3]).sum() / w.sum()**2
+        self.assertAlmostEqual(gnew[1,1], expected)
+        return
+
+    def test_resample_mode_nodata(self):
+        values = np.array([[1, 1, 2, 5],
+                           [2, 3, 5, 5],
+                           [0, 0, 0, 0],
+                           [4, 0, 0, 0]], dtype=np.int32)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values,
+                                 nodata_value=0)
+        gnew = grid.resample(2.0, 2.0, method="mode")
+        self.assertEqual(gnew[:,:].dtype, np.int32)
+        self.assertTrue(np.all(gnew[:,:] == np.array([[1, 5], [4, 0]])))
+        gnew = grid.resample(2.0, 2.0, method="max")
+        self.assertTrue(np.all(gnew[:,:] == np.array([[3, 5], [4, 0]])))
+        gnew = grid.resample(2.0, 2.0, method="average")
+        self.assertTrue(np.allclose(gnew[:,:], [[1.75, 4.25], [4.0, 0.0]]))
+        return
+
+    def test_resample_tiled(self):
+        # results do not depend on how the output is divided into tiles
+        values = peaks(100)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), values=values,
+                                 bandclass=karta.raster.CompressedBand,
+                                 bandkwargs=dict(chunksize=(32, 32)))
+        tile = karta.raster.grid.RESAMPLE_TILE
+        for method in ("nearest", "bilinear", "average", "mode", "min"):
+            try:
+                karta.raster.grid.RESAMPLE_TILE = 1024
+                expected = grid.resample(2.5, 3.0, method=method)[:,:]
+                karta.raster.grid.RESAMPLE_TILE = 7
+                gnew = grid.resample(2.5, 3.0, method=method)
+            finally:
+                karta.raster.grid.RESAMPLE_TILE = tile
+            self.assertEqual(gnew.size, (33, 40))
+            self.assertTrue(np.allclose(gnew[:,:], expected))
+        return
+
     def test_sample_nearest(self):
         grid = karta.RegularGrid([0.0, 0.0, 1.0, 1.0, 0.0, 0.0],
                                  values=np.array([[0, 1], [1, 0.5]]))
@@ -154,6 +277,78 @@ class RegularGridTests(unittest.TestCase):
                           0.63265306122448983, 0.74052478134110788])
         return
 
+    def test_sample_reads_needed_chunks(self):
+        values = np.arange(1024*1024, dtype=np.float64).reshape(1024, 1024)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values)
+        band = grid.bands[0]
+        band.cache.clear()
+        x = np.array([10.5, 20.5, 900.5])
+        y = np.array([10.5, 600.5, 900.5])
+        z = grid.sample_nearest(x, y)
+        self.assertTrue(np.all(z == values[[10, 600, 900], [10, 20, 900]]))
+        self.assertEqual(band.cache.misses, 3)
+
+        z = grid.sample_bilinear(x+0.25, y)
+        self.assertTrue(np.allclose(z, values[[10, 600, 900], [10, 20, 900]]
+                                       + 0.25))
+        self.assertEqual(band.cache.misses, 3)
+        return
+
+    def test_sample_multiband(self):
+        values = np.dstack([peaks(n=30), 2*peaks(n=30)])
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values)
+        z = grid.sample_nearest(np.array([3.5, 10.5]), np.array([5.5, 20.5]))
+        self.assertEqual(z.shape, (2, 2))
+        self.assertTrue(np.all(z == values[[5, 20], [3, 10]]))
+        z = grid.sample_bilinear(np.array([3.5, 10.5]), np.array([5.5, 20.5]))
+        self.assertTrue(np.allclose(z, values[[5, 20], [3, 10]]))
+        return
+
+    def test_sample_kernels(self):
+        grid = karta.RegularGrid((0.0, 0.0, 10.0, 10.0, 0.0, 0.0),
+                                 values=np.tile(np.arange(100.0), (80, 1)))
+        x = np.array([55.0, 203.0, 777.7])
+        y = np.array([35.0, 400.0, 12.5])
+        for method in ("bilinear", "cubic", "lanczos"):
+            z = grid.sample(x, y, method=method)
+            self.assertTrue(np.allclose(z, x/10.0 - 0.5, atol=0.05))
+        with self.assertRaises(ValueError):
+            grid.sample(x, y, method="quintic")
+        with self.assertRaises(karta.errors.GridError):
+            grid.sample(np.array([-20.0]), np.array([5.0]), method="cubic")
+        return
+
+    def test_sample_kernels_nodata(self):
+        values = np.ones((20, 20))
+        values[10:, :] = -9999.0
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values, nodata_value=-9999.0)
+        z = grid.sample(np.array([5.0, 5.0]), np.array([9.9, 10.1]),
+                        method="cubic")
+        self.assertEqual(list(z), [1.0, -9999.0])
+        return
+
+    def test_sample_band_subset(self):
+        values = np.dstack([k*peaks(n=40) for k in range(1, 6)])
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values)
+        x = np.array([3.5, 10.5, 30.5])
+        y = np.array([5.5, 20.5, 0.5])
+        z = grid.sample(x, y, method="nearest", bands=[4, 1])
+        self.assertEqual(z.shape, (3, 2))
+        self.assertTrue(np.all(z == values[[5, 20, 0], [3, 10, 30]][:,[4, 1]]))
+
+        z = grid.sample(x, y, method="cubic")
+        self.assertEqual(z.shape, (3, 5))
+        self.assertTrue(np.allclose(z, values[[5, 20, 0], [3, 10, 30]]))
+
+        z = grid.sample(x, y, method="bilinear", bands=2)
+        self.assertEqual(z.shape, (3,))
+        self.assertTrue(np.allclose(z, values[[5, 20, 0], [3, 10, 30], 2]))
+        return
+
     def test_vertex_coords(self):
         grid = karta.RegularGrid((0.0, 0.0, 30.0, 30.0, 0.0, 0.0),
                                  values=np.zeros([49, 49]))
@@ -217,6 +412,121 @@ class RegularGridTests(unittest.TestCase):
         self.assertEqual(minmax, (-6.5466445243204294, 8.075173545159231))
         return
 
+    def test_minmax_chunked(self):
+        values = np.arange(600*500, dtype=np.float64).reshape(600, 500)
+        values[:300, :] = -9999.0
+        for bandclass in (karta.raster.CompressedBand,
+                          karta.raster.SimpleBand):
+            grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                     values=values, nodata_value=-9999.0,
+                                     bandclass=bandclass)
+            self.assertEqual(grid.minmax(), (150000.0, 299999.0))
+            grid[500:510, 0:10] = -np.ones((10, 10))
+            self.assertEqual(grid.min(), -1.0)
+        return
+
+    def test_minmax_statistics_from_load(self):
+        # statistics recorded while the grid is written are used directly
+        values = np.arange(600*500, dtype=np.float64).reshape(600, 500)
+        values[:300, :] = -9999.0
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values, nodata_value=-9999.0)
+        band = grid.bands[0]
+        self.assertEqual(band.nodata, -9999.0)
+        self.assertTrue(band._statsvalid.all())
+        self.assertEqual(grid.minmax(), (150000.0, 299999.0))
+
+        grid.set_nodata_value(-1.0)
+        self.assertEqual(band.nodata, -1.0)
+        self.assertTrue(band._statsvalid.all())
+        self.assertEqual(grid.min(), 150000.0)
+        return
+
+    def test_mean_std(self):
+        values = np.random.RandomState(42).randn(600, 500) * 5 + 1e4
+        values[100:200, 300:] = np.nan
+        valid = values[~np.isnan(values)]
+        for bandclass in (karta.raster.CompressedBand,
+                          karta.raster.SimpleBand):
+            grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                     values=values, nodata_value=np.nan,
+                                     bandclass=bandclass)
+            self.assertAlmostEqual(grid.mean(), valid.mean(), places=9)
+            self.assertAlmostEqual(grid.std(), valid.std(), places=9)
+        return
+
+    def test_mean_std_nodata(self):
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=-9*np.ones((3, 3)), nodata_value=-9)
+        self.assertTrue(np.isnan(grid.mean()))
+        self.assertTrue(np.isnan(grid.std()))
+        return
+
+    def test_histogram(self):
+        values = np.random.RandomState(42).randn(600, 500)
+        values[:256, :256] = 0.5
+        values[300:, 300:] = -9999.0
+        valid = values[values != -9999.0]
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values, nodata_value=-9999.0)
+        counts, edges = grid.histogram(bins=15)
+        expected, expected_edges = np.histogram(valid, bins=15)
+        self.assertTrue(np.all(counts == expected))
+        self.assertTrue(np.allclose(edges, expected_edges))
+
+        counts, edges = grid.histogram(bins=[-1, 0, 1])
+        expected, _ = np.histogram(valid, bins=[-1, 0, 1])
+        self.assertTrue(np.all(counts == expected))
+        return
+
+    def test_aschunks(self):
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=np.zeros((40, 100)))
+        chunks = list(grid.aschunks())
+        self.assertEqual(chunks[0].size, (10, 25))
+        self.assertEqual(len(chunks), 16)
+        # size and overlap are (columns, rows)
+        chunks = list(grid.aschunks(size=(50, 20)))
+        self.assertEqual(chunks[0].size, (20, 50))
+        self.assertEqual(chunks[1].transform, (50, 0, 1, 1, 0, 0))
+        self.assertEqual(chunks[2].transform, (0, 20, 1, 1, 0, 0))
+        chunks = list(grid.aschunks(size=(50, 20), overlap=(10, 0)))
+        self.assertEqual(chunks[1].transform, (40, 0, 1, 1, 0, 0))
+        return
+
+    def test_map_chunks(self):
+        values = peaks(n=300)
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values)
+        expected = box_sum(values)
+        for workers in (1, 3):
+            result = grid.map_chunks(box_sum, size=(64, 100), overlap=(1, 1),
+                                     workers=workers)
+            self.assertEqual(result.size, grid.size)
+            self.assertEqual(result.transform, grid.transform)
+            self.assertTrue(np.allclose(result[:,:], expected))
+        return
+
+    def test_map_chunks_executor(self):
+        from multiprocessing.pool import ThreadPool
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=np.dstack([peaks(n=300)]*2))
+        pool = ThreadPool(2)
+        try:
+            result = grid.map_chunks(lambda a: a[:,:,0] > 0, executor=pool,
+                                     workers=2)
+        finally:
+            pool.close()
+        self.assertEqual(len(result.bands), 1)
+        self.assertEqual(result.bands[0].dtype, np.bool_)
+        self.assertTrue(np.all(result[:,:] == (peaks(n=300) > 0)))
+        return
+
+    def test_map_chunks_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.rast.map_chunks(lambda a: a[1:,:], size=(16, 16))
+        return
+
     def test_clip(self):
         clipped = self.rast.clip(500, 950, 500, 950)
         self.assertEqual(clipped.size, (15, 15))
@@ -228,6 +538,12 @@ class RegularGridTests(unittest.TestCase):
         self.assertEqual(Y[-1,0], 945)
         return
 
+    def test_clip_partial_overlap(self):
+        clipped = self.rast.clip(-500, 200, 1000, 3000)
+        self.assertEqual(clipped.size, (16, 7))
+        self.assertEqual(clipped.transform, (0, 990, 30, 30, 0, 0))
+        return
+
     def test_clip_to_extent(self):
         proto = karta.RegularGrid((500, 500, 30, 30, 0, 0), np.zeros((15,15)))
         clipped = self.rast.clip(*proto.get_extent("edge"))
@@ -268,6 +584,25 @@ class RegularGridTests(unittest.TestCase):
         self.assertTrue(np.all(newgrid[:3,:2] == proto[-3:,-2:]))
         return
 
+    def test_resize_memmap(self):
+        proto = karta.RegularGrid((500, 500, 30, 30, 0, 0), values=peaks(50),
+                                  bandclass=karta.raster.MemmapBand)
+        newgrid = proto.resize([380, 320, 380+30*60, 320+30*62])
+        self.assertTrue(isinstance(newgrid.bands[0], karta.raster.MemmapBand))
+        self.assertTrue(np.all(newgrid[6:56,4:54] == proto[:,:]))
+        self.assertTrue(np.all(np.isnan(newgrid[:6,:])))
+        return
+
+    def test_resize_bandkwargs(self):
+        proto = karta.RegularGrid((500, 500, 30, 30, 0, 0), values=peaks(50),
+                                  bandkwargs=dict(compressor="lz4",
+                                                  chunksize=(16, 16)))
+        newgrid = proto.resize([380, 320, 380+30*60, 320+30*62])
+        self.assertEqual(newgrid.bands[0].compressor, "lz4")
+        self.assertEqual(newgrid.bands[0]._chunksize, (16, 16))
+        self.assertTrue(np.all(newgrid[6:56,4:54] == proto[:,:]))
+        return
+
     def test_data_mask_nan(self):
         T = [0.0, 0.0, 1.0, 1.0, 0.0, 0.0]
         v = np.arange(64, dtype=np.float64).reshape([8, 8])
@@ -293,7 +628,8 @@ class RegularGridTests(unittest.TestCase):
                                  values=np.arange(1e6).reshape(1000, 1000),
                                  crs=karta.crs.Cartesian)
         masked_grid = grid.mask_by_poly(poly)
-        self.assertEqual(int(np.nansum(masked_grid[:,:])), 97048730546)
+        # sum of cells with centers inside the polygon
+        self.assertEqual(int(np.nansum(masked_grid[:,:])), 96937778947)
         return
 
     def test_mask_poly_inplace(self):
@@ -305,7 +641,7 @@ class RegularGridTests(unittest.TestCase):
                                  values=np.arange(1e6).reshape(1000, 1000),
                                  crs=karta.crs.Cartesian)
         grid.mask_by_poly(poly, inplace=True)
-        self.assertEqual(int(np.nansum(grid[:,:])), 97048730546)
+        self.assertEqual(int(np.nansum(grid[:,:])), 96937778947)
         return
 
     def test_mask_poly_partial(self):
@@ -333,7 +669,401 @@ class RegularGridTests(unittest.TestCase):
                                  values=np.arange(1e6).reshape(1000, 1000),
                                  crs=karta.crs.Cartesian)
         masked_grid = grid.mask_by_poly([poly, poly2])
-        self.assertEqual(int(np.nansum(masked_grid[:,:])), 47081206720)
+        self.assertEqual(int(np.nansum(masked_grid[:,:])), 47025269255)
+        return
+
+    def test_mask_poly_holes(self):
+        outer = karta.Polygon([(1, 1), (9, 1), (9, 9), (1, 9)])
+        hole = karta.Polygon([(3, 3), (3, 7), (7, 7), (7, 3)])
+        poly = karta.Polygon(outer.vertices, subs=[hole])
+        mp = karta.Multipolygon([[[(12, 2), (18, 2), (15, 8)]],
+                                 [[(12, 12), (18, 12), (18, 18), (12, 18)],
+                                  [(14, 14), (16, 14), (16, 16), (14, 16)]]])
+        grid = karta.RegularGrid([0.0, 0.0, 1.0, 1.0, 0.0, 0.0],
+                                 values=np.ones((20, 20)))
+        masked = grid.mask_by_poly([poly, mp])
+        expected = np.zeros((20, 20), dtype=bool)
+        expected[1:9,1:9] = True
+        expected[3:7,3:7] = False
+        expected[12:18,12:18] = True
+        expected[14:16,14:16] = False
+        X, Y = grid.center_coords()
+        expected |= (Y > 2) & (Y < 8) & (np.abs(X-15) < (8-Y)/2)
+        self.assertTrue(np.all(~np.isnan(masked[:,:]) == expected))
+        return
+
+    def test_rasterize_coverage(self):
+        # rotated square with a hole, partly outside the grid
+        theta = np.linspace(0, 2*np.pi, 5)[:-1] + 0.3
+        outer = np.column_stack([8*np.cos(theta)+3, 8*np.sin(theta)+10])
+        inner = np.column_stack([2*np.cos(theta)+5, 2*np.sin(theta)+10])
+        poly = karta.Polygon(outer, subs=[karta.Polygon(inner)])
+        T = [0.0, 0.0, 0.5, 0.5, 0.0, 0.0]
+        cov = karta.raster.rasterize(poly, T, (40, 40), coverage=True)
+        self.assertTrue(np.all((cov[:,:] >= 0) & (cov[:,:] <= 1)))
+
+        # exact area, compared with a finely sampled mask
+        fine = karta.raster.rasterize(poly, [0, 0, 0.025, 0.025, 0, 0],
+                                      (800, 800))
+        area = cov[:,:].sum() * 0.25
+        self.assertAlmostEqual(area, fine[:,:].sum() * 0.025**2, places=1)
+        inside = karta.raster.rasterize(poly, T, (40, 40))
+        self.assertTrue(np.all(cov[:,:][inside[:,:] == 0] < 1))
+        self.assertTrue(np.all(cov[:,:][inside[:,:] == 1] > 0))
+        return
+
+    def test_rasterize_strips(self):
+        t = -np.linspace(0, 2*np.pi, 200)
+        poly = karta.Polygon(zip((2+np.cos(7*t))*np.cos(t+0.3)*12 + 30,
+                                 (2+np.cos(7*t))*np.sin(t+0.2)*12 + 30))
+        T = [0.0, 0.0, 0.5, 0.5, 0.0, 0.0]
+        expected = karta.raster.rasterize(poly, T, (120, 120), coverage=True)
+        ncells = karta.raster.grid.REDUCTION_CELLS
+        try:
+            karta.raster.grid.REDUCTION_CELLS = 1000
+            cov = karta.raster.rasterize(poly, T, (120, 120), coverage=True)
+        finally:
+            karta.raster.grid.REDUCTION_CELLS = ncells
+        self.assertTrue(np.allclose(cov[:,:], expected[:,:]))
+        return
+
+    def test_zonal_stats(self):
+        # a grid of adjacent square zones, one with a hole, and a triangle
+        parts = [[[(x, y), (x+4, y), (x+4, y+4), (x, y+4)]]
+                 for x in (0, 4, 8) for y in (0, 4)]
+        parts[0].append([(1, 1), (1, 3), (3, 3), (3, 1)])
+        parts.append([[(2, 9), (9, 9), (5.5, 13)]])
+        mp = karta.Multipolygon(parts)
+        values = peaks(14)
+        values[10,6] = -999
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=values,
+                                 nodata_value=-999)
+        ncells = karta.raster.grid.REDUCTION_CELLS
+        try:
+            karta.raster.grid.REDUCTION_CELLS = 30
+            result = grid.zonal_stats(mp)
+        finally:
+            karta.raster.grid.REDUCTION_CELLS = ncells
+
+        for k in range(len(mp)):
+            v = grid.mask_by_poly(mp[k])[:,:]
+            v = v[v != -999]
+            self.assertEqual(result["count"][k], len(v))
+            for name, func in (("sum", np.sum), ("mean", np.mean), ("std", np.std),
+                               ("min", np.min), ("max", np.max)):
+                self.assertAlmostEqual(result[name][k], func(v))
+        self.assertEqual(result["count"][0], 12)
+        self.assertEqual(mp.data.getfield("mean"), result["mean"])
+        return
+
+    def test_zonal_stats_empty(self):
+        polys = [karta.Polygon([(1, 1), (3, 1), (3, 3), (1, 3)]),
+                 karta.Polygon([(20, 20), (23, 20), (23, 23), (20, 23)])]
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=np.ones((5, 5)))
+        result = grid.zonal_stats(polys, stats=["count", "mean"])
+        self.assertEqual(result["count"], [4, 0])
+        self.assertEqual(result["mean"][0], 1.0)
+        self.assertTrue(np.isnan(result["mean"][1]))
+        self.assertRaises(ValueError, grid.zonal_stats, polys, stats=["median"])
+        return
+
+    def test_terrain(self):
+        # plane z = 2x + 3y plus a bowl, so curvature is constant
+        x, y = np.meshgrid(np.arange(40)*2.0, np.arange(30)*3.0)
+        z = 2*x + 3*y + 0.5*(x**2 + y**2)
+        z[10, 10] = -1
+        grid = karta.RegularGrid([0, 0, 2.0, 3.0, 0, 0], values=z,
+                                 nodata_value=-1)
+        result = karta.raster.terrain(grid, ["slope", "gradient", "curvature",
+                                             "aspect", "hillshade"],
+                                      size=(8, 8))
+        dzdx, dzdy = result["gradient"]
+        inner = (slice(12, -1), slice(12, -1))
+        self.assertTrue(np.allclose(dzdx[inner], (2 + x)[inner]))
+        self.assertTrue(np.allclose(dzdy[inner], (3 + y)[inner]))
+        self.assertTrue(np.allclose(result["slope"][inner],
+                                    np.hypot(2+x, 3+y)[inner]))
+        self.assertTrue(np.allclose(result["aspect"][inner],
+                                    np.arctan2(3+y, -2-x)[inner]))
+        self.assertTrue(np.allclose(result["curvature"][inner], -2.0))
+        self.assertTrue(np.all(result["hillshade"][inner] <= 1.0))
+
+        # edges and neighbours of nodata are undefined
+        for g in (result["slope"], result["curvature"], dzdx):
+            values = g[:,:]
+            self.assertTrue(np.all(np.isnan(values[0,:])))
+            self.assertTrue(np.all(np.isnan(values[:,-1])))
+            self.assertTrue(np.all(np.isnan(values[9:12,9:12])))
+            self.assertEqual(np.isnan(values).sum(), 2*30 + 2*40 - 4 + 9)
+        return
+
+    def test_terrain_matches_slope(self):
+        result = karta.raster.terrain(self.rast, ["slope", "aspect"],
+                                      size=(16, 16))
+        slope = karta.raster.slope(self.rast)
+        self.assertTrue(np.array_equal(result["slope"][:,:], slope[:,:],
+                                       equal_nan=True))
+        self.assertRaises(ValueError, karta.raster.terrain, self.rast, ["tilt"])
+        return
+
+    def test_hillshade_percentile_clip(self):
+        result = karta.raster.terrain(self.rast, ["hillshade"])["hillshade"]
+        values = result[:,:]
+        q = np.percentile(values[~np.isnan(values)], [2, 98])
+        shade = karta.raster.hillshade(self.rast)[:,:]
+        self.assertAlmostEqual(np.nanmin(shade), q[0])
+        self.assertAlmostEqual(np.nanmax(shade), q[1])
+        return
+
+    def test_percentiles_nodata(self):
+        values = np.random.RandomState(7).rand(200, 150)
+        values[20:40, 10:90] = -1.0
+        grid = karta.RegularGrid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0),
+                                 values=values, nodata_value=-1.0)
+        q = karta.raster.misc._percentiles(grid, [2, 50, 98])
+        expected = np.percentile(values[values != -1.0], [2, 50, 98])
+        self.assertTrue(np.allclose(q, expected))
+        return
+
+    def test_viewshed_flat(self):
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=np.zeros((40, 60)))
+        for (i, j) in [(10, 50), (0, 0), (39, 30)]:
+            vs = karta.raster.viewshed(grid, j+0.5, i+0.5)
+            self.assertTrue(np.all(vs[:,:] == 1))
+            vs = karta.raster.viewshed(grid, j+0.5, i+0.5, radius=7.0)
+            I, J = np.indices(grid.size)
+            self.assertTrue(np.array_equal(vs[:,:] == 1,
+                                           np.hypot(I-i, J-j) <= 7.0))
+        return
+
+    def test_viewshed_wall(self):
+        z = np.zeros((50, 50))
+        z[:,30] = 10.0
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        vs = karta.raster.viewshed(grid, 10.5, 25.5, observer_height=1.0)
+        self.assertTrue(np.all(vs[:,:31] == 1))
+        self.assertTrue(np.all(vs[:,31:] == 0))
+        vs = karta.raster.viewshed(grid, 10.5, 25.5, observer_height=1.0,
+                                   target_height=100.0)
+        self.assertTrue(np.all(vs[:,:] == 1))
+        return
+
+    def test_viewshed_curvature(self):
+        # over flat ground the horizon is at sqrt(2 R h / (1-k))
+        grid = karta.RegularGrid([0, 0, 100, 100, 0, 0],
+                                 values=np.zeros((3, 200)))
+        vs = karta.raster.viewshed(grid, 50, 150, observer_height=10.0,
+                                   curvature=True)
+        horizon = np.sqrt(2*karta.raster.misc.EARTH_RADIUS*10.0/0.87)
+        self.assertEqual(vs[1,:].sum(), int(horizon // 100) + 1)
+        vs = karta.raster.viewshed(grid, 50, 150, observer_height=10.0)
+        self.assertEqual(vs[1,:].sum(), 200)
+        return
+
+    def test_cumulative_viewshed(self):
+        z = np.zeros((50, 50))
+        z[:,30] = 10.0
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        x = [10.5, 40.5, 20.5]
+        y = [25.5, 25.5, 5.5]
+        counts = karta.raster.cumulative_viewshed(grid, x, y,
+                                                  observer_height=1.0)
+        expected = sum(karta.raster.viewshed(grid, xi, yi,
+                                             observer_height=1.0)[:,:]
+                       for xi, yi in zip(x, y))
+        self.assertTrue(np.array_equal(counts[:,:], expected))
+        self.assertRaises(karta.errors.GridError,
+                          karta.raster.cumulative_viewshed, grid, [60.0], [1.0])
+        return
+
+    def _focal_reference(self, z, footprint, func):
+        ny, nx = z.shape
+        h, w = footprint.shape[0]//2, footprint.shape[1]//2
+        out = np.full(z.shape, np.nan)
+        for i in range(ny):
+            for j in range(nx):
+                if np.isnan(z[i,j]):
+                    continue
+                fp = footprint[max(h-i, 0):footprint.shape[0]-max(i+h+1-ny, 0),
+                               max(w-j, 0):footprint.shape[1]-max(j+w+1-nx, 0)]
+                window = z[max(i-h, 0):i+h+1, max(j-w, 0):j+w+1][fp]
+                out[i,j] = func(window[~np.isnan(window)])
+        return out
+
+    def test_focal(self):
+        np.random.seed(49)
+        z = np.random.rand(40, 37) * 100
+        z[10:13,5:9] = -1
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z, nodata_value=-1)
+        zn = np.where(z == -1, np.nan, z)
+        footprint = np.ones((5, 3), dtype=bool)
+        for stat, func in [("mean", np.mean), ("std", np.std), ("min", np.min),
+                           ("max", np.max), ("median", np.median)]:
+            result = grid.focal(stat, size=(5, 3), chunksize=(16, 16))
+            expected = self._focal_reference(zn, footprint, func)
+            self.assertTrue(np.allclose(result[:,:], expected, equal_nan=True))
+        self.assertTrue(np.all(np.isnan(result[10:13,5:9])))
+        return
+
+    def test_focal_footprint(self):
+        np.random.seed(49)
+        z = np.random.rand(30, 30)
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        footprint = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool)
+        result = grid.focal("max", footprint=footprint)
+        expected = self._focal_reference(z, footprint, np.max)
+        self.assertTrue(np.allclose(result[:,:], expected))
+        result = grid.focal(lambda v: np.nansum(v, axis=-1), footprint=footprint)
+        expected = self._focal_reference(z, footprint, np.sum)
+        self.assertTrue(np.allclose(result[:,:], expected))
+        self.assertRaises(ValueError, grid.focal, "mean", size=4)
+        self.assertRaises(ValueError, grid.focal, "mode")
+        return
+
+    def test_fill_depressions(self):
+        z = np.array([[5, 5, 5, 5, 5],
+                      [5, 3, 2, 3, 5],
+                      [5, 2, 1, 2, 5],
+                      [5, 3, 2, 3, 4.5],
+                      [5, 5, 5, 5, 5]])
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        filled = grid.fill_depressions()[:,:]
+        expected = z.copy()
+        expected[1:4,1:4] = 4.5
+        self.assertTrue(np.array_equal(filled, expected))
+        return
+
+    def test_flow_routing(self):
+        z = np.array([[5, 5, 5, 5, 5],
+                      [5, 3, 2, 3, 5],
+                      [5, 2, 1, 2, 5],
+                      [5, 3, 2, 3, 4.5],
+                      [5, 5, 5, 5, 5]])
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        direction = grid.flow_direction()
+        codes = direction[:,:]
+        self.assertEqual(codes[3,4], karta.raster.grid.FLOW_OUTLET)
+        # every interior cell follows a path to the outlet
+        for i in range(1, 4):
+            for j in range(1, 4):
+                path = [(i, j)]
+                while codes[path[-1]] >= 0:
+                    di, dj = karta.raster.grid.FLOW_OFFSETS[codes[path[-1]]]
+                    path.append((path[-1][0]+di, path[-1][1]+dj))
+                    self.assertTrue(len(path) < 25)
+                self.assertEqual(path[-1], (3, 4))
+
+        acc = grid.flow_accumulation()
+        self.assertEqual(acc[3,4], 25)
+        self.assertTrue(np.array_equal(
+            grid.flow_accumulation(direction=direction)[:,:], acc[:,:]))
+
+        # cells next to nodata drain into it
+        z[4,4] = -1
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z, nodata_value=-1)
+        self.assertEqual(grid.flow_direction()[4,4],
+                         karta.raster.grid.FLOW_NODATA)
+        self.assertEqual(grid.fill_depressions()[2,2], 3.0)
+        self.assertEqual(grid.flow_accumulation()[4,4], 0)
+        return
+
+    def test_flow_accumulation_plane(self):
+        # a plane sloping toward the bottom row drains down each column
+        z = np.add.outer(np.arange(20.0), np.zeros(15))
+        z[:,0] += 0.1
+        z[:,-1] += 0.1
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        acc = grid.flow_accumulation()[:,:]
+        self.assertTrue(np.all(acc[1:,:] == np.arange(19, 0, -1)[:,np.newaxis]))
+        # the raised edge columns spill sideways in the bottom row
+        self.assertTrue(np.array_equal(acc[0,1:-1], [40] + 11*[20] + [40]))
+        return
+
+    def test_flow_accumulation_invalid_direction(self):
+        z = np.add.outer(np.arange(6.0), np.arange(5.0))
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=z)
+        codes = grid.flow_direction()[:,:].astype(np.float64)
+        for bad in (8, 100, -3, np.nan):
+            values = codes.copy()
+            values[2,3] = bad
+            direction = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=values,
+                                          nodata_value=-99)
+            with self.assertRaises(ValueError):
+                grid.flow_accumulation(direction=direction)
+
+        # cells matching the direction nodata value are nodata
+        values = codes.copy()
+        values[2,3] = 255
+        direction = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=values,
+                                      nodata_value=255)
+        self.assertEqual(grid.flow_accumulation(direction=direction)[2,3], 0)
+        return
+
+    def test_build_overviews(self):
+        np.random.seed(49)
+        z = np.random.rand(37, 53)
+        z[3,5] = -1
+        grid = karta.RegularGrid([10, 20, 2, 3, 0, 0], values=z, nodata_value=-1)
+        overviews = grid.build_overviews([2, 4, 8])
+        self.assertEqual([ov.size for ov in overviews],
+                         [(19, 27), (10, 14), (5, 7)])
+        self.assertEqual(overviews[1].transform, (10, 20, 8, 12, 0, 0))
+        zn = np.where(z == -1, np.nan, z)
+        self.assertAlmostEqual(overviews[0][1,2], np.nanmean(zn[2:4,4:6]))
+        # partial edge cells average the cells inside the grid
+        self.assertAlmostEqual(overviews[2][4,6], zn[32:,48:].mean())
+
+        # resampling by multiples of an overview gives the full-resolution
+        # result, and other factors give the same structure
+        plain = karta.RegularGrid([10, 20, 2, 3, 0, 0], values=z,
+                                  nodata_value=-1)
+        for dx, dy in [(8, 12), (16, 24)]:
+            self.assertTrue(np.allclose(grid.resample(dx, dy, "average")[:,:],
+                                        plain.resample(dx, dy, "average")[:,:]))
+        self.assertEqual(grid.resample(10, 10, "average").size,
+                         plain.resample(10, 10, "average").size)
+        self.assertRaises(ValueError, grid.build_overviews, [1])
+        self.assertRaises(ValueError, grid.build_overviews, [2], method="max")
+        return
+
+    def test_overview_selection(self):
+        np.random.seed(49)
+        grid = karta.RegularGrid([10, 20, 2, 3, 0, 0],
+                                 values=np.random.rand(40, 60))
+        overviews = grid.build_overviews([2, 4, 8])
+        self.assertTrue(grid._overview(5.0) is grid)
+        self.assertTrue(grid._overview(6.0) is overviews[0])
+        self.assertTrue(grid._overview((8, 13)) is overviews[1])
+        self.assertTrue(grid._overview(100.0, "nearest") is grid)
+        self.assertTrue(grid._overview(100.0, "cubic") is overviews[2])
+
+        self.assertEqual(grid.sample([30.0], [50.0], resolution=12),
+                         overviews[1].sample([30.0], [50.0]))
+        clipped = grid.clip(10, 60, 20, 80, resolution=12)
+        self.assertEqual(clipped.transform[2:4], (8, 12))
+        line = karta.Line([(11, 21), (100, 100)])
+        _, z = grid.profile(line, resolution=12)
+        _, expected = overviews[1].profile(line, resolution=12)
+        self.assertTrue(np.allclose(z, expected))
+
+        # assigning values discards the overviews
+        grid[:,:] = np.zeros((40, 60))
+        self.assertEqual(grid.overviews, [])
+        return
+
+    def test_overviews_invalidated(self):
+        grid = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=np.ones((64, 64)))
+        other = karta.RegularGrid([0, 0, 1, 1, 0, 0], values=np.ones((64, 64)))
+        grid.build_overviews([2, 4])
+        grid[:,:] = grid + other
+        self.assertEqual(grid.overviews, [])
+        self.assertEqual(grid.sample([40.0], [40.0], resolution=2), 2.0)
+
+        grid.build_overviews([2, 4])
+        poly = karta.Polygon([(0, 0), (20, 0), (20, 20), (0, 20)])
+        grid.mask_by_poly(poly, inplace=True)
+        self.assertEqual(grid.overviews, [])
+        self.assertTrue(np.isnan(grid.sample([40.0], [40.0], resolution=2)))
         return
 
     def test_get_positions(self):
@@ -345,6 +1075,25 @@ class RegularGridTests(unittest.TestCase):
         self.assertEqual((i,j), (1.0, 1.5))
         return
 
+    def test_get_positions_skewed(self):
+        grid = karta.RegularGrid([100.0, -50.0, 30.0, 20.0, 4.0, -2.5],
+                                 values=np.zeros((40, 60)))
+        i = np.array([0.0, 3.25, 39.0, -2.5])
+        j = np.array([0.0, 10.5, 59.0, 70.0])
+        x, y = grid.get_coordinates(i, j)
+        self.assertEqual((x[0], y[0]), (117.0, -41.25))
+        i2, j2 = grid.get_positions(x, y)
+        self.assertTrue(np.allclose(i2, i))
+        self.assertTrue(np.allclose(j2, j))
+        self.assertEqual(list(grid.in_bounds(i2, j2)),
+                         [True, True, True, False])
+        return
+
+    def test_get_indices_outside(self):
+        with self.assertRaises(karta.errors.GridError):
+            self.rast.get_indices([15.0, 1500.0], [15.0, 15.0])
+        return
+
     def test_get_indices(self):
         ind = self.rast.get_indices(15.0, 15.0)
         self.assertEqual(tuple(ind), (0, 0))
@@ -414,6 +1163,49 @@ class RegularGridTests(unittest.TestCase):
         self.assertTrue(np.allclose(z, expected))
         return
 
+    def test_sample_along(self):
+        path = karta.Line([(15.0, 15.0), (315.0, 15.0), (315.0, 415.0)],
+                          crs=karta.crs.Cartesian)
+        d, x, y, z = self.rast.sample_along(path, resolution=40.0,
+                                            method="nearest")
+        self.assertTrue(np.allclose(d, np.arange(18)*40.0))
+        self.assertTrue(np.allclose(x[:8], np.arange(15.0, 315.0, 40.0)))
+        self.assertTrue(np.allclose(x[8:], 315.0))
+        self.assertTrue(np.allclose(y[8:], np.arange(35.0, 415.0, 40.0)))
+        self.assertTrue(np.allclose(z, self.rast.sample(x, y, method="nearest")))
+        return
+
+    def test_sample_along_multiline(self):
+        lines = [[(15.0, 15.0), (1400.0, 1400.0)],
+                 [(700.0, 20.0), (20.0, 700.0), (20.0, 20.0)],
+                 [(500.0, 500.0), (510.0, 500.0)]]
+        ml = karta.Multiline(lines, crs=karta.crs.Cartesian)
+        d, x, y, z = self.rast.sample_along(ml, resolution=25.0,
+                                            method="nearest")
+        self.assertEqual(len(z), 3)
+        for k, line in enumerate(lines):
+            expected = self.rast.sample_along(karta.Line(line), resolution=25.0,
+                                              method="nearest")
+            for a, b in zip((d[k], x[k], y[k], z[k]), expected):
+                self.assertTrue(np.allclose(a, b))
+        self.assertEqual(len(z[2]), 1)
+        return
+
+    def test_sample_along_geodesic(self):
+        grid = karta.RegularGrid((-10.0, 40.0, 0.1, 0.1, 0.0, 0.0),
+                                 values=np.zeros((100, 100)),
+                                 crs=karta.crs.LonLatWGS84)
+        line = karta.Line([(-9.0, 41.0), (-1.0, 49.0)], crs=karta.crs.LonLatWGS84)
+        d, x, y, z = grid.sample_along(line, resolution=20000.0)
+        az, _, dist = karta.crs.LonLatWGS84.inverse(x[:-1], y[:-1], x[1:], y[1:])
+        self.assertTrue(np.allclose(dist, 20000.0))
+        # positions lie on the geodesic between the endpoints
+        n = len(x) - 1
+        az0, _, _ = karta.crs.LonLatWGS84.inverse(np.full(n, -9.0),
+                                                  np.full(n, 41.0), x[1:], y[1:])
+        self.assertTrue(np.allclose(az0, az0[0]))
+        return
+
     def test_gridpoints(self):
         np.random.seed(49)
         x = np.random.rand(20000)*10.0-5.0
@@ -427,6 +1219,49 @@ class RegularGridTests(unittest.TestCase):
         self.assertTrue(np.sum(np.abs(Xg**2+Yg**3-grid[:,:]))/Xg.size < 0.45)
         return
 
+    def test_gridpoints_stats(self):
+        np.random.seed(49)
+        x = np.random.rand(5000)*4.0
+        y = np.random.rand(5000)*3.0
+        z = np.random.randint(-1000, 1000, 5000).astype(np.int32)
+        T = [0.0, 0.0, 1.0, 1.0, 0.0, 0.0]
+        grids = karta.raster.gridpoints(x, y, z, T, karta.crs.Cartesian,
+                                        stats=["count", "sum", "mean", "std",
+                                               "min", "max", "first", "last",
+                                               "median", "p90"],
+                                        size=(4, 4))
+        cells = y.astype(int)*4 + x.astype(int)
+        for name, func in (("count", len), ("sum", np.sum), ("mean", np.mean),
+                           ("std", np.std), ("min", np.min), ("max", np.max),
+                           ("first", lambda a: a[0]), ("last", lambda a: a[-1]),
+                           ("median", np.median),
+                           ("p90", lambda a: np.percentile(a, 90))):
+            expected = [func(z[cells == c]) for c in range(12)]
+            self.assertTrue(np.allclose(grids[name][:3,:].ravel(), expected))
+        self.assertEqual(grids["count"][3,0], 0)
+        self.assertTrue(np.all(np.isnan(grids["mean"][3,:])))
+        return
+
+    def test_point_binner_batches(self):
+        np.random.seed(49)
+        x = np.random.rand(3000)*10.0
+        y = np.random.rand(3000)*10.0
+        z = np.random.rand(3000)
+        T = [0.0, 0.0, 2.0, 2.0, 0.0, 0.0]
+        stats = ["mean", "std", "max", "first", "p25"]
+        expected = karta.raster.gridpoints(x, y, z, T, karta.crs.Cartesian,
+                                           stats=stats, size=(5, 5))
+        binner = karta.raster.PointBinner(T, (5, 5), stats=stats)
+        for k in range(0, 3000, 700):
+            binner.add(x[k:k+700], y[k:k+700], z[k:k+700])
+        grids = binner.grids()
+        for name in stats:
+            self.assertTrue(np.allclose(grids[name][:,:], expected[name][:,:]))
+        self.assertRaises(karta.errors.GridError, binner.add, [11.0], [1.0], [1.0])
+        self.assertRaises(ValueError, karta.raster.PointBinner, T, (5, 5),
+                          stats=["mode"])
+        return
+
     def test_read_aai(self):
         grid = karta.read_aai(os.path.join(TESTDATA,'peaks49.asc'))
         self.assertTrue(np.all(grid[::-1] == self.rast[:,:]))
@@ -503,6 +1338,13 @@ class WarpedGridTests(unittest.TestCase):
 #                            6.09829941]))
 #        return
 
+def box_sum(a):
+    """ Sum of each cell and its eight neighbours, treating cells outside
+    the array as zero. """
+    padded = np.pad(a, 1, mode="constant")
+    return sum(padded[i:i+a.shape[0], j:j+a.shape[1]]
+               for i in range(3) for j in range(3))
+
 def peaks(n=49):
     """ 2d peaks function of MATLAB logo fame. """
     X, Y = np.meshgrid(np.linspace(-3, 3, n), np.linspace(-3, 3, n))
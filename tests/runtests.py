@@ -16,6 +16,7 @@ from rtree_tests import *
 from table_tests import *
 from raster_tests import *
 from band_tests import *
+from expression_tests import *
 
 # Vector IO
 from shapefile_tests import *